@@ -0,0 +1,88 @@
+"""
+Microbenchmark: per-save highlighting cost across the 20 most popular
+languages with a fresh lexer and formatter per render (how `Snippet.save`
+used to work) against the per-process renderer pool. Run from the
+repository root:
+
+    python benchmarks/highlight_pool.py [--rounds N]
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tutorial.settings")
+
+import django
+
+django.setup()
+
+from pygments import highlight
+from pygments.formatters.html import HtmlFormatter
+from pygments.lexers import get_lexer_by_name
+
+from snippets import highlighting
+
+LANGUAGES = (
+    "python", "javascript", "typescript", "java", "c", "cpp", "csharp", "go",
+    "rust", "php", "ruby", "kotlin", "swift", "bash", "sql", "html", "css",
+    "json", "yaml", "markdown",
+)
+
+CODE = """\
+def greet(name):
+    # Say hello
+    return "Hello, %s!" % name
+
+for i in range(10):
+    print(greet(i))
+"""
+
+
+def unpooled(code, language, linenos):
+    lexer = get_lexer_by_name(language)
+    formatter = HtmlFormatter(
+        linenos="table" if linenos else False, cssclass=highlighting.CSS_CLASS
+    )
+    return highlight(code, lexer, formatter)
+
+
+def timed(render, language, rounds):
+    render(CODE, language, False)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        render(CODE, language, False)
+    return (time.perf_counter() - start) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    print("%-12s %12s %12s %8s" % ("language", "fresh (us)", "pooled (us)", "saved"))
+    totals = [0, 0]
+    for language in LANGUAGES:
+        fresh = timed(unpooled, language, args.rounds)
+        pooled = timed(highlighting.render, language, args.rounds)
+        totals[0] += fresh
+        totals[1] += pooled
+        print(
+            "%-12s %12.1f %12.1f %7.0f%%"
+            % (language, fresh * 1e6, pooled * 1e6, (1 - pooled / fresh) * 100)
+        )
+    print(
+        "%-12s %12.1f %12.1f %7.0f%%"
+        % (
+            "mean",
+            totals[0] / len(LANGUAGES) * 1e6,
+            totals[1] / len(LANGUAGES) * 1e6,
+            (1 - totals[1] / totals[0]) * 100,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Concurrency benchmark: threads creating snippets, each with its audit
+INSERT, against a fresh SQLite file per profile, reporting throughput
+and "database is locked" failures. The profiles are SQLite's defaults,
+the production pragmas with deferred and with immediate transactions,
+and the latter plus the serialized write lock. Run from the repository
+root:
+
+    python benchmarks/sqlite_concurrency.py [--threads N] [--writes N]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tutorial.settings")
+
+import django
+
+django.setup()
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections, transaction
+
+from snippets.models import ExtendedUser, Snippet
+
+DEFERRED = "django.db.backends.sqlite3"
+IMMEDIATE = "snippets.backends.sqlite3"
+PROFILES = (
+    ("default", DEFERRED, None, False),
+    ("production", DEFERRED, "production", False),
+    ("+immediate", IMMEDIATE, "production", False),
+    ("+immediate+lock", IMMEDIATE, "production", True),
+)
+
+
+def writer(owner_id, writes, failures):
+    try:
+        for i in range(writes):
+            try:
+                # Read, then write in the same transaction, as a view
+                # validating before saving does.
+                with transaction.atomic():
+                    owner = ExtendedUser.objects.get(pk=owner_id)
+                    Snippet.objects.create(code="print(%d)" % i, owner=owner)
+            except OperationalError:
+                failures.append(1)
+    finally:
+        connection.close()
+
+
+def run(engine, profile, serialize, threads, writes):
+    connections.close_all()
+    # Connections are made from the settings when first used in a thread.
+    del connections["default"]
+    directory = tempfile.mkdtemp()
+    settings.DATABASES["default"]["ENGINE"] = engine
+    settings.DATABASES["default"]["NAME"] = os.path.join(directory, "bench.sqlite3")
+    settings.SNIPPETS_SQLITE_PROFILE = profile
+    settings.SNIPPETS_SERIALIZE_WRITES = serialize
+    call_command("migrate", verbosity=0)
+    owner = ExtendedUser.objects.create_user(username="bench", password="bench")
+    connection.close()
+
+    failures = []
+    workers = [
+        threading.Thread(target=writer, args=(owner.pk, writes, failures))
+        for _ in range(threads)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    return (threads * writes - len(failures)) / elapsed, len(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--writes", type=int, default=100)
+    args = parser.parse_args()
+
+    print("%-16s %14s %10s" % ("profile", "writes/s", "failed"))
+    for name, engine, profile, serialize in PROFILES:
+        rate, failed = run(engine, profile, serialize, args.threads, args.writes)
+        print("%-16s %14.1f %10d" % (name, rate, failed))
+
+
+if __name__ == "__main__":
+    main()
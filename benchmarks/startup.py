@@ -0,0 +1,76 @@
+"""
+Startup benchmark: time to import `snippets.models` and `tutorial.wsgi`
+in fresh interpreters.
+
+The "eager" rows also build the language and style choices from Pygments
+and load its lexer mapping while the models are imported, which is what
+every process paid before the choices became lazy. Run from the
+repository root:
+
+    python benchmarks/startup.py [--runs N]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Django imports app models through importlib, which `-X importtime` does
+# not report, so the models import is timed by wrapping `import_module`.
+SCRIPT = """
+import json, sys, time
+import django.apps.config as config
+
+timings = {}
+import_module = config.import_module
+
+def timed_import(name, *args):
+    start = time.perf_counter()
+    module = import_module(name, *args)
+    if name == "snippets.models":
+        if %(eager)r:
+            from pygments.lexers import get_lexer_by_name
+            from snippets import choices
+            choices.build()
+        timings[name] = time.perf_counter() - start
+    return module
+
+config.import_module = timed_import
+start = time.perf_counter()
+import tutorial.wsgi
+timings["tutorial.wsgi"] = time.perf_counter() - start
+json.dump(timings, sys.stdout)
+"""
+
+
+def measure(eager):
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE="tutorial.settings")
+    result = subprocess.run(
+        [sys.executable, "-c", SCRIPT % {"eager": eager}],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    for mode, eager in (("eager", True), ("lazy", False)):
+        samples = [measure(eager) for _ in range(args.runs)]
+        for module in ("snippets.models", "tutorial.wsgi"):
+            median = statistics.median(sample[module] for sample in samples)
+            print("%-6s %-16s %8.1f ms" % (mode, module, median * 1000))
+
+
+if __name__ == "__main__":
+    main()
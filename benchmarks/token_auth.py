@@ -0,0 +1,66 @@
+"""
+Microbenchmark: time and queries per authenticated request with DRF's
+`TokenAuthentication` against `CachedTokenAuthentication`, on a
+throwaway test database. Run from the repository root:
+
+    python benchmarks/token_auth.py [--requests N]
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tutorial.settings")
+
+import django
+
+django.setup()
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, setup_test_environment
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIRequestFactory
+
+from snippets.authentication import CachedTokenAuthentication, get_token_cache
+from snippets.models import ExtendedUser
+
+
+def timed(authenticator, request, requests):
+    authenticator.authenticate(request)
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        for _ in range(requests):
+            authenticator.authenticate(request)
+        elapsed = time.perf_counter() - start
+    return elapsed / requests, len(queries) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        user = ExtendedUser.objects.create_user(username="bench", password="bench")
+        token = Token.objects.create(user=user)
+        request = APIRequestFactory().get("/", HTTP_AUTHORIZATION="Token %s" % token.key)
+        get_token_cache().clear()
+
+        plain = timed(TokenAuthentication(), request, args.requests)
+        cached = timed(CachedTokenAuthentication(), request, args.requests)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    print("%-8s %14s %10s" % ("backend", "per call (us)", "queries"))
+    for name, (seconds, queries) in (("plain", plain), ("cached", cached)):
+        print("%-8s %14.1f %10.2f" % (name, seconds * 1e6, queries))
+    print("saved    %13.0f%%" % ((1 - cached[0] / plain[0]) * 100))
+
+
+if __name__ == "__main__":
+    main()
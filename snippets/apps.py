@@ -1,11 +1,50 @@
 from django.apps import AppConfig
-from django.db.models.signals import pre_delete, post_save
+from django.core import checks
+from django.db.backends.signals import connection_created
+
+
+def check_pygments_choices(app_configs, **kwargs):
+    from . import choices
+
+    if choices.table_is_current():
+        return []
+    return [
+        checks.Warning(
+            "The static Pygments choices table does not match the installed "
+            "Pygments release, so choices are computed at runtime.",
+            hint="Run `manage.py build_pygments_choices`.",
+            id="snippets.W001",
+        )
+    ]
+
+def check_shared_cache(app_configs, **kwargs):
+    from django.conf import settings
+    from django.core.cache.backends.dummy import DummyCache
+    from django.core.cache.backends.locmem import LocMemCache
+    from .cache import shared_cache
+
+    if not isinstance(shared_cache(), (LocMemCache, DummyCache)):
+        return []
+    return [
+        checks.Error(
+            "The cache %r named by SNIPPETS_SHARED_CACHE is local to each "
+            "process, so token revocations and cache invalidations would "
+            "not reach the other processes."
+            % getattr(settings, "SNIPPETS_SHARED_CACHE", "default"),
+            hint="Point SNIPPETS_SHARED_CACHE at a file, Redis or Memcached cache.",
+            id="snippets.E001",
+        )
+    ]
 
 class SnippetsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "snippets"
     
     def ready(self):
-        from .signals import audit_signal_handler
-        post_save.connect(audit_signal_handler)
-        pre_delete.connect(audit_signal_handler)
\ No newline at end of file
+        from . import audit, authentication, db, tokens
+        audit.connect()
+        authentication.connect()
+        tokens.connect()
+        connection_created.connect(db.configure_sqlite, dispatch_uid="sqlite-pragmas")
+        checks.register(check_pygments_choices)
+        checks.register(check_shared_cache)
\ No newline at end of file
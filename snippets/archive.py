@@ -0,0 +1,92 @@
+"""
+Time-partitioned audit archives: one gzip NDJSON file per UTC day, read
+back in place by the audit API.
+"""
+
+import datetime
+import gzip
+import json
+import os
+import shutil
+from pathlib import Path
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+# Audit columns written to the archive, `user__username` as `username`.
+FIELDS = (
+    "id",
+    "model_name",
+    "object_id",
+    "action",
+    "timestamp",
+    "user_id",
+    "user__username",
+    "changes",
+)
+
+
+def archive_dir():
+    return Path(
+        getattr(
+            settings, "SNIPPETS_AUDIT_ARCHIVE_DIR", settings.BASE_DIR / "audit-archive"
+        )
+    )
+
+
+def partition_path(day):
+    return archive_dir() / ("audits-%s.ndjson.gz" % day.isoformat())
+
+
+def partitions():
+    """
+    The days with an archive partition, oldest first.
+    """
+    days = []
+    for path in archive_dir().glob("audits-*.ndjson.gz"):
+        try:
+            days.append(datetime.date.fromisoformat(path.name[7:17]))
+        except ValueError:
+            continue
+    return sorted(days)
+
+
+def write_partition(day, rows):
+    """
+    Add the audit `rows`, dicts of `FIELDS`, to the partition of `day` as
+    a new gzip member, and return their ids once the file is durably
+    replaced. An interrupted write leaves the partition as it was.
+    """
+    path = partition_path(day)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    ids = []
+    with open(tmp, "wb") as out:
+        if path.exists():
+            with open(path, "rb") as existing:
+                shutil.copyfileobj(existing, out)
+        with gzip.GzipFile(fileobj=out, mode="wb", mtime=0) as archive:
+            for row in rows:
+                row["username"] = row.pop("user__username")
+                archive.write(
+                    json.dumps(row, cls=DjangoJSONEncoder).encode("utf-8") + b"\n"
+                )
+                ids.append(row["id"])
+        out.flush()
+        os.fsync(out.fileno())
+    tmp.replace(path)
+    return ids
+
+
+def read_partition(day):
+    """
+    Yield the audits archived for `day`, skipping rows archived twice by
+    a run that stopped before deleting them.
+    """
+    seen = set()
+    with gzip.open(partition_path(day), "rt", encoding="utf-8") as archive:
+        for line in archive:
+            row = json.loads(line)
+            if row["id"] not in seen:
+                seen.add(row["id"])
+                yield row
@@ -0,0 +1,222 @@
+"""
+Audit registry and buffered audit writes.
+
+Models opt in to auditing with the `register` class decorator, which
+also picks the audited actions and the fields whose changes are tracked.
+`connect` then subscribes the audit handlers to those models only.
+
+Inside `buffered()`, which `AuditMiddleware` enters for every request,
+audit records are held back until the transaction that produced them
+commits, then written together with one `bulk_create` when the block
+exits or the buffer outgrows its size or age bounds. Records of writes
+that are rolled back are dropped with their `on_commit` callbacks.
+Outside of it, records are saved immediately. Either way `write` also
+counts them in the hourly `AuditRollup` table.
+"""
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.signals import post_init, post_save, pre_delete
+
+ACTIONS = ("create", "update", "destroy")
+# Longer text values are cut short in the recorded changes.
+DIFF_MAX_LENGTH = 200
+
+registry = {}
+_local = threading.local()
+
+
+def _short(value):
+    if isinstance(value, str) and len(value) > DIFF_MAX_LENGTH:
+        return value[:DIFF_MAX_LENGTH] + "\u2026"
+    return value
+
+
+class AuditOptions:
+    """
+    How one model is audited. With `fields` set, updates are only audited
+    when one of those fields changed since the instance was loaded or
+    last saved, and the audit lists the changes, with the old and new
+    values of the fields in `values`.
+    """
+
+    def __init__(self, model, actions, fields, values):
+        self.model = model
+        self.actions = frozenset(actions)
+        self.fields = fields
+        self.values = frozenset(values)
+        self.attnames = {
+            name: model._meta.get_field(name).attname for name in fields or ()
+        }
+
+    @property
+    def tracks_changes(self):
+        return self.fields is not None and "update" in self.actions
+
+    def snapshot(self, instance):
+        # Deferred fields are left out rather than loaded.
+        instance._audit_snapshot = {
+            name: instance.__dict__[attname]
+            for name, attname in self.attnames.items()
+            if attname in instance.__dict__
+        }
+
+    def changes(self, instance):
+        """
+        Map each tracked field changed since the snapshot to `[old, new]`,
+        or to None if its values are not recorded.
+        """
+        snapshot = getattr(instance, "_audit_snapshot", {})
+        changes = {}
+        for name, attname in self.attnames.items():
+            if attname not in instance.__dict__:
+                continue
+            new = instance.__dict__[attname]
+            if name in snapshot and snapshot[name] == new:
+                continue
+            if name in self.values:
+                changes[name] = [_short(snapshot.get(name)), _short(new)]
+            else:
+                changes[name] = None
+        return changes
+
+
+def register(actions=ACTIONS, fields=None, values=()):
+    """
+    Class decorator opting a model in to auditing, see `AuditOptions`.
+    """
+
+    def decorator(model):
+        registry[model] = AuditOptions(model, actions, fields, values)
+        return model
+
+    return decorator
+
+
+def connect():
+    """
+    Connect the audit handlers to the registered models.
+    """
+    from .signals import audit_signal_handler, snapshot_handler
+
+    for model, options in registry.items():
+        uid = "audit-%s" % model._meta.label_lower
+        if options.actions & {"create", "update"}:
+            post_save.connect(audit_signal_handler, sender=model, dispatch_uid=uid)
+        if "destroy" in options.actions:
+            pre_delete.connect(audit_signal_handler, sender=model, dispatch_uid=uid)
+        if options.tracks_changes:
+            post_init.connect(snapshot_handler, sender=model, dispatch_uid=uid)
+
+
+def _state():
+    if not hasattr(_local, "depth"):
+        _local.depth = 0
+        _local.records = []
+        _local.started = None
+        _local.max_size = None
+        _local.max_age = None
+    return _local
+
+
+def record(audit):
+    """
+    Save the unsaved `audit`, buffering it inside `buffered()`.
+    """
+    if not _state().depth:
+        write([audit])
+        return
+    transaction.on_commit(lambda: _committed(audit))
+
+
+def _committed(audit):
+    state = _state()
+    if not state.depth:
+        # The transaction outlived the buffered block.
+        write([audit])
+        return
+    if not state.records:
+        state.started = time.monotonic()
+    state.records.append(audit)
+    if (
+        len(state.records) >= state.max_size
+        or time.monotonic() - state.started >= state.max_age
+    ):
+        flush()
+
+
+def flush():
+    """
+    Write the buffered audits with one `bulk_create`.
+    """
+    state = _state()
+    records, state.records = state.records, []
+    state.started = None
+    if records:
+        write(records)
+
+
+def write(audits):
+    """
+    Insert unsaved audits and count them in the hourly rollups.
+    """
+    from .models import Audit
+
+    with transaction.atomic(savepoint=False):
+        Audit.objects.bulk_create(audits)
+        roll_up(audits)
+
+
+def roll_up(audits):
+    """
+    Add saved audits to the `AuditRollup` counts of their hour, model,
+    action and user. A unique constraint keeps one row per key, a writer
+    losing the race to create it adds to the winner's row instead.
+    """
+    from .models import AuditRollup
+
+    counts = Counter(
+        (
+            audit.timestamp.replace(minute=0, second=0, microsecond=0),
+            audit.model_name,
+            audit.action,
+            audit.user_id,
+        )
+        for audit in audits
+    )
+    for (hour, model_name, action, user_id), count in counts.items():
+        key = dict(hour=hour, model_name=model_name, action=action, user_id=user_id)
+        if AuditRollup.objects.filter(**key).update(count=F("count") + count):
+            continue
+        try:
+            with transaction.atomic():
+                AuditRollup.objects.create(count=count, **key)
+        except IntegrityError:
+            AuditRollup.objects.filter(**key).update(count=F("count") + count)
+
+
+@contextmanager
+def buffered(max_size=None, max_age=None):
+    """
+    Buffer audit records until the block exits, or until `max_size`
+    records or `max_age` seconds have accumulated, defaulting to
+    `SNIPPETS_AUDIT_BUFFER_SIZE` and `SNIPPETS_AUDIT_BUFFER_AGE`. Buffered
+    records are written even if the block raises. Nested blocks share the
+    outermost buffer and its bounds.
+    """
+    state = _state()
+    if not state.depth:
+        state.max_size = max_size or getattr(settings, "SNIPPETS_AUDIT_BUFFER_SIZE", 500)
+        state.max_age = max_age or getattr(settings, "SNIPPETS_AUDIT_BUFFER_AGE", 5)
+    state.depth += 1
+    try:
+        yield
+    finally:
+        state.depth -= 1
+        if not state.depth:
+            flush()
@@ -0,0 +1,168 @@
+"""
+Token authentication with a per-process cache of which user each token
+belongs to, so most API calls skip the token and user lookup,
+authentication with the stateless signed tokens of `snippets.tokens`, and
+an authentication backend that caches the users of sessions.
+
+Deleting a token or saving or deleting a user drops it from the caches
+of the process making the change, and leaves a stamp in the shared cache
+that makes every other process reload its cached entry on the next hit.
+"""
+import copy
+import time
+from threading import Lock
+
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.db.models.signals import post_delete, post_save
+from rest_framework import exceptions
+from rest_framework.authentication import (
+    BaseAuthentication,
+    TokenAuthentication,
+    get_authorization_header,
+)
+
+from . import tokens
+from .cache import LRUCache, changed_since, stamp
+
+_token_cache = None
+_user_cache = None
+_cache_lock = Lock()
+
+
+def get_token_cache():
+    global _token_cache
+    with _cache_lock:
+        if _token_cache is None:
+            _token_cache = LRUCache(
+                getattr(settings, "SNIPPETS_TOKEN_CACHE_SIZE", 1024),
+                ttl=getattr(settings, "SNIPPETS_TOKEN_CACHE_TTL", 60),
+            )
+        return _token_cache
+
+
+def get_user_cache():
+    global _user_cache
+    with _cache_lock:
+        if _user_cache is None:
+            _user_cache = LRUCache(
+                getattr(settings, "SNIPPETS_USER_CACHE_SIZE", 1024),
+                ttl=getattr(settings, "SNIPPETS_USER_CACHE_TTL", 30),
+            )
+        return _user_cache
+
+
+def _user_stamp(user_id):
+    return "snippets:auth:user:%s" % user_id
+
+
+def _token_stamp(key):
+    return "snippets:auth:token:%s" % key
+
+
+def _stamp_timeout():
+    # A stamp only has to outlive the cache entries loaded before it.
+    return max(
+        getattr(settings, "SNIPPETS_TOKEN_CACHE_TTL", 60),
+        getattr(settings, "SNIPPETS_USER_CACHE_TTL", 30),
+    )
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    `ModelBackend` that refuses soft-deleted users and keeps the users of
+    sessions in a bounded cache for `SNIPPETS_USER_CACHE_TTL` seconds.
+    Saving or deleting a user, which covers soft deletes and staff flag
+    changes, invalidates its entry in every process.
+    """
+
+    def user_can_authenticate(self, user):
+        return super().user_can_authenticate(user) and not getattr(user, "is_deleted", False)
+
+    def get_user(self, user_id):
+        cache = get_user_cache()
+        cached = cache.get(user_id)
+        if cached is not None and changed_since([_user_stamp(user_id)], cached[1]):
+            cached = None
+        if cached is None:
+            # Taken before the query, so a change racing it is not missed.
+            loaded = time.time()
+            user = super().get_user(user_id)
+            if user is None:
+                return None
+            cached = (user, loaded)
+            cache.set(user_id, cached)
+        # Requests may change their user, so each gets its own copy.
+        return copy.copy(cached[0])
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    `TokenAuthentication` that also rejects soft-deleted users, and keeps
+    resolved tokens in a bounded cache for `SNIPPETS_TOKEN_CACHE_TTL`
+    seconds. Deleting a token or saving or deleting its user invalidates
+    the entry in every process, each hit checks the stamps of both.
+    """
+
+    def authenticate_credentials(self, key):
+        cache = get_token_cache()
+        cached = cache.get(key)
+        if cached is not None:
+            user, token, loaded = cached
+            if changed_since([_token_stamp(key), _user_stamp(user.pk)], loaded):
+                cached = None
+        if cached is None:
+            loaded = time.time()
+            user, token = super().authenticate_credentials(key)
+            if getattr(user, "is_deleted", False):
+                raise exceptions.AuthenticationFailed("User inactive or deleted.")
+            cached = (user, token, loaded)
+            cache.set(key, cached)
+        # Requests may change their user, so each gets its own copy.
+        user, token, _ = cached
+        return copy.copy(user), token
+
+
+class SignedTokenAuthentication(BaseAuthentication):
+    """
+    Authenticate `Authorization: Bearer <access token>` headers from the
+    token's signed claims, without a database query.
+    """
+    keyword = "Bearer"
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed("Invalid bearer header.")
+        try:
+            return tokens.verify_access(auth[1].decode())
+        except (tokens.InvalidToken, UnicodeError) as error:
+            raise exceptions.AuthenticationFailed(str(error) or "Invalid token.")
+
+    def authenticate_header(self, request):
+        return self.keyword
+
+
+def forget_token(sender, instance, **kwargs):
+    get_token_cache().delete(instance.key)
+    stamp(_token_stamp(instance.key), _stamp_timeout())
+
+
+def forget_user(sender, instance, **kwargs):
+    get_token_cache().delete_matching(lambda key, value: value[0].pk == instance.pk)
+    get_user_cache().delete(instance.pk)
+    stamp(_user_stamp(instance.pk), _stamp_timeout())
+
+
+def connect():
+    """
+    Invalidate cached tokens and users when they change.
+    """
+    from rest_framework.authtoken.models import Token
+    from .models import ExtendedUser
+
+    post_delete.connect(forget_token, sender=Token, dispatch_uid="token-cache")
+    post_save.connect(forget_user, sender=ExtendedUser, dispatch_uid="token-cache")
+    post_delete.connect(forget_user, sender=ExtendedUser, dispatch_uid="token-cache")
@@ -0,0 +1,52 @@
+"""
+SQLite backend whose transactions start with BEGIN IMMEDIATE.
+
+A deferred transaction that reads and then writes fails right away with
+"database is locked" when another connection wrote in between, as
+SQLite cannot wait for a lock without breaking its snapshot. Taking the
+write lock when the transaction begins lets it wait up to the busy
+timeout instead. With `SNIPPETS_SERIALIZE_WRITES` enabled, transactions
+also hold `db.write_lock` until they commit or roll back.
+
+Django 5.1 offers the former as the "transaction_mode" option.
+"""
+from django.db.backends.sqlite3 import base
+
+from snippets import db
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    holds_write_lock = False
+
+    def _start_transaction_under_autocommit(self):
+        if db.serializes_writes():
+            db.acquire_write_lock()
+            self.holds_write_lock = True
+        try:
+            self.cursor().execute("BEGIN IMMEDIATE")
+        except Exception:
+            self._release_write_lock()
+            raise
+
+    def _commit(self):
+        try:
+            super()._commit()
+        finally:
+            self._release_write_lock()
+
+    def _rollback(self):
+        try:
+            super()._rollback()
+        finally:
+            self._release_write_lock()
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._release_write_lock()
+
+    def _release_write_lock(self):
+        if self.holds_write_lock:
+            self.holds_write_lock = False
+            db.release_write_lock()
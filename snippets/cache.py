@@ -0,0 +1,104 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+def shared_cache():
+    """
+    The Django cache named by `SNIPPETS_SHARED_CACHE`, for state that every
+    process must see.
+    """
+    return caches[getattr(settings, "SNIPPETS_SHARED_CACHE", "default")]
+
+
+def stamp(key, timeout):
+    """
+    Record in the shared cache that `key` changed now, for `timeout` seconds.
+    """
+    shared_cache().set(key, time.time(), timeout)
+
+
+def changed_since(keys, when):
+    """
+    Whether any of the stamps `keys` was set at or after `when`, a
+    `time.time()` value. One round trip to the shared cache.
+    """
+    return any(stamped >= when for stamped in shared_cache().get_many(keys).values())
+
+
+class LRUCache:
+    """
+    A small thread-safe least-recently-used mapping with hit, miss and
+    eviction counters. With `ttl` set, entries also expire that many
+    seconds after they were set.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_matching(self, predicate):
+        """
+        Delete the entries for which `predicate(key, value)` is true.
+        """
+        with self._lock:
+            for key in [
+                key for key, (value, _) in self._data.items() if predicate(key, value)
+            ]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def __len__(self):
+        return len(self._data)
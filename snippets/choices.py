@@ -0,0 +1,47 @@
+"""
+Language and style choices for snippets.
+
+Walking every Pygments lexer and style plugin takes a noticeable part of
+process startup, so the choices are read from the generated
+`pygments_choices` table when it matches the installed Pygments release,
+and only computed from Pygments otherwise. Either way nothing is loaded
+until the choices are first used.
+
+Regenerate the table with `manage.py build_pygments_choices`.
+"""
+from functools import lru_cache
+
+import pygments
+
+
+def build():
+    from pygments.lexers import get_all_lexers
+    from pygments.styles import get_all_styles
+
+    lexers = [item for item in get_all_lexers() if item[1]]
+    language_choices = sorted([(item[1][0], item[0]) for item in lexers])
+    style_choices = sorted((item, item) for item in get_all_styles())
+    return language_choices, style_choices
+
+
+def table_is_current():
+    from . import pygments_choices
+
+    return pygments_choices.PYGMENTS_VERSION == pygments.__version__
+
+
+@lru_cache(maxsize=None)
+def _load():
+    if table_is_current():
+        from . import pygments_choices
+
+        return pygments_choices.LANGUAGE_CHOICES, pygments_choices.STYLE_CHOICES
+    return build()
+
+
+def language_choices():
+    return _load()[0]
+
+
+def style_choices():
+    return _load()[1]
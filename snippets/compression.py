@@ -0,0 +1,166 @@
+"""
+Compressed storage for large text columns.
+
+Compressed values are stored as bytes: a short header holding the CRC-32
+and length of the UTF-8 text, followed by a raw deflate stream that ends
+on a byte boundary without a final block. That lets a stored value be
+spliced into a gzip response between freshly compressed page head and
+tail, so the highlight endpoint never recompresses it.
+"""
+import codecs
+import struct
+import zlib
+
+from django.conf import settings
+from django.db import models
+
+MAGIC = b"SZ\x01"
+HEADER = struct.Struct("<II")
+HEADER_SIZE = len(MAGIC) + HEADER.size
+
+# Gzip member header: deflate, no flags, no mtime, unknown OS.
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+
+def is_enabled():
+    return getattr(settings, "SNIPPETS_COMPRESSED_STORAGE", False)
+
+
+def _compressor():
+    level = getattr(settings, "SNIPPETS_COMPRESSION_LEVEL", 6)
+    return zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+
+def compress(text):
+    data = text.encode("utf-8")
+    compressor = _compressor()
+    body = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return MAGIC + HEADER.pack(zlib.crc32(data), len(data) & 0xFFFFFFFF) + body
+
+
+def decompress(value):
+    return b"".join(iter_decompressed([value])).decode("utf-8")
+
+
+def parse_header(value):
+    """
+    Return `(crc, size)` for a stored compressed value, or None if the
+    value is plain text. Only the first `HEADER_SIZE` bytes are needed.
+    """
+    if not isinstance(value, (bytes, memoryview)):
+        return None
+    value = bytes(value[:HEADER_SIZE])
+    if not value.startswith(MAGIC) or len(value) < HEADER_SIZE:
+        return None
+    return HEADER.unpack(value[len(MAGIC):])
+
+
+def iter_decompressed(chunks):
+    """
+    Decompress a stored value read in arbitrary byte chunks, yielding the
+    UTF-8 encoded text.
+    """
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    skip = HEADER_SIZE
+    for chunk in chunks:
+        chunk = bytes(chunk)
+        if skip:
+            chunk, skip = chunk[skip:], max(skip - len(chunk), 0)
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+
+
+def iter_text(chunks):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    for data in iter_decompressed(chunks):
+        text = decoder.decode(data)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def gzip_stream(head, deflated, crc, size, tail):
+    """
+    Yield a gzip body for `head` + stored value + `tail`, where `deflated`
+    yields the stored deflate stream after its header and `crc`/`size`
+    come from that header.
+    """
+    head = head.encode("utf-8")
+    tail = tail.encode("utf-8")
+    yield GZIP_HEADER
+    compressor = _compressor()
+    yield compressor.compress(head) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    for chunk in deflated:
+        yield bytes(chunk)
+    compressor = _compressor()
+    yield compressor.compress(tail) + compressor.flush()
+
+    crc = zlib.crc32(tail, crc32_combine(zlib.crc32(head), crc, size))
+    yield HEADER.pack(crc, (len(head) + size + len(tail)) & 0xFFFFFFFF)
+
+
+def _gf2_times(matrix, vector):
+    total = 0
+    row = 0
+    while vector:
+        if vector & 1:
+            total ^= matrix[row]
+        vector >>= 1
+        row += 1
+    return total
+
+
+def _gf2_square(matrix):
+    return [_gf2_times(matrix, row) for row in matrix]
+
+
+def crc32_combine(crc1, crc2, len2):
+    """
+    CRC-32 of two concatenated byte strings from their separate CRCs and
+    the length of the second, as zlib's `crc32_combine`.
+    """
+    if len2 <= 0:
+        return crc1
+
+    # Operator for one zero bit, then for two and four zero bits.
+    odd = [0xEDB88320] + [1 << n for n in range(31)]
+    even = _gf2_square(odd)
+    odd = _gf2_square(even)
+
+    # Apply len2 zero bytes to crc1, squaring the operator for each bit.
+    while True:
+        even = _gf2_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+        odd = _gf2_square(even)
+        if len2 & 1:
+            crc1 = _gf2_times(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+    return crc1 ^ crc2
+
+
+class CompressedTextField(models.TextField):
+    """
+    A TextField that, with `SNIPPETS_COMPRESSED_STORAGE` enabled, writes
+    its values compressed. Reads are transparent and rows written before
+    compression was enabled keep working.
+    """
+
+    def from_db_value(self, value, expression, connection):
+        if parse_header(value) is not None:
+            return decompress(value)
+        return value
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        value = super().get_db_prep_value(value, connection, prepared)
+        if isinstance(value, str) and is_enabled():
+            return compress(value)
+        return value
@@ -0,0 +1,93 @@
+"""
+SQLite tuning: the pragmas of the selected profile applied to every new
+connection, and an optional lock that makes writers queue up instead of
+contending for the database, held by the transactions of
+`snippets.backends.sqlite3`.
+"""
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+_write_lock = threading.RLock()
+_local = threading.local()
+
+
+def pragmas():
+    """
+    The pragmas of the `SNIPPETS_SQLITE_PROFILES` entry named by
+    `SNIPPETS_SQLITE_PROFILE`, none without a profile.
+    """
+    profile = getattr(settings, "SNIPPETS_SQLITE_PROFILE", None)
+    if profile is None:
+        return {}
+    profiles = getattr(settings, "SNIPPETS_SQLITE_PROFILES", {})
+    if profile not in profiles:
+        raise ImproperlyConfigured("Unknown SQLite profile %r." % profile)
+    return profiles[profile]
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    `connection_created` handler running the profile's pragmas on new
+    SQLite connections, but the journal mode on read replicas.
+    """
+    if connection.vendor != "sqlite":
+        return
+    values = pragmas()
+    if connection.alias in getattr(settings, "SNIPPETS_READ_REPLICAS", []):
+        # Replicas are read-only copies, their journal mode cannot change.
+        values = {k: v for k, v in values.items() if k != "journal_mode"}
+    with connection.cursor() as cursor:
+        for name, value in values.items():
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+
+
+def serializes_writes():
+    return getattr(settings, "SNIPPETS_SERIALIZE_WRITES", False)
+
+
+def acquire_write_lock():
+    """
+    Take the process-wide write lock and, at the outermost level, an
+    exclusive lock on `SNIPPETS_WRITE_LOCK_FILE` if set, shared with other
+    processes. Reentrant within a thread.
+    """
+    _write_lock.acquire()
+    depth = getattr(_local, "depth", 0)
+    path = getattr(settings, "SNIPPETS_WRITE_LOCK_FILE", None)
+    if not depth and path:
+        import fcntl
+
+        try:
+            _local.lock_file = open(path, "a")
+            fcntl.flock(_local.lock_file, fcntl.LOCK_EX)
+        except Exception:
+            _write_lock.release()
+            raise
+    _local.depth = depth + 1
+
+
+def release_write_lock():
+    _local.depth -= 1
+    if not _local.depth and getattr(_local, "lock_file", None) is not None:
+        _local.lock_file.close()
+        _local.lock_file = None
+    _write_lock.release()
+
+
+@contextmanager
+def write_lock():
+    """
+    Hold the write lock, see `acquire_write_lock`, if
+    `SNIPPETS_SERIALIZE_WRITES` is enabled.
+    """
+    if not serializes_writes():
+        yield
+        return
+    acquire_write_lock()
+    try:
+        yield
+    finally:
+        release_write_lock()
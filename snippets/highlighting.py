@@ -0,0 +1,402 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from threading import Lock, get_ident
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.html import escape
+import pygments
+from . import db
+from .cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Snippet fields that feed into the highlighted HTML. `style` and `title`
+# are applied when the fragment is wrapped into a document, see `document`.
+RENDER_FIELDS = ("code", "language", "linenos")
+CSS_CLASS = "highlight"
+# Bump when the formatter options change, so cached renders are not reused.
+RENDER_VERSION = 1
+
+DOCUMENT = """<!DOCTYPE html>
+<html>
+<head>
+  <title>%(title)s</title>
+  <meta charset="utf-8">
+  <link rel="stylesheet" href="%(stylesheet)s">
+</head>
+<body>
+<h2>%(title)s</h2>
+
+%(fragment)s
+</body>
+</html>
+"""
+
+_pool = None
+_pool_lock = Lock()
+_renderers = None
+_memory_cache = None
+_store_stats = {"hits": 0, "misses": 0}
+_store_lock = Lock()
+
+
+def is_async():
+    return getattr(settings, "SNIPPETS_HIGHLIGHT_ASYNC", False)
+
+
+def is_oversized(code):
+    return len(code) > getattr(settings, "SNIPPETS_HIGHLIGHT_MAX_SIZE", 1024 * 1024)
+
+
+def render_inputs(snippet):
+    return tuple(getattr(snippet, field) for field in RENDER_FIELDS)
+
+
+class RendererPool:
+    """
+    A bounded per-process pool of `(lexer, formatter)` pairs keyed on the
+    render options. Building a formatter computes its whole style table, so
+    pairs are reused across renders. A pair is checked out for the duration
+    of one render, so threads never share an instance.
+    """
+
+    def __init__(self, maxkeys, per_key):
+        self.maxkeys = maxkeys
+        self.per_key = per_key
+        self.created = 0
+        self.reused = 0
+        self._free = OrderedDict()
+        self._lock = Lock()
+
+    @contextmanager
+    def acquire(self, language, linenos):
+        key = (language, linenos)
+        pair = None
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                pair = free.pop()
+                self.reused += 1
+        if pair is None:
+            pair = self._create(language, linenos)
+
+        try:
+            yield pair
+        finally:
+            with self._lock:
+                free = self._free.setdefault(key, [])
+                self._free.move_to_end(key)
+                if len(free) < self.per_key:
+                    free.append(pair)
+                while len(self._free) > self.maxkeys:
+                    self._free.popitem(last=False)
+
+    def _create(self, language, linenos):
+        # Imported here as loading the lexer mapping noticeably slows down
+        # startup of every process that never highlights anything.
+        from pygments.formatters.html import HtmlFormatter
+        from pygments.lexers import get_lexer_by_name
+
+        lexer = get_lexer_by_name(language)
+        formatter = HtmlFormatter(
+            linenos="table" if linenos else False, cssclass=CSS_CLASS
+        )
+        with self._lock:
+            self.created += 1
+        return lexer, formatter
+
+    def stats(self):
+        with self._lock:
+            return {
+                "keys": len(self._free),
+                "idle": sum(len(free) for free in self._free.values()),
+                "created": self.created,
+                "reused": self.reused,
+            }
+
+
+def get_renderers():
+    global _renderers
+    with _pool_lock:
+        if _renderers is None:
+            _renderers = RendererPool(
+                getattr(settings, "SNIPPETS_HIGHLIGHT_POOL_KEYS", 64),
+                getattr(settings, "SNIPPETS_HIGHLIGHT_POOL_PER_KEY", 4),
+            )
+        return _renderers
+
+
+def render(code, language, linenos):
+    """
+    Use the `pygments` library to create a class-based highlighted HTML
+    fragment of the code snippet. The colours live in the per-style
+    stylesheet returned by `stylesheet`.
+    """
+    from pygments import highlight
+
+    with get_renderers().acquire(language, linenos) as (lexer, formatter):
+        return highlight(code, lexer, formatter)
+
+
+@lru_cache(maxsize=None)
+def stylesheet(style):
+    """
+    The CSS for one Pygments style, shared by every snippet using it.
+    Raises `pygments.util.ClassNotFound` for unknown styles.
+    """
+    from pygments.formatters.html import HtmlFormatter
+
+    return HtmlFormatter(style=style).get_style_defs("." + CSS_CLASS)
+
+
+def document(title, stylesheet_url, fragment):
+    """
+    Wrap a stored fragment into the standalone page served by the
+    highlight endpoint.
+    """
+    head, tail = document_parts(title, stylesheet_url)
+    return head + fragment + tail
+
+
+def document_parts(title, stylesheet_url):
+    """
+    The page around the fragment as a `(head, tail)` pair, for responses
+    that stream the fragment in between.
+    """
+    values = {"title": escape(title), "stylesheet": escape(stylesheet_url)}
+    head, tail = DOCUMENT.split("%(fragment)s")
+    return head % values, tail % values
+
+
+def digest(inputs):
+    """
+    Content address of a render. The Pygments version is part of the key so
+    an upgrade never serves HTML produced by an older release.
+    """
+    payload = json.dumps([pygments.__version__, RENDER_VERSION, *inputs])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def get_memory_cache():
+    global _memory_cache
+    with _store_lock:
+        if _memory_cache is None:
+            _memory_cache = LRUCache(
+                getattr(settings, "SNIPPETS_HIGHLIGHT_CACHE_SIZE", 256)
+            )
+        return _memory_cache
+
+
+def _use_store():
+    return getattr(settings, "SNIPPETS_HIGHLIGHT_CACHE_PERSISTENT", True)
+
+
+def lookup(inputs):
+    """
+    Return the cached HTML for these render inputs, checking the in-process
+    LRU first and the `HighlightCache` table second, or None on a miss.
+    """
+    key = digest(inputs)
+    return lookup_many([key]).get(key)
+
+
+def lookup_many(keys):
+    """
+    Return `{digest: html}` for the cached renders among `keys`, with one
+    query for the persistent tier.
+    """
+    from .models import HighlightCache
+
+    memory = get_memory_cache()
+    found = {}
+    for key in keys:
+        html = memory.get(key)
+        if html is not None:
+            found[key] = html
+
+    missing = set(keys) - set(found)
+    if not missing or not _use_store():
+        return found
+
+    stored = dict(
+        HighlightCache.objects.filter(digest__in=missing).values_list("digest", "html")
+    )
+    with _store_lock:
+        _store_stats["hits"] += len(stored)
+        _store_stats["misses"] += len(missing) - len(stored)
+    for key, html in stored.items():
+        memory.set(key, html)
+    found.update(stored)
+    return found
+
+
+def remember(inputs, html):
+    remember_many({digest(inputs): html})
+
+
+def remember_many(renders):
+    from .models import HighlightCache
+
+    memory = get_memory_cache()
+    for key, html in renders.items():
+        memory.set(key, html)
+    if _use_store() and renders:
+        HighlightCache.objects.bulk_create(
+            [HighlightCache(digest=key, html=html) for key, html in renders.items()],
+            ignore_conflicts=True,
+        )
+
+
+def cached_render(*inputs):
+    html = lookup(inputs)
+    if html is None:
+        html = render(*inputs)
+        remember(inputs, html)
+    return html
+
+
+def render_many(batch, cached=True, pool=None, parallel=True):
+    """
+    Render a list of render inputs, reusing cached renders unless `cached`
+    is false, and spreading the rest over `pool`, by default the worker
+    pool, once there are at least `SNIPPETS_HIGHLIGHT_POOL_MIN_BATCH` of
+    them. Returns the HTML in input order.
+    """
+    keys = [digest(inputs) for inputs in batch]
+    found = lookup_many(keys) if cached else {}
+    todo = {key: inputs for key, inputs in zip(keys, batch) if key not in found}
+
+    min_batch = getattr(settings, "SNIPPETS_HIGHLIGHT_POOL_MIN_BATCH", 4)
+    if parallel and len(todo) >= min_batch:
+        pool = pool or get_pool()
+        chunksize = max(1, len(todo) // (worker_count() * 4))
+        rendered = pool.map(render, *zip(*todo.values()), chunksize=chunksize)
+    else:
+        rendered = (render(*inputs) for inputs in todo.values())
+
+    fresh = dict(zip(todo, rendered))
+    remember_many(fresh)
+    found.update(fresh)
+    return [found[key] for key in keys]
+
+
+def cache_stats():
+    from .models import HighlightCache
+
+    with _store_lock:
+        store = dict(_store_stats)
+    store["size"] = HighlightCache.objects.count() if _use_store() else 0
+    return {
+        "memory": get_memory_cache().stats(),
+        "persistent": store,
+        "renderers": get_renderers().stats(),
+    }
+
+
+def worker_count():
+    return getattr(settings, "SNIPPETS_HIGHLIGHT_WORKERS", None) or os.cpu_count()
+
+
+def make_pool(workers):
+    # Spawned rather than forked, as forking a threaded server can deadlock.
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = make_pool(worker_count())
+        return _pool
+
+
+def schedule(snippet):
+    """
+    Render the highlight for an already saved snippet on the worker pool
+    once the surrounding transaction has committed.
+    """
+    pk, version = snippet.pk, snippet.version
+    inputs = render_inputs(snippet)
+
+    def submit():
+        future = get_pool().submit(render, *inputs)
+        future.add_done_callback(partial(_store, pk, version, inputs, get_ident()))
+
+    transaction.on_commit(submit)
+
+
+def _store(pk, version, inputs, submitter, future):
+    from .models import Snippet
+
+    try:
+        html = future.result()
+        status = Snippet.HighlightStatus.READY
+        remember(inputs, html)
+    except Exception:
+        logger.exception("Highlighting snippet %s failed", pk)
+        html = ""
+        status = Snippet.HighlightStatus.FAILED
+
+    try:
+        _write(pk, version, html, status)
+    finally:
+        # Done callbacks usually run on the pool's management thread, which
+        # would otherwise keep its own connection open forever.
+        if get_ident() != submitter:
+            connection.close()
+
+
+def _write(pk, version, html, status):
+    from .models import Snippet
+
+    # Only store the result if the snippet was not saved in the meantime.
+    # A newer render is then on its way, or the row is left pending until
+    # it is rendered on request. Comparing the stored code instead would
+    # miss rows compressed differently than the lookup value.
+    with db.write_lock():
+        Snippet.objects.filter(pk=pk, version=version).update(
+            highlighted=html,
+            highlight_status=status,
+            version=F("version") + 1,
+            updated=timezone.now(),
+        )
+
+
+def is_stalled(snippet):
+    """
+    Whether the background render of a pending snippet is overdue, as when
+    the process that scheduled it exited before storing it.
+    """
+    timeout = getattr(settings, "SNIPPETS_HIGHLIGHT_PENDING_TIMEOUT", 60)
+    return (timezone.now() - snippet.updated).total_seconds() > timeout
+
+
+def render_stalled(snippet):
+    """
+    Render a snippet whose background render is overdue in this process and
+    store it as `_store` would. Returns `(html, status)`.
+    """
+    from .models import Snippet
+
+    inputs = render_inputs(snippet)
+    try:
+        html = cached_render(*inputs)
+        status = Snippet.HighlightStatus.READY
+    except Exception:
+        logger.exception("Highlighting snippet %s failed", snippet.pk)
+        html = ""
+        status = Snippet.HighlightStatus.FAILED
+    _write(snippet.pk, snippet.version, html, status)
+    return html, status
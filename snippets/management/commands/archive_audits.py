@@ -0,0 +1,83 @@
+import datetime
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from snippets import archive
+from snippets.models import Audit
+
+
+class Command(BaseCommand):
+    help = (
+        "Move audits older than the retention period into per-day gzip "
+        "NDJSON archives, deleting the archived rows in small chunks."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=getattr(settings, "SNIPPETS_AUDIT_RETENTION_DAYS", 90),
+            help="Keep this many days of audits in the database.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Rows deleted per transaction.",
+        )
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0,
+            help="Seconds to wait between delete transactions.",
+        )
+        parser.add_argument(
+            "--vacuum",
+            action="store_true",
+            help="Run VACUUM afterwards to return the freed space to the OS.",
+        )
+
+    def handle(self, *args, **options):
+        # Whole UTC days only, so every partition is complete once written.
+        today = timezone.now().astimezone(datetime.timezone.utc).date()
+        cutoff = today - datetime.timedelta(days=options["days"])
+        old = Audit.objects.filter(
+            timestamp__lt=datetime.datetime.combine(
+                cutoff, datetime.time(), datetime.timezone.utc
+            )
+        )
+
+        total = 0
+        for day in old.dates("timestamp", "day"):
+            start = datetime.datetime.combine(
+                day, datetime.time(), datetime.timezone.utc
+            )
+            rows = (
+                old.filter(
+                    timestamp__gte=start,
+                    timestamp__lt=start + datetime.timedelta(days=1),
+                )
+                .order_by("timestamp", "id")
+                .values(*archive.FIELDS)
+                .iterator(chunk_size=options["chunk_size"])
+            )
+            ids = archive.write_partition(day, rows)
+            self.delete(ids, options["chunk_size"], options["pause"])
+            total += len(ids)
+            self.stdout.write("%s: archived %d audits" % (day, len(ids)))
+
+        if options["vacuum"]:
+            with connection.cursor() as cursor:
+                cursor.execute("VACUUM")
+        self.stdout.write(self.style.SUCCESS("Archived %d audits." % total))
+
+    def delete(self, ids, chunk_size, pause):
+        for start in range(0, len(ids), chunk_size):
+            with transaction.atomic():
+                Audit.objects.filter(pk__in=ids[start : start + chunk_size]).delete()
+            if pause:
+                time.sleep(pause)
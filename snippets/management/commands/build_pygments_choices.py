@@ -0,0 +1,36 @@
+from pathlib import Path
+from pprint import pformat
+
+import pygments
+from django.core.management.base import BaseCommand
+
+from snippets import choices
+
+TEMPLATE = """# Generated by `manage.py build_pygments_choices`, do not edit.
+
+PYGMENTS_VERSION = %r
+
+LANGUAGE_CHOICES = %s
+
+STYLE_CHOICES = %s
+"""
+
+
+class Command(BaseCommand):
+    help = "Regenerate the static language and style choices table from Pygments."
+
+    def handle(self, *args, **options):
+        language_choices, style_choices = choices.build()
+        path = Path(choices.__file__).with_name("pygments_choices.py")
+        path.write_text(
+            TEMPLATE
+            % (
+                pygments.__version__,
+                pformat(language_choices),
+                pformat(style_choices),
+            )
+        )
+        self.stdout.write(
+            "Wrote %d languages and %d styles for Pygments %s to %s"
+            % (len(language_choices), len(style_choices), pygments.__version__, path)
+        )
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Min
+from django.db.models.functions import TruncHour
+
+from snippets.models import Audit, AuditRollup
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the hourly audit rollups from the audit table. Hours "
+        "before the oldest audit keep their counts, since their audits may "
+        "have been archived, unless --all is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Also drop the rollups of hours without audits in the table.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Rollup rows inserted per query.",
+        )
+
+    def handle(self, *args, **options):
+        oldest = Audit.objects.aggregate(oldest=Min("timestamp"))["oldest"]
+        rollups = AuditRollup.objects.all()
+        if not options["all"]:
+            if oldest is None:
+                rollups = rollups.none()
+            else:
+                rollups = rollups.filter(
+                    hour__gte=oldest.replace(minute=0, second=0, microsecond=0)
+                )
+
+        counts = (
+            Audit.objects.annotate(hour=TruncHour("timestamp"))
+            .values("hour", "model_name", "action", "user_id")
+            .annotate(count=Count("id"))
+            .order_by()
+        )
+        with transaction.atomic():
+            rollups.delete()
+            created = AuditRollup.objects.bulk_create(
+                (AuditRollup(**row) for row in counts.iterator()),
+                batch_size=options["batch_size"],
+            )
+        self.stdout.write(
+            self.style.SUCCESS("Rebuilt %d audit rollup rows." % len(created))
+        )
@@ -0,0 +1,185 @@
+import json
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+
+from snippets import highlighting
+from snippets.models import Snippet
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-render the highlighted HTML of all snippets, or of a filtered "
+        "subset, across a process pool. Progress is checkpointed so an "
+        "interrupted run can be resumed with --resume."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--language",
+            action="append",
+            help="Only snippets in this language, can be repeated.",
+        )
+        parser.add_argument("--owner", help="Only snippets owned by this username.")
+        parser.add_argument(
+            "--status",
+            choices=Snippet.HighlightStatus.values,
+            help="Only snippets with this highlight status.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="Worker processes, 0 renders in this process. Defaults to the number of CPUs.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Rows fetched per database round trip.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=200,
+            help="Snippets rendered and written per batch.",
+        )
+        parser.add_argument(
+            "--no-cache",
+            action="store_true",
+            help="Render every snippet even if a cached render exists.",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            default="rehighlight.checkpoint.json",
+            help="Progress file, removed when the run completes.",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Continue after the last snippet recorded in the checkpoint.",
+        )
+
+    def handle(self, *args, **options):
+        filters = {
+            "language": options["language"],
+            "owner": options["owner"],
+            "status": options["status"],
+        }
+        checkpoint = Path(options["checkpoint"])
+        last_pk, done = 0, 0
+        if options["resume"]:
+            if not checkpoint.exists():
+                raise CommandError("No checkpoint found at %s." % checkpoint)
+            state = json.loads(checkpoint.read_text())
+            if state["filters"] != filters:
+                raise CommandError(
+                    "The checkpoint was written with different filters: %s"
+                    % state["filters"]
+                )
+            last_pk, done = state["last_pk"], state["done"]
+
+        queryset = Snippet.objects.filter(pk__gt=last_pk).order_by("pk")
+        if options["language"]:
+            queryset = queryset.filter(language__in=options["language"])
+        if options["owner"]:
+            queryset = queryset.filter(owner__username=options["owner"])
+        if options["status"]:
+            queryset = queryset.filter(highlight_status=options["status"])
+        total = done + queryset.count()
+
+        workers = options["workers"]
+        if workers is None:
+            workers = highlighting.worker_count()
+        pool = highlighting.make_pool(workers) if workers else None
+        render_options = {
+            "cached": not options["no_cache"],
+            "pool": pool,
+            "parallel": pool is not None,
+        }
+
+        # Only the render inputs and the fields written back are loaded.
+        rows = queryset.only("id", "version", *highlighting.RENDER_FIELDS).iterator(
+            chunk_size=options["chunk_size"]
+        )
+        started = time.monotonic()
+        rendered = skipped = 0
+        try:
+            batch = []
+            for snippet in rows:
+                batch.append(snippet)
+                if len(batch) == options["batch_size"]:
+                    last_pk = batch[-1].pk
+                    skipped += self.write(batch, render_options)
+                    rendered += len(batch)
+                    self.save_checkpoint(checkpoint, filters, last_pk, done + rendered)
+                    self.report(done + rendered, total, rendered, started)
+                    batch = []
+            if batch:
+                skipped += self.write(batch, render_options)
+                rendered += len(batch)
+                self.report(done + rendered, total, rendered, started)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        checkpoint.unlink(missing_ok=True)
+        if skipped:
+            self.stdout.write(
+                "Skipped %d snippets edited during the run, their saves "
+                "re-highlighted them." % skipped
+            )
+        self.stdout.write(
+            self.style.SUCCESS("Re-highlighted %d snippets." % (done + rendered))
+        )
+
+    def write(self, batch, render_options):
+        """
+        Store the renders of a batch, returning how many snippets were
+        skipped because they were edited since they were loaded.
+        """
+        Snippet.highlight_many(batch, **render_options)
+
+        def per_snippet(field):
+            # The value of `field` on each snippet of the batch, by pk.
+            output_field = Snippet._meta.get_field(field)
+            whens = [
+                When(
+                    pk=snippet.pk,
+                    then=Value(getattr(snippet, field), output_field=output_field),
+                )
+                for snippet in batch
+            ]
+            return Case(*whens, output_field=output_field)
+
+        # One statement for the batch, guarded like `highlighting._write`
+        # so an edit made meanwhile is never paired with HTML rendered from
+        # the old code. update() sends no signals, so no audit rows are
+        # written.
+        with transaction.atomic():
+            written = Snippet.objects.filter(
+                pk__in=[snippet.pk for snippet in batch],
+                version=per_snippet("version"),
+            ).update(
+                highlighted=per_snippet("highlighted"),
+                highlight_status=per_snippet("highlight_status"),
+                version=F("version") + 1,
+                updated=timezone.now(),
+            )
+        return len(batch) - written
+
+    def save_checkpoint(self, path, filters, last_pk, done):
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(
+            json.dumps({"filters": filters, "last_pk": last_pk, "done": done})
+        )
+        tmp.replace(path)
+
+    def report(self, done, total, rendered, started):
+        elapsed = time.monotonic() - started
+        rate = rendered / elapsed if elapsed else 0
+        self.stdout.write("%d/%d snippets, %.1f snippets/s" % (done, total, rate))
@@ -0,0 +1,76 @@
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from snippets import routers
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy the default SQLite database to the read replicas with SQLite's "
+        "online backup API. Each copy is written next to the replica and "
+        "swapped in, so readers never see a partial copy, dated to when the "
+        "backup started."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--database",
+            action="append",
+            help="Only sync this replica, can be repeated. Defaults to "
+            "SNIPPETS_READ_REPLICAS.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=None,
+            help="Keep syncing every this many seconds instead of once.",
+        )
+
+    def handle(self, *args, **options):
+        aliases = options["database"] or routers.replicas()
+        if not aliases:
+            raise CommandError("No read replicas are configured.")
+        paths = {}
+        for alias in aliases:
+            if alias not in connections:
+                raise CommandError("Unknown database %r." % alias)
+            path = routers.replica_path(alias)
+            if path is None:
+                raise CommandError("The replica %r is not file backed." % alias)
+            paths[alias] = Path(path)
+
+        while True:
+            started = time.monotonic()
+            for alias, path in paths.items():
+                self.sync(path)
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        "Synced %s in %.2fs." % (alias, time.monotonic() - started)
+                    )
+                )
+            if options["interval"] is None:
+                return
+            time.sleep(max(options["interval"] - (time.monotonic() - started), 0))
+
+    def sync(self, path):
+        source = connections[DEFAULT_DB_ALIAS]
+        source.ensure_connection()
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.unlink(missing_ok=True)
+        target = sqlite3.connect(tmp)
+        started = time.time()
+        try:
+            source.connection.backup(target)
+            # Replicas are opened read-only, so they must not need a WAL.
+            target.execute("PRAGMA journal_mode = delete")
+        finally:
+            target.close()
+        # The copy holds the data as of the start of the backup, which
+        # readers compare with SNIPPETS_REPLICA_MAX_LAG.
+        os.utime(tmp, (started, started))
+        tmp.replace(path)
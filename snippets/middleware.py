@@ -0,0 +1,35 @@
+from django.core.exceptions import MiddlewareNotUsed
+
+from . import audit, routers
+
+
+class AuditMiddleware:
+    """
+    Write the audits of a request with one query once it is handled.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with audit.buffered():
+            return self.get_response(request)
+
+
+class ReplicaStickyMiddleware:
+    """
+    After a successful request that may have written, send the client's
+    reads to the default database for the `routers` sticky window.
+    """
+
+    def __init__(self, get_response):
+        if not routers.replicas():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400:
+            # Token authenticated users are set on the request by the view.
+            routers.note_write(request, response)
+        return response
@@ -0,0 +1,26 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("snippets", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="snippet",
+            name="highlight_status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("ready", "Ready"),
+                    ("failed", "Failed"),
+                ],
+                default="ready",
+                max_length=10,
+            ),
+        ),
+    ]
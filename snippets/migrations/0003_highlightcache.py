@@ -0,0 +1,24 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("snippets", "0002_snippet_highlight_status"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="HighlightCache",
+            fields=[
+                (
+                    "digest",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("html", models.TextField()),
+                ("created", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
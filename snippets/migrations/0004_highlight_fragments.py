@@ -0,0 +1,32 @@
+from django.db import migrations
+from pygments import highlight
+from pygments.formatters.html import HtmlFormatter
+from pygments.lexers import get_lexer_by_name
+
+
+def render_fragments(apps, schema_editor):
+    """
+    Re-render stored full HTML documents as class-based fragments, and drop
+    cached renders made in the old format.
+    """
+    Snippet = apps.get_model("snippets", "Snippet")
+    HighlightCache = apps.get_model("snippets", "HighlightCache")
+
+    HighlightCache.objects.all().delete()
+    for snippet in Snippet.objects.filter(highlight_status="ready").iterator():
+        formatter = HtmlFormatter(linenos="table" if snippet.linenos else False)
+        snippet.highlighted = highlight(
+            snippet.code, get_lexer_by_name(snippet.language), formatter
+        )
+        snippet.save(update_fields=["highlighted"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("snippets", "0003_highlightcache"),
+    ]
+
+    operations = [
+        migrations.RunPython(render_fragments, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:41
+
+import snippets.choices
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("snippets", "0004_highlight_fragments"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="snippet",
+            name="language",
+            field=models.CharField(
+                choices=snippets.choices.language_choices,
+                default="python",
+                max_length=100,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="snippet",
+            name="style",
+            field=models.CharField(
+                choices=snippets.choices.style_choices,
+                default="friendly",
+                max_length=100,
+            ),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("snippets", "0005_lazy_choices"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="snippet",
+            name="highlight_status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("ready", "Ready"),
+                    ("failed", "Failed"),
+                    ("streamed", "Streamed"),
+                ],
+                default="ready",
+                max_length=10,
+            ),
+        ),
+    ]
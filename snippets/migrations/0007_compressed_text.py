@@ -0,0 +1,29 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:49
+
+import snippets.compression
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("snippets", "0006_snippet_highlight_streamed"),
+    ]
+
+    # The column type does not change, so skip SQLite's table rebuild.
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name="snippet",
+                    name="code",
+                    field=snippets.compression.CompressedTextField(),
+                ),
+                migrations.AlterField(
+                    model_name="snippet",
+                    name="highlighted",
+                    field=snippets.compression.CompressedTextField(),
+                ),
+            ]
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("snippets", "0007_compressed_text"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="snippet",
+            name="updated",
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name="snippet",
+            name="version",
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:59
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_snippets(apps, schema_editor):
+    ExtendedUser = apps.get_model("snippets", "ExtendedUser")
+    Snippet = apps.get_model("snippets", "Snippet")
+
+    counts = (
+        Snippet.objects.filter(owner=OuterRef("pk"))
+        .order_by()
+        .values("owner")
+        .annotate(count=Count("pk"))
+        .values("count")
+    )
+    ExtendedUser.objects.update(snippet_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("snippets", "0008_snippet_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="extendeduser",
+            name="snippet_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_snippets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.0.6 on 2026-10-18 12:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("snippets", "0009_extendeduser_snippet_count"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="audit",
+            index=models.Index(fields=["timestamp", "id"], name="audit_timestamp_id"),
+        ),
+    ]
@@ -0,0 +1,71 @@
+from django.db import migrations, models
+
+import snippets.models
+
+
+def encode_actions(apps, schema_editor):
+    """
+    Copy the action names into the coded column, which takes names.
+    """
+    Audit = apps.get_model("snippets", "Audit")
+    for name in snippets.models.AuditActionField.CODES:
+        Audit.objects.filter(action=name).update(action_code=name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("snippets", "0010_audit_timestamp_id"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="audit",
+            name="action_code",
+            field=snippets.models.AuditActionField(null=True),
+        ),
+        migrations.RunPython(encode_actions, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name="audit",
+            name="action",
+        ),
+        migrations.RenameField(
+            model_name="audit",
+            old_name="action_code",
+            new_name="action",
+        ),
+        migrations.AlterField(
+            model_name="audit",
+            name="action",
+            field=snippets.models.AuditActionField(),
+        ),
+        migrations.AlterField(
+            model_name="audit",
+            name="model_name",
+            field=models.CharField(max_length=100),
+        ),
+        migrations.AlterField(
+            model_name="audit",
+            name="object_id",
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="audit",
+            index=models.Index(
+                fields=["model_name", "object_id", "timestamp"],
+                name="audit_object_history",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="audit",
+            index=models.Index(
+                fields=["action", "timestamp"], name="audit_action_timestamp"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="audit",
+            index=models.Index(
+                fields=["user", "timestamp"], name="audit_user_timestamp"
+            ),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.0.6 on 2026-10-18 12:09
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("snippets", "0011_audit_codes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="audit",
+            name="changes",
+            field=models.JSONField(
+                encoder=django.core.serializers.json.DjangoJSONEncoder, null=True
+            ),
+        ),
+    ]
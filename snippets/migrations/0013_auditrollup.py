@@ -0,0 +1,52 @@
+# Generated by Django 5.0.6 on 2026-10-18 12:15
+
+import django.db.models.deletion
+import snippets.models
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("snippets", "0012_audit_changes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AuditRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("hour", models.DateTimeField()),
+                ("model_name", models.CharField(max_length=100)),
+                ("action", snippets.models.AuditActionField()),
+                ("count", models.PositiveIntegerField(default=0)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        db_constraint=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["hour", "model_name", "action"],
+                        name="rollup_hour_model_action",
+                    )
+                ],
+            },
+        ),
+    ]
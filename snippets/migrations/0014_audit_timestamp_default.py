@@ -0,0 +1,19 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:14
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("snippets", "0013_auditrollup"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="audit",
+            name="timestamp",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:55
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicates(apps, schema_editor):
+    AuditRollup = apps.get_model("snippets", "AuditRollup")
+
+    duplicates = (
+        AuditRollup.objects.values("hour", "model_name", "action", "user")
+        .order_by()
+        .annotate(total=Sum("count"), rows=Count("pk"), keep=Min("pk"))
+        .filter(rows__gt=1)
+    )
+    for row in duplicates:
+        key = {field: row[field] for field in ("hour", "model_name", "action", "user")}
+        AuditRollup.objects.filter(**key).exclude(pk=row["keep"]).delete()
+        AuditRollup.objects.filter(pk=row["keep"]).update(count=row["total"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("snippets", "0014_audit_timestamp_default"),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="auditrollup",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("user__isnull", False)),
+                fields=("hour", "model_name", "action", "user"),
+                name="rollup_unique_key",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="auditrollup",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("user__isnull", True)),
+                fields=("hour", "model_name", "action"),
+                name="rollup_unique_key_no_user",
+            ),
+        ),
+    ]
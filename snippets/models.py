@@ -1,58 +1,313 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.db.models import F
 from django.db.models.signals import post_delete, post_save
-from pygments import highlight  
-from pygments.formatters.html import HtmlFormatter 
-from pygments.lexers import get_all_lexers, get_lexer_by_name  
-from pygments.styles import get_all_styles
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from . import audit, choices, highlighting
+from .compression import CompressedTextField
 
-LEXERS = [item for item in get_all_lexers() if item[1]]
-LANGUAGE_CHOICES = sorted([(item[1][0], item[0]) for item in LEXERS])
-STYLE_CHOICES = sorted((item, item) for item in get_all_styles())
 
+def __getattr__(name):
+    # The choices are resolved lazily, see `snippets.choices`.
+    if name == "LANGUAGE_CHOICES":
+        return choices.language_choices()
+    if name == "STYLE_CHOICES":
+        return choices.style_choices()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+@audit.register(
+    fields=("title", "code", "linenos", "language", "style", "owner"),
+    values=("title", "linenos", "language", "style", "owner"),
+)
 class Snippet(models.Model):
+    class HighlightStatus(models.TextChoices):
+        PENDING = "pending"
+        READY = "ready"
+        FAILED = "failed"
+        STREAMED = "streamed"
+
     created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True, db_index=True)
+    version = models.PositiveIntegerField(default=1)
     title = models.CharField(max_length=100, blank=True, default="")
-    code = models.TextField()
+    code = CompressedTextField()
     linenos = models.BooleanField(default=False)
     language = models.CharField(
-        choices=LANGUAGE_CHOICES, default="python", max_length=100
+        choices=choices.language_choices, default="python", max_length=100
+    )
+    style = models.CharField(
+        choices=choices.style_choices, default="friendly", max_length=100
     )
-    style = models.CharField(choices=STYLE_CHOICES, default="friendly", max_length=100)
     owner = models.ForeignKey(
         "snippets.ExtendedUser", related_name="snippets", on_delete=models.CASCADE
     )  
-    highlighted = models.TextField()  
+    highlighted = CompressedTextField()
+    highlight_status = models.CharField(
+        choices=HighlightStatus.choices, default=HighlightStatus.READY, max_length=10
+    )
 
     class Meta:
         ordering = ("created",)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Snippet, cls).from_db(db, field_names, values)
+        instance._loaded_inputs = instance._current_inputs()
+        instance._loaded_owner_id = instance.__dict__.get("owner_id")
+        return instance
+
+    def _current_inputs(self):
+        # Only look at loaded fields, reading a deferred one costs a query.
+        deferred = self.get_deferred_fields()
+        return {
+            field: getattr(self, field)
+            for field in highlighting.RENDER_FIELDS
+            if field not in deferred
+        }
+
+    def render_inputs_changed(self):
+        """
+        Whether any field feeding the highlighted HTML changed since the row
+        was loaded. Always true for snippets not loaded from the database.
+        """
+        loaded = getattr(self, "_loaded_inputs", None)
+        return loaded is None or self._current_inputs() != loaded
+
     def save(self, *args, **kwargs):  
         """
-        Use the `pygments` library to create a highlighted HTML
-        representation of the code snippet.
+        Highlight the code snippet, either inline or, when
+        `SNIPPETS_HIGHLIGHT_ASYNC` is enabled, on the background worker pool.
+        Saves that leave the render inputs alone neither re-highlight nor
+        rewrite the highlighted column. Every save bumps `version`, which
+        backs the snippet ETags.
         """
-        lexer = get_lexer_by_name(self.language)
-        linenos = "table" if self.linenos else False
-        options = {"title": self.title} if self.title else {}
-        formatter = HtmlFormatter(
-            style=self.style, linenos=linenos, full=True, **options
-        )
-        self.highlighted = highlight(self.code, lexer, formatter)
+        update_fields = kwargs.get("update_fields")
+        if not self._state.adding:
+            self.version += 1
+        if update_fields:
+            update_fields = {*update_fields, "version", "updated"}
+            kwargs["update_fields"] = update_fields
+        if update_fields is not None:
+            rendering = bool(set(update_fields) & set(highlighting.RENDER_FIELDS))
+        else:
+            rendering = True
+        rendering = rendering and self.render_inputs_changed()
+
+        if not rendering:
+            if update_fields is None:
+                deferred = self.get_deferred_fields()
+                kwargs["update_fields"] = [
+                    field.name
+                    for field in self._meta.concrete_fields
+                    if not field.primary_key
+                    and field.name not in deferred
+                    and field.name not in ("highlighted", "highlight_status")
+                ]
+            super(Snippet, self).save(*args, **kwargs)
+            return
+
+        inputs = highlighting.render_inputs(self)
+        if highlighting.is_oversized(self.code):
+            # Too large to store pre-rendered, highlighted while streaming.
+            html = ""
+            status = Snippet.HighlightStatus.STREAMED
+        elif highlighting.is_async():
+            html = highlighting.lookup(inputs)
+            status = Snippet.HighlightStatus.READY
+        else:
+            html = highlighting.cached_render(*inputs)
+            status = Snippet.HighlightStatus.READY
+
+        pending = html is None
+        self.highlighted = "" if pending else html
+        self.highlight_status = Snippet.HighlightStatus.PENDING if pending else status
+        if update_fields is not None:
+            kwargs["update_fields"] = {*update_fields, "highlighted", "highlight_status"}
         super(Snippet, self).save(*args, **kwargs)
+        self._loaded_inputs = self._current_inputs()
+        if pending:
+            highlighting.schedule(self)
+
+    @staticmethod
+    def highlight_many(snippets, **options):
+        """
+        Highlight a batch of snippets in one go, spreading the renders over
+        the worker pool, for use with `bulk_create` and `bulk_update`.
+        Options are passed on to `highlighting.render_many`.
+        """
+        fitting = []
+        for snippet in snippets:
+            if highlighting.is_oversized(snippet.code):
+                snippet.highlighted = ""
+                snippet.highlight_status = Snippet.HighlightStatus.STREAMED
+            else:
+                fitting.append(snippet)
+
+        rendered = highlighting.render_many(
+            [highlighting.render_inputs(snippet) for snippet in fitting], **options
+        )
+        for snippet, html in zip(fitting, rendered):
+            snippet.highlighted = html
+            snippet.highlight_status = Snippet.HighlightStatus.READY
 
     def __str__(self):
         return self.title
 
+class HighlightCache(models.Model):
+    """
+    Persistent tier of the highlight cache, keyed on a hash of the render
+    inputs so identical snippets share one rendering.
+    """
+    digest = models.CharField(max_length=64, primary_key=True)
+    html = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+
+@audit.register(
+    fields=(
+        "username", "password", "first_name", "last_name", "email", "is_staff",
+        "is_active", "is_superuser", "is_deleted", "last_login",
+    ),
+    values=(
+        "username", "first_name", "last_name", "email", "is_staff",
+        "is_active", "is_superuser", "is_deleted", "last_login",
+    ),
+)
 class ExtendedUser(AbstractUser):
     is_deleted = models.BooleanField(default=False)
+    # Denormalized count of owned snippets, see `count_snippets`.
+    snippet_count = models.PositiveIntegerField(default=0)
 
     def soft_delete(self):
         self.is_deleted = True
-    
+
+    def save(self, *args, **kwargs):
+        """
+        Only write `snippet_count` when the user is created or it is named
+        in `update_fields`, a stale value would undo concurrent updates.
+        """
+        existing = not self._state.adding and self.pk is not None
+        if existing and kwargs.get("update_fields") is None:
+            deferred = self.get_deferred_fields()
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in deferred
+                and field.name != "snippet_count"
+            ]
+        super(ExtendedUser, self).save(*args, **kwargs)
+
+    @staticmethod
+    def count_snippets(user_id, delta):
+        """
+        Add `delta` to a user's `snippet_count` in the database, without
+        loading the user. Saves and deletes of single snippets are counted
+        by signal handlers, as are owner changes saved on a loaded snippet.
+        Bulk inserts and queryset updates must call this themselves.
+        """
+        ExtendedUser.objects.filter(pk=user_id).update(
+            snippet_count=F("snippet_count") + delta
+        )
+
+class AuditActionField(models.PositiveSmallIntegerField):
+    """
+    Stores an audit action as a small integer code while reading and
+    writing it by name, so `action="create"` works in saves and lookups.
+    """
+    CODES = {"create": 1, "update": 2, "destroy": 3}
+    NAMES = {code: name for name, code in CODES.items()}
+
+    def from_db_value(self, value, expression, connection):
+        return self.NAMES.get(value, value)
+
+    def to_python(self, value):
+        return self.NAMES.get(value, value)
+
+    def get_prep_value(self, value):
+        if isinstance(value, str):
+            if value not in self.CODES:
+                raise ValueError("Unknown audit action %r." % value)
+            return self.CODES[value]
+        return super().get_prep_value(value)
+
 class Audit(models.Model):
-    model_name = models.TextField()
-    object_id = models.TextField(null=True)
-    action = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
-    user = models.ForeignKey(ExtendedUser, on_delete=models.SET(None), default=None, null=True)
\ No newline at end of file
+    model_name = models.CharField(max_length=100)
+    object_id = models.CharField(max_length=64, null=True)
+    action = AuditActionField()
+    # Set when the audited event happens, buffered audits are saved later.
+    timestamp = models.DateTimeField(default=timezone.now)
+    user = models.ForeignKey(ExtendedUser, on_delete=models.SET(None), default=None, null=True)
+    # Changed fields of audited updates, see `audit.AuditOptions.changes`.
+    changes = models.JSONField(null=True, encoder=DjangoJSONEncoder)
+
+    class Meta:
+        # Back the cursor pagination, the audit filters and object histories.
+        indexes = [
+            models.Index(fields=["timestamp", "id"], name="audit_timestamp_id"),
+            models.Index(
+                fields=["model_name", "object_id", "timestamp"],
+                name="audit_object_history",
+            ),
+            models.Index(fields=["action", "timestamp"], name="audit_action_timestamp"),
+            models.Index(fields=["user", "timestamp"], name="audit_user_timestamp"),
+        ]
+
+class AuditRollup(models.Model):
+    """
+    Audit counts per hour, model, action and user, kept up to date by
+    `audit.write` and rebuilt by `manage.py rebuild_audit_rollups`.
+    Archiving audits leaves their counts in place.
+    """
+    hour = models.DateTimeField()
+    model_name = models.CharField(max_length=100)
+    action = AuditActionField()
+    # Users are soft deleted, a hard delete keeps the id in the counts.
+    user = models.ForeignKey(
+        ExtendedUser,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        related_name="+",
+    )
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["hour", "model_name", "action"], name="rollup_hour_model_action"),
+        ]
+        # One row per key. NULLs are distinct in unique constraints, so
+        # rows without a user get their own.
+        constraints = [
+            models.UniqueConstraint(
+                fields=["hour", "model_name", "action", "user"],
+                condition=models.Q(user__isnull=False),
+                name="rollup_unique_key",
+            ),
+            models.UniqueConstraint(
+                fields=["hour", "model_name", "action"],
+                condition=models.Q(user__isnull=True),
+                name="rollup_unique_key_no_user",
+            ),
+        ]
+
+def count_saved_snippet(sender, instance, created, raw=False, **kwargs):
+    # Fixtures carry their own counts.
+    if raw:
+        return
+    if created:
+        ExtendedUser.count_snippets(instance.owner_id, 1)
+    else:
+        # Only known for snippets loaded with their owner.
+        previous = getattr(instance, "_loaded_owner_id", None)
+        if previous is not None and previous != instance.owner_id:
+            ExtendedUser.count_snippets(previous, -1)
+            ExtendedUser.count_snippets(instance.owner_id, 1)
+    instance._loaded_owner_id = instance.owner_id
+
+def count_deleted_snippet(sender, instance, **kwargs):
+    ExtendedUser.count_snippets(instance.owner_id, -1)
+
+post_save.connect(count_saved_snippet, sender=Snippet)
+post_delete.connect(count_deleted_snippet, sender=Snippet)
@@ -0,0 +1,122 @@
+from itertools import islice
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination, LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class AuditCursorPagination(CursorPagination):
+    """
+    Newest audits first, paged by position in `(timestamp, id)` rather than
+    by offset, so every page costs the same and no total count is run.
+
+    DRF's cursor only holds the first ordering field and skips over rows
+    sharing it with an offset. Audits written together share a timestamp,
+    so the cursor here holds both fields. Positions are then unique and
+    cursors never carry an offset.
+    """
+    ordering = ("-timestamp", "-id")
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+        position = self.cursor.position if self.cursor is not None else None
+
+        if reverse:
+            queryset = queryset.order_by("timestamp", "id")
+        else:
+            queryset = queryset.order_by(*self.ordering)
+        if position is not None:
+            timestamp, pk = self.parse_position(position)
+            if reverse:
+                queryset = queryset.filter(
+                    Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk)
+                )
+            else:
+                queryset = queryset.filter(
+                    Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk)
+                )
+
+        # One extra row tells whether there is a page beyond this one.
+        results = list(queryset[: self.page_size + 1])
+        self.page = results[: self.page_size]
+        has_following = len(results) > len(self.page)
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = position is not None, has_following
+        else:
+            self.has_next, self.has_previous = has_following, position is not None
+        # An empty page links back to where it started.
+        self.next_position = self.previous_position = position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        position = self.position(self.page[-1]) if self.page else self.next_position
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        position = self.position(self.page[0]) if self.page else self.previous_position
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=position))
+
+    def position(self, audit):
+        return "%s|%d" % (audit.timestamp.isoformat(), audit.id)
+
+    def parse_position(self, position):
+        timestamp, _, pk = position.rpartition("|")
+        try:
+            timestamp = parse_datetime(timestamp)
+            pk = int(pk)
+        except ValueError:
+            timestamp = None
+        if timestamp is None:
+            raise NotFound(self.invalid_cursor_message)
+        return timestamp, pk
+
+
+class StreamPagination(LimitOffsetPagination):
+    """
+    Pages through an iterator, such as the rows of an archive partition,
+    reading it only up to the end of the requested page. Nothing else is
+    held in memory, so there is no total count.
+    """
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+        self.offset = self.get_offset(request)
+        # One extra row tells whether there is a page beyond this one.
+        rows = list(islice(queryset, self.offset, self.offset + self.limit + 1))
+        self.has_next = len(rows) > self.limit
+        return rows[: self.limit]
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(url, self.offset_query_param, self.offset + self.limit)
+
+    def get_paginated_response(self, data):
+        return Response(
+            {
+                "next": self.get_next_link(),
+                "previous": self.get_previous_link(),
+                "results": data,
+            }
+        )
@@ -0,0 +1,193 @@
+"""
+Read replicas for the read-heavy views.
+
+Views using `ReplicaReadMixin` read from one of `SNIPPETS_READ_REPLICAS`,
+copies of the default database refreshed by the `sync_replica` command,
+while every write and every other read goes to "default". Replicas last
+synced more than `SNIPPETS_REPLICA_MAX_LAG` seconds ago are skipped, and a
+user who has just written reads from "default" for
+`SNIPPETS_REPLICA_STICKY_SECONDS`. With the lag no longer than the sticky
+window, users always see their own changes.
+"""
+import contextvars
+import os
+import random
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework.permissions import SAFE_METHODS
+
+from .cache import changed_since, stamp
+
+_reading_from = contextvars.ContextVar("snippets_reading_from", default=None)
+
+
+def replicas():
+    return getattr(settings, "SNIPPETS_READ_REPLICAS", [])
+
+
+def replica_path(alias):
+    """
+    The file holding the replica `alias`, or None if it is not file backed.
+    """
+    name = str(connections[alias].settings_dict["NAME"])
+    if name.startswith("file:"):
+        name, _, query = name[len("file:"):].partition("?")
+        if "mode=memory" in query:
+            return None
+    if not name or name == ":memory:":
+        return None
+    return name
+
+
+def max_lag():
+    return getattr(settings, "SNIPPETS_REPLICA_MAX_LAG", sticky_seconds())
+
+
+def choose_replica():
+    """
+    A replica synced within the maximum lag, or None.
+    """
+    oldest = time.time() - max_lag() if max_lag() is not None else None
+    available = [
+        alias for alias in replicas() if _synced_since(replica_path(alias), oldest)
+    ]
+    return random.choice(available) if available else None
+
+
+def _synced_since(path, when):
+    # sync_replica dates each copy it swaps in to when its backup started.
+    if path is None:
+        return False
+    try:
+        synced = os.path.getmtime(path)
+    except OSError:
+        return False
+    return when is None or synced >= when
+
+
+@contextmanager
+def reading_from(alias):
+    """
+    Route the reads of the views using `ReplicaReadMixin` to `alias`.
+    """
+    token = _reading_from.set(alias)
+    try:
+        yield
+    finally:
+        _reading_from.reset(token)
+
+
+def iter_reading_from(alias, iterable):
+    """
+    Iterate `iterable` with its reads routed to `alias`, for streaming
+    responses that query while they are consumed.
+    """
+    iterator = iter(iterable)
+    while True:
+        with reading_from(alias):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def sticky_seconds():
+    return getattr(settings, "SNIPPETS_REPLICA_STICKY_SECONDS", 10)
+
+
+STICKY_COOKIE = "snippets_sticky"
+_STICKY_SALT = "snippets.routers.sticky"
+
+
+def _sticky_key(user_id):
+    return "snippets:replica:wrote:%s" % user_id
+
+
+def note_write(request, response):
+    """
+    Pin the reads of the client behind `request` to the default database
+    for the sticky window. Users are pinned with a stamp in the shared
+    cache, which holds for every process and client they use. Anonymous
+    clients get a signed cookie holding when the window ends.
+    """
+    if not sticky_seconds():
+        return
+    user = getattr(request, "user", None)
+    if user is not None and user.is_authenticated:
+        stamp(_sticky_key(user.pk), sticky_seconds())
+    else:
+        response.set_signed_cookie(
+            STICKY_COOKIE,
+            "%.3f" % (time.time() + sticky_seconds()),
+            salt=_STICKY_SALT,
+            max_age=sticky_seconds(),
+            httponly=True,
+            samesite="Lax",
+        )
+
+
+def recently_wrote(request):
+    if request.user.is_authenticated:
+        since = time.time() - sticky_seconds()
+        return changed_since([_sticky_key(request.user.pk)], since)
+    deadline = request.get_signed_cookie(STICKY_COOKIE, None, salt=_STICKY_SALT)
+    try:
+        return deadline is not None and float(deadline) > time.time()
+    except ValueError:
+        return False
+
+
+class ReplicaRouter:
+    """
+    Reads go to the replica chosen for the current view, if any. Writes,
+    relations and migrations all belong to the default database.
+    """
+
+    def db_for_read(self, model, **hints):
+        return _reading_from.get()
+
+    def db_for_write(self, model, **hints):
+        # Without this, saving an instance read from a replica would write
+        # to the replica it came from.
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in replicas():
+            return False
+        return None
+
+
+class ReplicaReadMixin:
+    """
+    Serve GET, HEAD and OPTIONS requests from a read replica, unless the
+    client wrote within the sticky window. The replica is picked after
+    authentication, which reads from the default database.
+    """
+
+    replica = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS and not recently_wrote(request):
+            self.replica = choose_replica()
+            if self.replica is not None:
+                self.replica_token = _reading_from.set(self.replica)
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            response = super().dispatch(request, *args, **kwargs)
+        finally:
+            if self.replica is not None:
+                _reading_from.reset(self.replica_token)
+        if self.replica is not None and response.streaming:
+            response.streaming_content = iter_reading_from(
+                self.replica, response.streaming_content
+            )
+        return response
@@ -0,0 +1,30 @@
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class TestRunner(DiscoverRunner):
+    """
+    Runs the tests with the file-based caches in a temporary directory,
+    so no run sees the entries of another or leaves its own behind.
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.cache_dir = tempfile.mkdtemp(prefix="snippets-cache-")
+        caches = {
+            alias: {**options, "LOCATION": "%s/%s" % (self.cache_dir, alias)}
+            if options["BACKEND"].endswith("FileBasedCache")
+            else options
+            for alias, options in settings.CACHES.items()
+        }
+        self.cache_settings = override_settings(CACHES=caches)
+        self.cache_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.cache_settings.disable()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        super().teardown_test_environment(**kwargs)
@@ -1,6 +1,6 @@
 from snippets.models import ExtendedUser
 from rest_framework import serializers
-from snippets.models import Snippet, Audit, LANGUAGE_CHOICES, STYLE_CHOICES
+from snippets.models import Snippet, Audit
 
 
 class SnippetSerializer(serializers.HyperlinkedModelSerializer): 
@@ -24,16 +24,26 @@ class SnippetSerializer(serializers.HyperlinkedModelSerializer):
         )  
 
 class UserSerializer(serializers.HyperlinkedModelSerializer):  
+    snippets_url = serializers.HyperlinkedIdentityField(view_name="user-snippets")
+
+    class Meta:
+        model = ExtendedUser
+        fields = ("url", "id", "username", "snippet_count", "snippets_url")
+
+class ExpandedUserSerializer(UserSerializer):
+    """
+    A user with links to all of their snippets, for `?expand=snippets`.
+    """
     snippets = serializers.HyperlinkedRelatedField(  
         many=True, view_name="snippet-detail", read_only=True
     )
 
-    class Meta:
-        model = ExtendedUser
-        fields = ("url", "id", "username", "snippets")
+    class Meta(UserSerializer.Meta):
+        fields = UserSerializer.Meta.fields + ("snippets",)
 
 class AuditSerializer(serializers.HyperlinkedModelSerializer):
     username = serializers.ReadOnlyField(source="user.username")
+    action = serializers.ReadOnlyField()
 
     class Meta:
         model = Audit
@@ -42,5 +52,15 @@ class AuditSerializer(serializers.HyperlinkedModelSerializer):
             "object_id",
             "action",
             "timestamp",
-            "username"
-        )
\ No newline at end of file
+            "username",
+            "changes",
+        )
+
+class ArchivedAuditSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    model_name = serializers.CharField()
+    object_id = serializers.CharField(allow_null=True)
+    action = serializers.CharField()
+    timestamp = serializers.DateTimeField()
+    username = serializers.CharField(allow_null=True)
+    changes = serializers.JSONField(allow_null=True)
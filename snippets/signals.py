@@ -1,30 +1,37 @@
-from django.core.signals import request_finished
-from django.dispatch import receiver
 from crum import get_current_user
+from django.utils import timezone
+from .audit import record, registry
 
-@receiver(request_finished)
-def audit_signal_handler(sender, **kwargs):
-    model_name = sender.__name__ if sender is not None else "Unknown"
 
-    logged_models = {'ExtendedUser', 'Snippet'}
-
-    if model_name not in logged_models:
-        return
+def snapshot_handler(sender, instance, **kwargs):
+    registry[sender].snapshot(instance)
 
+def audit_signal_handler(sender, instance, **kwargs):
     from .models import Audit
-    
-    instance = kwargs['instance'] if 'instance' in kwargs else None
-    created = kwargs['created'] if 'created' in kwargs else False
-    user = get_current_user()
+
+    options = registry[sender]
     action = "destroy"
     # determine what type of action is currently happening
     if 'created' in kwargs:
-        action = "create" if created else "update"
-    
+        action = "create" if kwargs['created'] else "update"
+
+    changes = None
+    if options.tracks_changes and action != "destroy":
+        if action == "update":
+            changes = options.changes(instance)
+        options.snapshot(instance)
+        if action == "update" and not changes:
+            return
+    if action not in options.actions:
+        return
+
     new_audit = Audit(
         action=action, 
-        model_name=model_name, 
-        user=user,
-        object_id=instance.pk if instance != None else None
+        model_name=sender.__name__, 
+        user=get_current_user(),
+        object_id=instance.pk,
+        changes=changes,
+        # Stamped now rather than when a buffered audit is written.
+        timestamp=timezone.now(),
     )
-    new_audit.save()
\ No newline at end of file
+    record(new_audit)
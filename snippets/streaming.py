@@ -0,0 +1,132 @@
+"""
+Chunked reads of large snippet columns and incremental rendering, so the
+memory used by the highlight endpoint does not grow with the snippet size.
+"""
+from itertools import chain
+
+from django.conf import settings
+from django.db.models import BinaryField
+from django.db.models.functions import Substr
+from django.utils.html import escape
+
+from . import compression
+from .highlighting import CSS_CLASS
+
+
+def threshold():
+    return getattr(settings, "SNIPPETS_HIGHLIGHT_STREAM_THRESHOLD", 256 * 1024)
+
+
+def chunk_size():
+    return getattr(settings, "SNIPPETS_HIGHLIGHT_CHUNK_SIZE", 64 * 1024)
+
+
+def iter_raw(queryset, field, start=1):
+    """
+    Yield the value of `field` for the single row matched by `queryset` as
+    stored, from the 1-based offset `start`, reading
+    `SNIPPETS_HIGHLIGHT_CHUNK_SIZE` characters, or bytes for compressed
+    values, per query.
+    """
+    size = chunk_size()
+    while True:
+        # Read as binary so compressed values skip the field's decompression.
+        chunk = (
+            queryset.annotate(
+                chunk=Substr(field, start, size, output_field=BinaryField())
+            )
+            .values_list("chunk", flat=True)
+            .first()
+        )
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) < size:
+            return
+        start += size
+
+
+def iter_column(queryset, field):
+    """
+    Yield the text of `field` for the single row matched by `queryset` in
+    chunks, decompressing compressed values on the fly.
+    """
+    chunks = iter_raw(queryset, field)
+    first = next(chunks, None)
+    if first is None:
+        return
+    chunks = chain([first], chunks)
+    if isinstance(first, str):
+        yield from chunks
+    else:
+        yield from compression.iter_text(chunks)
+
+
+def iter_lines(chunks, batch, limit):
+    """
+    Regroup text chunks into strings of at most `batch` complete lines.
+    A line reaching `limit` characters is flushed unfinished, so one huge
+    line is not held whole.
+    """
+    pending = ""
+    lines = []
+    for chunk in chunks:
+        *complete, pending = (pending + chunk).split("\n")
+        for line in complete:
+            lines.append(line + "\n")
+            if len(lines) == batch:
+                yield "".join(lines)
+                lines = []
+        if len(pending) >= limit:
+            lines.append(pending)
+            yield "".join(lines)
+            pending = ""
+            lines = []
+    if pending:
+        lines.append(pending)
+    if lines:
+        yield "".join(lines)
+
+
+def render_lines(chunks, language, linenos):
+    """
+    Highlight code read in chunks, a batch of
+    `SNIPPETS_HIGHLIGHT_STREAM_LINES` lines at a time, or part of a line
+    longer than `SNIPPETS_HIGHLIGHT_CHUNK_SIZE`. Lexer state does not carry
+    over between batches, so a construct spanning a batch boundary, such as
+    a long multi-line string, may be coloured incorrectly.
+    """
+    from pygments import highlight
+    from pygments.formatters.html import HtmlFormatter
+    from pygments.lexers import get_lexer_by_name
+
+    batch = getattr(settings, "SNIPPETS_HIGHLIGHT_STREAM_LINES", 1000)
+    lexer = get_lexer_by_name(language, stripnl=False)
+    formatter = HtmlFormatter(nowrap=True)
+
+    yield '<div class="%s"><pre><span></span>' % CSS_CLASS
+    lineno = 1
+    line_start = True
+    for text in iter_lines(chunks, batch, chunk_size()):
+        html = highlight(text, lexer, formatter)
+        if not text.endswith("\n"):
+            # Pygments ends its output with a newline, not so the text.
+            html = html.rstrip("\n")
+        if linenos:
+            numbered = []
+            for line in html.splitlines(keepends=True):
+                if line_start:
+                    numbered.append('<span class="linenos">%6d</span>' % lineno)
+                    lineno += 1
+                numbered.append(line)
+                line_start = line.endswith("\n")
+            html = "".join(numbered)
+        yield html
+    yield "</pre></div>\n"
+
+
+def escaped(chunks):
+    yield "<pre>"
+    for chunk in chunks:
+        yield escape(chunk)
+    yield "</pre>"
@@ -1,6 +1,37 @@
-from django.test import TestCase, Client
-from django.urls import reverse
-from snippets.models import ExtendedUser, Audit
+import csv
+import datetime
+import gzip
+import itertools
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from io import StringIO
+import zlib
+from concurrent.futures import Future
+from unittest import mock
+from django.conf import settings
+from django.core.management import call_command, CommandError
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import get_resolver, reverse
+from django.utils import timezone
+from django.utils.http import http_date
+from rest_framework.authtoken.models import Token
+from django.db import transaction
+from django.db.models import BinaryField
+from django.db.models.functions import Substr
+from snippets import apps, archive, audit, authentication, choices, compression, db, highlighting, models, routers, streaming, tokens
+from snippets.cache import shared_cache
+from snippets.management.commands import rehighlight
+from snippets.models import ExtendedUser, Audit, AuditRollup, Snippet, HighlightCache
 
 # Create your tests here.
 class UserTest(TestCase):
@@ -165,7 +196,55 @@ class AuditListViewTest(TestCase):
         res = self.client.get(list_url)
         
         self.assertEqual(res.status_code, 200)
-        self.assertEqual(res.data['count'], 4)
+        self.assertEqual(len(res.data['results']), 4)
+        self.assertEqual(res.data['results'][0]['object_id'], None)
+
+    def testListViewCursor(self):
+        audits = [Audit.objects.create(model_name="Snippet", object_id=str(i), action="update") for i in range(25)]
+
+        pages = []
+        url = reverse('audit-list')
+        while url:
+            res = self.client.get(url)
+            pages.append(res.data['results'])
+            url = res.data['next']
+
+        object_ids = [entry['object_id'] for page in pages for entry in page]
+        self.assertNotIn('count', res.data)
+        self.assertEqual(len(pages[0]), 10)
+        self.assertEqual(object_ids[:25], [audit.object_id for audit in reversed(audits)])
+        self.assertEqual(len(object_ids), Audit.objects.count())
+
+    def testListViewCursorTies(self):
+        # Rows written by one bulk insert or backfill share their timestamp.
+        for i in range(25):
+            Audit.objects.create(model_name="Snippet", object_id=str(i), action="update")
+        Audit.objects.update(timestamp=timezone.now())
+        expected = list(Audit.objects.order_by("-id").values_list("object_id", flat=True))
+
+        pages = []
+        url = reverse('audit-list')
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                res = self.client.get(url)
+            self.assertFalse([q for q in queries.captured_queries if "OFFSET" in q['sql']])
+            pages.append([entry['object_id'] for entry in res.data['results']])
+            url = res.data['next']
+        self.assertEqual([pk for page in pages for pk in page], expected)
+
+        res = self.client.get(res.data['previous'])
+        self.assertEqual([entry['object_id'] for entry in res.data['results']], pages[-2])
+
+    def testListViewInvalidCursor(self):
+        res = self.client.get(reverse('audit-list'), {"cursor": "cD1ub3Q="})
+
+        self.assertEqual(res.status_code, 404)
+
+    def testListViewNoCount(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('audit-list'))
+
+        self.assertFalse([q for q in queries.captured_queries if "COUNT(" in q['sql']])
 
     def testListViewNotAuth(self):
         self.client.logout()
@@ -174,6 +253,434 @@ class AuditListViewTest(TestCase):
         
         self.assertEqual(res.status_code, 401)
 
+class AuditBufferTest(TestCase):
+    def setUp(self):
+        self.owner = ExtendedUser.objects.create_user(username="owner", password="1234")
+        self.audits = Audit.objects.count()
+
+    def tearDown(self):
+        Snippet.objects.all().delete()
+        Audit.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def audit_inserts(self, queries):
+        return [q for q in queries.captured_queries if q['sql'].startswith('INSERT INTO "snippets_audit"')]
+
+    def testFlushOnExit(self):
+        with CaptureQueriesContext(connection) as queries:
+            with audit.buffered():
+                with self.captureOnCommitCallbacks(execute=True):
+                    for i in range(3):
+                        Snippet.objects.create(code="print(%d)" % i, owner=self.owner)
+                self.assertEqual(Audit.objects.count(), self.audits)
+
+        self.assertEqual(Audit.objects.count(), self.audits + 3)
+        self.assertEqual(len(self.audit_inserts(queries)), 1)
+
+    def testTimestampOfEvent(self):
+        later = timezone.now() + datetime.timedelta(hours=1)
+        with audit.buffered():
+            with self.captureOnCommitCallbacks(execute=True):
+                snippet = Snippet.objects.create(code="print(1)", owner=self.owner)
+            happened = timezone.now()
+            # The buffer is flushed well after the event.
+            with mock.patch("django.utils.timezone.now", return_value=later):
+                audit.flush()
+
+        entry = Audit.objects.get(model_name="Snippet", object_id=snippet.pk)
+        self.assertLessEqual(entry.timestamp, happened)
+
+    def testRollbackDropsRecords(self):
+        with audit.buffered():
+            with self.captureOnCommitCallbacks(execute=True):
+                Snippet.objects.create(code="kept", owner=self.owner)
+                try:
+                    with transaction.atomic():
+                        Snippet.objects.create(code="rolled back", owner=self.owner)
+                        raise RuntimeError
+                except RuntimeError:
+                    pass
+
+        self.assertEqual(Audit.objects.count(), self.audits + 1)
+
+    def testFlushOnError(self):
+        with self.assertRaises(RuntimeError):
+            with audit.buffered():
+                with self.captureOnCommitCallbacks(execute=True):
+                    Snippet.objects.create(code="print(1)", owner=self.owner)
+                raise RuntimeError
+
+        self.assertEqual(Audit.objects.count(), self.audits + 1)
+
+    def testSizeBound(self):
+        with audit.buffered(max_size=2):
+            with self.captureOnCommitCallbacks(execute=True):
+                for i in range(3):
+                    Snippet.objects.create(code="print(%d)" % i, owner=self.owner)
+            self.assertEqual(Audit.objects.count(), self.audits + 2)
+
+        self.assertEqual(Audit.objects.count(), self.audits + 3)
+
+    def testUnbuffered(self):
+        Snippet.objects.create(code="print(1)", owner=self.owner)
+
+        self.assertEqual(Audit.objects.count(), self.audits + 1)
+
+    def testRequestBuffered(self):
+        self.client.force_login(self.owner)
+        audits = Audit.objects.count()
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(reverse('snippet-list'), {"code": "print(1)"})
+
+        self.assertEqual(Audit.objects.count(), audits)
+        self.assertEqual(len(callbacks), 1)
+
+class AuditRegistryTest(TestCase):
+    def setUp(self):
+        self.owner = ExtendedUser.objects.create_user(username="owner", password="1234")
+        self.snippet = Snippet.objects.create(code="print(1)", owner=self.owner)
+
+    def tearDown(self):
+        Snippet.objects.all().delete()
+        Audit.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def last_update(self, model_name):
+        return Audit.objects.filter(model_name=model_name, action="update").order_by("-id").first()
+
+    def testOnlyRegisteredSenders(self):
+        from django.contrib.sessions.models import Session
+        from django.db.models.signals import post_save
+        from rest_framework.authtoken.models import Token
+
+        self.assertTrue(post_save.has_listeners(Snippet))
+        self.assertFalse(post_save.has_listeners(Session))
+        self.assertFalse(post_save.has_listeners(Token))
+
+    def testChanges(self):
+        snippet = Snippet.objects.get(pk=self.snippet.pk)
+        snippet.title = "Hello"
+        snippet.code = "print(2)"
+        snippet.save()
+
+        audit = self.last_update("Snippet")
+        self.assertEqual(audit.changes, {"title": ["", "Hello"], "code": None})
+
+    def testUnchangedSaveNotAudited(self):
+        audits = Audit.objects.count()
+
+        self.snippet.save()
+        Snippet.objects.get(pk=self.snippet.pk).save()
+
+        self.assertEqual(Audit.objects.count(), audits)
+
+    def testSnapshotRefreshedOnSave(self):
+        self.snippet.title = "One"
+        self.snippet.save()
+        self.snippet.title = "Two"
+        self.snippet.save()
+
+        self.assertEqual(self.last_update("Snippet").changes, {"title": ["One", "Two"]})
+
+    def testValuesNotRecorded(self):
+        self.owner.set_password("secret")
+        self.owner.save()
+
+        self.assertEqual(self.last_update("ExtendedUser").changes, {"password": None})
+
+class AuditFilterTest(TestCase):
+    def setUp(self):
+        self.staff = ExtendedUser.objects.create_user(username="staff1", password="password", is_staff=True)
+        self.client.force_login(self.staff)
+        Audit.objects.all().delete()
+        self.audits = [
+            Audit.objects.create(model_name="Snippet", object_id="1", action="create", user=self.staff),
+            Audit.objects.create(model_name="Snippet", object_id="1", action="update"),
+            Audit.objects.create(model_name="Snippet", object_id="2", action="destroy"),
+            Audit.objects.create(model_name="ExtendedUser", object_id="1", action="update"),
+        ]
+        Audit.objects.filter(pk=self.audits[0].pk).update(timestamp="2020-01-01T00:00:00Z")
+
+    def tearDown(self):
+        Audit.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def get(self, **params):
+        res = self.client.get(reverse('audit-list'), params)
+        self.assertEqual(res.status_code, 200)
+        return [(entry['model_name'], entry['object_id'], entry['action']) for entry in res.data['results']]
+
+    def testActionStoredAsCode(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT action FROM snippets_audit WHERE id = %s", [self.audits[2].pk])
+            self.assertEqual(cursor.fetchone()[0], 3)
+        self.assertEqual(Audit.objects.get(pk=self.audits[2].pk).action, "destroy")
+
+    def testFilters(self):
+        self.assertEqual(self.get(model="Snippet", object_id="1"), [("Snippet", "1", "update"), ("Snippet", "1", "create")])
+        self.assertEqual(self.get(action="destroy"), [("Snippet", "2", "destroy")])
+        self.assertEqual(self.get(user=self.staff.pk), [("Snippet", "1", "create")])
+        self.assertEqual(self.get(until="2021-01-01T00:00:00"), [("Snippet", "1", "create")])
+        self.assertEqual(len(self.get(model="Snippet", since="2021-01-01T00:00:00")), 2)
+
+    def testInvalidFilters(self):
+        for params in ({"action": "rename"}, {"user": "staff1"}, {"since": "yesterday"}):
+            res = self.client.get(reverse('audit-list'), params)
+            self.assertEqual(res.status_code, 400)
+
+    def testHistory(self):
+        res = self.client.get(reverse('audit-history', args=["Snippet", "1"]))
+
+        self.assertEqual([entry['action'] for entry in res.data['results']], ["update", "create"])
+        self.assertEqual(res.data['results'][1]['username'], "staff1")
+
+class AuditExportTest(TestCase):
+    def setUp(self):
+        self.staff = ExtendedUser.objects.create_user(username="staff1", password="password", is_staff=True)
+        self.client.force_login(self.staff)
+        Audit.objects.all().delete()
+        Audit.objects.create(model_name="Snippet", object_id="1", action="create", user=self.staff)
+        Audit.objects.create(model_name="Snippet", object_id="1", action="update", changes={"title": ["", "Hi, there"]})
+        Audit.objects.create(model_name="ExtendedUser", object_id="2", action="destroy")
+
+    def tearDown(self):
+        Audit.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def export(self, **params):
+        res = self.client.get(reverse('audit-export'), params)
+        self.assertEqual(res.status_code, 200)
+        return b"".join(res.streaming_content).decode("utf-8")
+
+    def testNdjson(self):
+        rows = [json.loads(line) for line in self.export().splitlines()]
+
+        self.assertEqual([row['action'] for row in rows], ["create", "update", "destroy"])
+        self.assertEqual(rows[0]['username'], "staff1")
+        self.assertEqual(rows[1]['changes'], {"title": ["", "Hi, there"]})
+
+    def testCsv(self):
+        rows = list(csv.DictReader(StringIO(self.export(export_format="csv"))))
+
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0]['username'], "staff1")
+        self.assertEqual(json.loads(rows[1]['changes']), {"title": ["", "Hi, there"]})
+
+    def testFilters(self):
+        rows = self.export(model="Snippet", action="update").splitlines()
+
+        self.assertEqual(len(rows), 1)
+
+    def testInvalidFormat(self):
+        res = self.client.get(reverse('audit-export'), {"export_format": "xml"})
+
+        self.assertEqual(res.status_code, 400)
+
+    def testNotAuth(self):
+        self.client.logout()
+
+        res = self.client.get(reverse('audit-export'))
+
+        self.assertEqual(res.status_code, 401)
+
+class AuditRollupTest(TestCase):
+    def setUp(self):
+        self.staff = ExtendedUser.objects.create_user(username="staff1", password="password", is_staff=True)
+        self.client.force_login(self.staff)
+        Audit.objects.all().delete()
+        AuditRollup.objects.all().delete()
+
+    def tearDown(self):
+        Snippet.objects.all().delete()
+        Audit.objects.all().delete()
+        AuditRollup.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def rollups(self, **params):
+        res = self.client.get(reverse('audit-rollups'), params)
+        self.assertEqual(res.status_code, 200)
+        return res.data['results']
+
+    def testRollupOnWrite(self):
+        snippets = [Snippet.objects.create(code="print(%d)" % i, owner=self.staff) for i in range(2)]
+        with audit.buffered():
+            with self.captureOnCommitCallbacks(execute=True):
+                snippets[0].delete()
+
+        counts = {
+            (row.model_name, row.action, row.user_id): row.count
+            for row in AuditRollup.objects.all()
+        }
+        self.assertEqual(counts, {("Snippet", "create", None): 2, ("Snippet", "destroy", None): 1})
+
+    def testRollupRace(self):
+        record = Audit.objects.create(model_name="Snippet", object_id="1", action="update")
+        real_filter = AuditRollup.objects.filter
+        raced = []
+
+        def racing_filter(**key):
+            # Another writer creates the row between our update and create.
+            if raced:
+                return real_filter(**key)
+            raced.append(True)
+            AuditRollup(count=5, **key).save()
+            return real_filter(**key).none()
+
+        with mock.patch.object(AuditRollup.objects, "filter", side_effect=racing_filter):
+            audit.roll_up([record])
+
+        self.assertEqual(list(AuditRollup.objects.values_list("count", flat=True)), [6])
+
+    def testEndpoint(self):
+        AuditRollup.objects.bulk_create([
+            AuditRollup(hour="2020-01-01T10:00:00Z", model_name="Snippet", action="create", user=self.staff, count=2),
+            AuditRollup(hour="2020-01-01T11:00:00Z", model_name="Snippet", action="create", count=3),
+            AuditRollup(hour="2020-01-01T11:00:00Z", model_name="Snippet", action="create", user=self.staff, count=1),
+            AuditRollup(hour="2020-01-01T11:00:00Z", model_name="ExtendedUser", action="update", count=4),
+        ])
+
+        rows = self.rollups(group_by="model,action")
+        self.assertEqual(
+            [(row['model_name'], row['action'], row['count']) for row in rows],
+            [("ExtendedUser", "update", 4), ("Snippet", "create", 6)],
+        )
+
+        rows = self.rollups(model="Snippet", until="2020-01-01T11:00:00")
+        self.assertEqual(rows[0]['username'], "staff1")
+        self.assertEqual(rows[0]['count'], 2)
+        self.assertEqual(len(rows), 1)
+
+    def testEndpointInvalid(self):
+        res = self.client.get(reverse('audit-rollups'), {"group_by": "day"})
+        self.assertEqual(res.status_code, 400)
+
+        res = self.client.get(reverse('audit-rollups'), {"action": "rename"})
+        self.assertEqual(res.status_code, 400)
+
+    def testEndpointIgnoresObjectId(self):
+        AuditRollup.objects.create(hour="2020-01-01T10:00:00Z", model_name="Snippet", action="create", count=2)
+
+        self.assertEqual(len(self.rollups(object_id="1")), 1)
+
+    def testRebuild(self):
+        archived = AuditRollup.objects.create(hour="2019-01-01T00:00:00Z", model_name="Snippet", action="create", count=7)
+        Audit.objects.bulk_create([
+            Audit(model_name="Snippet", object_id=str(i), action="update", user=self.staff)
+            for i in range(3)
+        ])
+        Audit.objects.update(timestamp="2020-01-01T10:30:00Z")
+        AuditRollup.objects.create(hour="2020-01-01T10:00:00Z", model_name="Snippet", action="update", count=99)
+
+        call_command("rebuild_audit_rollups", stdout=StringIO())
+
+        self.assertTrue(AuditRollup.objects.filter(pk=archived.pk).exists())
+        rollup = AuditRollup.objects.get(hour="2020-01-01T10:00:00Z")
+        self.assertEqual((rollup.action, rollup.user_id, rollup.count), ("update", self.staff.pk, 3))
+
+        call_command("rebuild_audit_rollups", "--all", stdout=StringIO())
+
+        self.assertEqual(AuditRollup.objects.count(), 1)
+
+class ArchiveAuditsTest(TestCase):
+    def setUp(self):
+        self.staff = ExtendedUser.objects.create_user(username="staff1", password="password", is_staff=True)
+        self.client.force_login(self.staff)
+        Audit.objects.all().delete()
+        self.old = [
+            Audit.objects.create(model_name="Snippet", object_id=str(i), action="update", user=self.staff)
+            for i in range(3)
+        ]
+        self.recent = Audit.objects.create(model_name="Snippet", object_id="9", action="create")
+        Audit.objects.filter(pk__in=[a.pk for a in self.old[:2]]).update(timestamp="2020-01-01T10:00:00Z")
+        Audit.objects.filter(pk=self.old[2].pk).update(timestamp="2020-01-02T10:00:00Z")
+        self.directory = tempfile.mkdtemp()
+        settings = override_settings(SNIPPETS_AUDIT_ARCHIVE_DIR=self.directory)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def tearDown(self):
+        Audit.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def archive_audits(self, *args):
+        out = StringIO()
+        call_command("archive_audits", "--days=30", "--chunk-size=1", *args, stdout=out)
+        return out.getvalue()
+
+    def testArchive(self):
+        out = self.archive_audits()
+
+        self.assertIn("Archived 3 audits", out)
+        self.assertEqual(list(Audit.objects.values_list("pk", flat=True)), [self.recent.pk])
+        self.assertEqual(sorted(os.listdir(self.directory)), ["audits-2020-01-01.ndjson.gz", "audits-2020-01-02.ndjson.gz"])
+        with gzip.open(os.path.join(self.directory, "audits-2020-01-01.ndjson.gz"), "rt") as partition:
+            rows = [json.loads(line) for line in partition]
+        self.assertEqual([row["id"] for row in rows], [a.pk for a in self.old[:2]])
+        self.assertEqual(rows[0]["username"], "staff1")
+        self.assertEqual(rows[0]["action"], "update")
+
+    def testRerunAppends(self):
+        self.archive_audits()
+        Audit.objects.create(model_name="Snippet", object_id="5", action="destroy")
+        Audit.objects.filter(object_id="5").update(timestamp="2020-01-01T12:00:00Z")
+
+        self.archive_audits()
+
+        res = self.client.get(reverse('audit-archive-detail', args=["2020-01-01"]))
+        self.assertEqual(len(res.data['results']), 3)
+
+    def testArchiveApi(self):
+        self.archive_audits()
+
+        res = self.client.get(reverse('audit-archive'))
+        self.assertEqual([entry['date'] for entry in res.data], ["2020-01-01", "2020-01-02"])
+
+        res = self.client.get(res.data[0]['url'], {"object_id": "1"})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([entry['object_id'] for entry in res.data['results']], ["1"])
+
+    def testArchiveApiPages(self):
+        self.archive_audits()
+        url = reverse('audit-archive-detail', args=["2020-01-01"])
+
+        res = self.client.get(url, {"limit": 1})
+        self.assertEqual([entry['id'] for entry in res.data['results']], [self.old[0].pk])
+        self.assertIsNone(res.data['previous'])
+
+        res = self.client.get(res.data['next'])
+        self.assertEqual([entry['id'] for entry in res.data['results']], [self.old[1].pk])
+        self.assertIsNone(res.data['next'])
+        self.assertIsNotNone(res.data['previous'])
+
+    def testArchiveApiReadsOnePage(self):
+        self.archive_audits()
+        read = []
+
+        def endless(day):
+            for i in itertools.count():
+                read.append(i)
+                yield {"id": i, "model_name": "Snippet", "object_id": str(i), "action": "update",
+                       "timestamp": "2020-01-01T10:00:00Z", "username": None, "changes": None}
+
+        with mock.patch.object(archive, "read_partition", endless):
+            res = self.client.get(reverse('audit-archive-detail', args=["2020-01-01"]), {"offset": 20})
+
+        self.assertEqual([entry['id'] for entry in res.data['results']], list(range(20, 30)))
+        self.assertEqual(len(read), 31)
+
+    def testArchiveApiMissing(self):
+        for day in ("2020-01-05", "yesterday"):
+            res = self.client.get(reverse('audit-archive-detail', args=[day]))
+            self.assertEqual(res.status_code, 404)
+
+    def testArchiveApiNotAuth(self):
+        self.client.logout()
+
+        res = self.client.get(reverse('audit-archive'))
+
+        self.assertEqual(res.status_code, 401)
+
 class AuditDetailViewTest(TestCase):
     def setUp(self):
         staff_user = ExtendedUser.objects.create_user(username="staff1", password="password", is_staff=True)
@@ -205,4 +712,1392 @@ class AuditDetailViewTest(TestCase):
         list_url = reverse('audit-detail', args=[audit_one.pk])
         res = self.client.get(list_url)
         
-        self.assertEqual(res.status_code, 401)
\ No newline at end of file
+        self.assertEqual(res.status_code, 401)
+
+class InlinePool:
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+    def map(self, fn, *iterables, chunksize=1):
+        return map(fn, *iterables)
+
+class SnippetHighlightTest(TestCase):
+    def setUp(self):
+        highlighting.get_memory_cache().clear()
+        self.owner = ExtendedUser.objects.create_user(username="owner", password="1234")
+
+    def tearDown(self):
+        Snippet.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def testHighlightInline(self):
+        snippet = Snippet.objects.create(code="print(1)", owner=self.owner)
+
+        self.assertEqual(snippet.highlight_status, Snippet.HighlightStatus.READY)
+        self.assertIn("print", snippet.highlighted)
+
+    @override_settings(SNIPPETS_HIGHLIGHT_ASYNC=True)
+    def testHighlightPending(self):
+        with self.captureOnCommitCallbacks(execute=False):
+            snippet = Snippet.objects.create(code="print(1)", owner=self.owner)
+
+        self.assertEqual(snippet.highlight_status, Snippet.HighlightStatus.PENDING)
+        self.assertEqual(snippet.highlighted, "")
+
+        res = self.client.get(reverse('snippet-highlight', args=[snippet.pk]))
+        self.assertEqual(res.status_code, 202)
+
+    @override_settings(SNIPPETS_HIGHLIGHT_ASYNC=True)
+    def testHighlightStalled(self):
+        with self.captureOnCommitCallbacks(execute=False):
+            snippet = Snippet.objects.create(code="print(1)", owner=self.owner)
+        # The render was scheduled by a process that has since exited.
+        updated = snippet.updated - datetime.timedelta(minutes=5)
+        Snippet.objects.filter(pk=snippet.pk).update(updated=updated)
+
+        res = self.client.get(reverse('snippet-highlight', args=[snippet.pk]))
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b"print", res.content)
+
+        snippet.refresh_from_db()
+        self.assertEqual(snippet.highlight_status, Snippet.HighlightStatus.READY)
+        self.assertIn("print", snippet.highlighted)
+
+    @override_settings(SNIPPETS_HIGHLIGHT_ASYNC=True)
+    def testHighlightBackground(self):
+        with mock.patch.object(highlighting, "get_pool", return_value=InlinePool()):
+            with self.captureOnCommitCallbacks(execute=True):
+                snippet = Snippet.objects.create(code="print(1)", owner=self.owner)
+
+        snippet.refresh_from_db()
+        self.assertEqual(snippet.highlight_status, Snippet.HighlightStatus.READY)
+        self.assertIn("print", snippet.highlighted)
+
+        res = self.client.get(reverse('snippet-highlight', args=[snippet.pk]))
+        self.assertEqual(res.status_code, 200)
+
+    @override_settings(SNIPPETS_HIGHLIGHT_ASYNC=True)
+    def testHighlightStaleResult(self):
+        with mock.patch.object(highlighting, "get_pool", return_value=InlinePool()):
+            with self.captureOnCommitCallbacks(execute=False) as callbacks:
+                snippet = Snippet.objects.create(code="print(1)", owner=self.owner)
+            snippet.code = "print(2)"
+            with self.captureOnCommitCallbacks(execute=False):
+                snippet.save()
+            callbacks[0]()
+
+        snippet.refresh_from_db()
+        self.assertEqual(snippet.highlight_status, Snippet.HighlightStatus.PENDING)
+
+    @override_settings(SNIPPETS_HIGHLIGHT_ASYNC=True)
+    def testHighlightStoredUncompressed(self):
+        with mock.patch.object(highlighting, "get_pool", return_value=InlinePool()):
+            with self.captureOnCommitCallbacks(execute=False) as callbacks:
+                snippet = Snippet.objects.create(code="print(1)", owner=self.owner)
+            # The row was written before compressed storage was enabled.
+            with override_settings(SNIPPETS_COMPRESSED_STORAGE=True):
+                callbacks[0]()
+
+        snippet.refresh_from_db()
+        self.assertEqual(snippet.highlight_status, Snippet.HighlightStatus.READY)
+
+class HighlightCacheTest(TestCase):
+    def setUp(self):
+        highlighting.get_memory_cache().clear()
+        self.owner = ExtendedUser.objects.create_user(username="owner", password="1234", is_staff=True)
+
+    def tearDown(self):
+        Snippet.objects.all().delete()
+        HighlightCache.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def testIdenticalSnippetsRenderOnce(self):
+        with mock.patch.object(highlighting, "render", wraps=highlighting.render) as render:
+            first = Snippet.objects.create(code="print(1)", owner=self.owner)
+            second = Snippet.objects.create(code="print(1)", owner=self.owner)
+
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(first.highlighted, second.highlighted)
+        self.assertEqual(HighlightCache.objects.count(), 1)
+
+    def testPersistentTier(self):
+        Snippet.objects.create(code="print(1)", owner=self.owner)
+        highlighting.get_memory_cache().clear()
+
+        with mock.patch.object(highlighting, "render") as render:
+            Snippet.objects.create(code="print(1)", owner=self.owner)
+
+        render.assert_not_called()
+
+    @override_settings(SNIPPETS_HIGHLIGHT_ASYNC=True)
+    def testCachedSnippetSkipsPool(self):
+        highlighting.cached_render("print(1)", "python", False)
+
+        with mock.patch.object(highlighting, "schedule") as schedule:
+            snippet = Snippet.objects.create(code="print(1)", owner=self.owner)
+
+        schedule.assert_not_called()
+        self.assertEqual(snippet.highlight_status, Snippet.HighlightStatus.READY)
+
+    def testLRUEviction(self):
+        cache = highlighting.LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def testLRUExpiry(self):
+        cache = highlighting.LRUCache(2, ttl=10)
+        cache.set("a", 1)
+
+        with mock.patch("snippets.cache.time.monotonic", return_value=time.monotonic() + 11):
+            self.assertEqual(cache.get("a"), None)
+        self.assertEqual(len(cache), 0)
+
+    def testStatsView(self):
+        self.client.force_login(self.owner)
+        Snippet.objects.create(code="print(1)", owner=self.owner)
+
+        res = self.client.get(reverse('highlight-cache'))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data['persistent']['size'], 1)
+        self.assertEqual(res.data['memory']['size'], 1)
+
+class SnippetStyleTest(TestCase):
+    def setUp(self):
+        highlighting.get_memory_cache().clear()
+        self.owner = ExtendedUser.objects.create_user(username="owner", password="1234")
+
+    def tearDown(self):
+        Snippet.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def testFragmentHasNoStylesheet(self):
+        snippet = Snippet.objects.create(code="print(1)", owner=self.owner)
+
+        self.assertNotIn("<style", snippet.highlighted)
+        self.assertTrue(snippet.highlighted.startswith('<div class="highlight">'))
+
+    def testStyleChangeSharesRender(self):
+        with mock.patch.object(highlighting, "render", wraps=highlighting.render) as render:
+            Snippet.objects.create(code="print(1)", style="friendly", owner=self.owner)
+            Snippet.objects.create(code="print(1)", style="monokai", owner=self.owner)
+
+        self.assertEqual(render.call_count, 1)
+
+    def testHighlightDocument(self):
+        snippet = Snippet.objects.create(code="print(1)", title="<demo>", style="monokai", owner=self.owner)
+
+        res = self.client.get(reverse('snippet-highlight', args=[snippet.pk]))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertContains(res, reverse('snippet-style', args=["monokai"]))
+        self.assertContains(res, "<h2>&lt;demo&gt;</h2>")
+        self.assertContains(res, snippet.highlighted)
+
+    def testStylesheet(self):
+        res = self.client.get(reverse('snippet-style', args=["monokai"]))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['Content-Type'], "text/css")
+        self.assertIn("immutable", res['Cache-Control'])
+        self.assertIn(b".highlight", res.content)
+
+    def testStylesheetUnknown(self):
+        res = self.client.get(reverse('snippet-style', args=["nope"]))
+
+        self.assertEqual(res.status_code, 404)
+
+    def testStylesheetNotAChoice(self):
+        with mock.patch.object(choices, "style_choices", return_value=[("default", "default")]):
+            with mock.patch.object(highlighting, "stylesheet") as stylesheet:
+                res = self.client.get(reverse('snippet-style', args=["monokai"]))
+
+        self.assertEqual(res.status_code, 404)
+        stylesheet.assert_not_called()
+
+class ChoicesTest(TestCase):
+    def setUp(self):
+        self.owner = ExtendedUser.objects.create_user(username="owner", password="1234")
+        self.client.force_login(self.owner)
+
+    def tearDown(self):
+        Snippet.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def testTableMatchesPygments(self):
+        self.assertTrue(choices.table_is_current())
+        self.assertEqual((choices.language_choices(), choices.style_choices()), choices.build())
+
+    def testModuleChoices(self):
+        self.assertIn(("python", "Python"), models.LANGUAGE_CHOICES)
+        self.assertIn(("monokai", "monokai"), models.STYLE_CHOICES)
+
+    def testCreateValidatesLanguage(self):
+        list_url = reverse('snippet-list')
+
+        res = self.client.post(list_url, {"code": "x", "language": "nope"})
+        self.assertEqual(res.status_code, 400)
+        self.assertIn("language", res.data)
+
+        res = self.client.post(list_url, {"code": "x", "language": "rust", "style": "monokai"})
+        self.assertEqual(res.status_code, 201)
+
+class RendererPoolTest(TestCase):
+    def testReuse(self):
+        pool = highlighting.RendererPool(maxkeys=2, per_key=1)
+
+        with pool.acquire("python", False) as first:
+            pass
+        with pool.acquire("python", False) as second:
+            pass
+
+        self.assertIs(first, second)
+        self.assertEqual(pool.stats()["created"], 1)
+        self.assertEqual(pool.stats()["reused"], 1)
+
+    def testCheckoutIsExclusive(self):
+        pool = highlighting.RendererPool(maxkeys=2, per_key=2)
+
+        with pool.acquire("python", False) as first:
+            with pool.acquire("python", False) as second:
+                self.assertIsNot(first, second)
+
+        self.assertEqual(pool.stats()["idle"], 2)
+
+    def testBounded(self):
+        pool = highlighting.RendererPool(maxkeys=2, per_key=1)
+
+        for language in ("python", "rust", "go"):
+            with pool.acquire(language, False):
+                pass
+        with pool.acquire("python", True):
+            pass
+
+        self.assertEqual(pool.stats()["keys"], 2)
+        self.assertEqual(pool.stats()["created"], 4)
+
+class SnippetDirtyFieldsTest(TestCase):
+    def setUp(self):
+        highlighting.get_memory_cache().clear()
+        self.owner = ExtendedUser.objects.create_user(username="owner", password="1234")
+        self.snippet = Snippet.objects.create(code="print(1)", owner=self.owner)
+
+    def tearDown(self):
+        Snippet.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def updateSql(self, snippet, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            with mock.patch.object(highlighting, "cached_render", wraps=highlighting.cached_render) as render:
+                snippet.save(**kwargs)
+        updates = [q['sql'] for q in queries.captured_queries if q['sql'].startswith("UPDATE")]
+        return render.call_count, updates[0]
+
+    def testUnrelatedChangeSkipsHighlight(self):
+        snippet = Snippet.objects.get(pk=self.snippet.pk)
+        snippet.title = "renamed"
+
+        renders, sql = self.updateSql(snippet)
+
+        self.assertEqual(renders, 0)
+        self.assertIn('"title"', sql)
+        self.assertNotIn('"highlighted"', sql)
+
+    def testCodeChangeHighlights(self):
+        snippet = Snippet.objects.get(pk=self.snippet.pk)
+        snippet.code = "print(2)"
+
+        renders, sql = self.updateSql(snippet)
+
+        self.assertEqual(renders, 1)
+        self.assertIn('"highlighted"', sql)
+        snippet.refresh_from_db()
+        self.assertIn("2", snippet.highlighted)
+
+    def testUpdateFieldsIncludesHighlight(self):
+        snippet = Snippet.objects.get(pk=self.snippet.pk)
+        snippet.code = "print(2)"
+
+        renders, sql = self.updateSql(snippet, update_fields=["code"])
+
+        self.assertEqual(renders, 1)
+        self.assertIn('"highlighted"', sql)
+
+    def testUpdateFieldsWithoutInputs(self):
+        snippet = Snippet.objects.get(pk=self.snippet.pk)
+        snippet.code = "print(2)"
+        snippet.title = "renamed"
+
+        renders, sql = self.updateSql(snippet, update_fields=["title"])
+
+        self.assertEqual(renders, 0)
+        self.assertNotIn('"code"', sql)
+
+    def testDeferredHighlight(self):
+        snippet = Snippet.objects.defer("highlighted", "code").get(pk=self.snippet.pk)
+        snippet.style = "monokai"
+
+        with CaptureQueriesContext(connection) as queries:
+            renders, sql = self.updateSql(snippet)
+
+        self.assertEqual(renders, 0)
+        self.assertFalse(any(q['sql'].startswith("SELECT") for q in queries.captured_queries))
+
+    def testPatchSkipsHighlight(self):
+        self.client.force_login(self.owner)
+        detail_url = reverse('snippet-detail', args=[self.snippet.pk])
+
+        with mock.patch.object(highlighting, "cached_render") as render:
+            res = self.client.patch(detail_url, {"style": "monokai"}, content_type="application/json")
+
+        self.assertEqual(res.status_code, 200)
+        render.assert_not_called()
+
+class SnippetStreamingTest(TestCase):
+    def setUp(self):
+        highlighting.get_memory_cache().clear()
+        self.owner = ExtendedUser.objects.create_user(username="owner", password="1234")
+
+    def tearDown(self):
+        Snippet.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def getHighlight(self, snippet):
+        return self.client.get(reverse('snippet-highlight', args=[snippet.pk]))
+
+    def testSmallSnippetNotStreamed(self):
+        snippet = Snippet.objects.create(code="print(1)", owner=self.owner)
+
+        res = self.getHighlight(snippet)
+
+        self.assertFalse(res.streaming)
+        self.assertContains(res, snippet.highlighted)
+
+    @override_settings(SNIPPETS_HIGHLIGHT_STREAM_THRESHOLD=100, SNIPPETS_HIGHLIGHT_CHUNK_SIZE=64)
+    def testLargeFragmentStreamed(self):
+        snippet = Snippet.objects.create(code="print(1)\n" * 50, owner=self.owner)
+
+        res = self.getHighlight(snippet)
+        content = b"".join(res.streaming_content).decode()
+
+        self.assertTrue(res.streaming)
+        self.assertIn(snippet.highlighted, content)
+        self.assertTrue(content.startswith("<!DOCTYPE html>"))
+
+    @override_settings(SNIPPETS_HIGHLIGHT_MAX_SIZE=100, SNIPPETS_HIGHLIGHT_CHUNK_SIZE=64, SNIPPETS_HIGHLIGHT_STREAM_LINES=7)
+    def testOversizedRenderedOnRequest(self):
+        code = "".join("x%d = %d\n" % (i, i) for i in range(50))
+        snippet = Snippet.objects.create(code=code, linenos=True, owner=self.owner)
+
+        self.assertEqual(snippet.highlight_status, Snippet.HighlightStatus.STREAMED)
+        self.assertEqual(snippet.highlighted, "")
+
+        res = self.getHighlight(snippet)
+        content = b"".join(res.streaming_content).decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(content.count('<span class="linenos">'), 50)
+        self.assertIn('<span class="n">x49</span>', content)
+
+    def testIterLines(self):
+        lines = list(streaming.iter_lines(["a\nb", "c\nd\ne"], 2, 64))
+
+        self.assertEqual(lines, ["a\nbc\n", "d\ne"])
+
+    def testIterLinesFlushesLongLine(self):
+        lines = list(streaming.iter_lines(["a\nbc", "defgh", "i\nj"], 10, 4))
+
+        self.assertEqual(lines, ["a\nbcdefgh", "i\nj"])
+
+    @override_settings(SNIPPETS_HIGHLIGHT_MAX_SIZE=100, SNIPPETS_HIGHLIGHT_CHUNK_SIZE=64)
+    def testLongLineRenderedInParts(self):
+        code = "x = [%s]\ny = 1\n" % ", ".join(str(i) for i in range(100))
+        snippet = Snippet.objects.create(code=code, linenos=True, owner=self.owner)
+
+        res = self.getHighlight(snippet)
+        content = b"".join(res.streaming_content).decode()
+
+        self.assertEqual(content.count('<span class="linenos">'), 2)
+        self.assertIn('<span class="linenos">     2</span><span class="n">y</span>', content)
+
+    def testIterColumn(self):
+        snippet = Snippet.objects.create(code="abcdefghij", owner=self.owner)
+        row = Snippet.objects.filter(pk=snippet.pk)
+
+        with override_settings(SNIPPETS_HIGHLIGHT_CHUNK_SIZE=4):
+            chunks = list(streaming.iter_column(row, "code"))
+
+        self.assertEqual(chunks, ["abcd", "efgh", "ij"])
+
+@override_settings(SNIPPETS_COMPRESSED_STORAGE=True)
+class CompressedStorageTest(TestCase):
+    def setUp(self):
+        highlighting.get_memory_cache().clear()
+        self.owner = ExtendedUser.objects.create_user(username="owner", password="1234")
+        self.snippet = Snippet.objects.create(code="print('h\u00e9llo')\n" * 200, owner=self.owner)
+
+    def tearDown(self):
+        Snippet.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def storedValue(self, column):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT %s FROM snippets_snippet WHERE id = %%s" % column, [self.snippet.pk])
+            return cursor.fetchone()[0]
+
+    def testStoredCompressed(self):
+        stored = self.storedValue("highlighted")
+
+        self.assertIsInstance(stored, bytes)
+        self.assertLess(len(stored), len(self.snippet.highlighted))
+        self.assertEqual(Snippet.objects.get(pk=self.snippet.pk).highlighted, self.snippet.highlighted)
+        self.assertEqual(Snippet.objects.get(pk=self.snippet.pk).code, self.snippet.code)
+
+    def testPlainRowsStillRead(self):
+        with override_settings(SNIPPETS_COMPRESSED_STORAGE=False):
+            plain = Snippet.objects.create(code="print(1)", owner=self.owner)
+
+        self.assertEqual(Snippet.objects.get(pk=plain.pk).code, "print(1)")
+
+    def testGzipServedPrecompressed(self):
+        url = reverse('snippet-highlight', args=[self.snippet.pk])
+
+        with mock.patch.object(compression, "decompress") as decompress:
+            res = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip, deflate")
+            body = gzip.decompress(b"".join(res.streaming_content)).decode()
+
+        decompress.assert_not_called()
+        self.assertEqual(res['Content-Encoding'], "gzip")
+        self.assertIn("Accept-Encoding", res['Vary'])
+        self.assertTrue(body.startswith("<!DOCTYPE html>"))
+        self.assertIn(self.snippet.highlighted, body)
+
+    def testIdentityDecompressed(self):
+        url = reverse('snippet-highlight', args=[self.snippet.pk])
+
+        res = self.client.get(url)
+        body = b"".join(res.streaming_content).decode()
+
+        self.assertFalse(res.has_header('Content-Encoding'))
+        self.assertIn(self.snippet.highlighted, body)
+
+    def testCrc32Combine(self):
+        first, second = b"head", b"body" * 1000
+
+        combined = compression.crc32_combine(zlib.crc32(first), zlib.crc32(second), len(second))
+
+        self.assertEqual(combined, zlib.crc32(first + second))
+
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        highlighting.get_memory_cache().clear()
+        self.owner = ExtendedUser.objects.create_user(username="owner", password="1234")
+        self.snippet = Snippet.objects.create(code="print(1)", owner=self.owner)
+
+    def tearDown(self):
+        Snippet.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def assertRevalidates(self, url, last_modified=True):
+        res = self.client.get(url)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.has_header('ETag'))
+        self.assertEqual(res.has_header('Last-Modified'), last_modified)
+
+        with self.assertNumQueries(1):
+            cached = self.client.get(url, HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(cached.status_code, 304)
+
+        if last_modified:
+            cached = self.client.get(url, HTTP_IF_MODIFIED_SINCE=res['Last-Modified'])
+            self.assertEqual(cached.status_code, 304)
+        return res['ETag']
+
+    def testDetail(self):
+        url = reverse('snippet-detail', args=[self.snippet.pk])
+        etag = self.assertRevalidates(url)
+
+        self.snippet.title = "renamed"
+        self.snippet.save()
+
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res['ETag'], etag)
+
+    def testHighlight(self):
+        url = reverse('snippet-highlight', args=[self.snippet.pk])
+        etag = self.assertRevalidates(url)
+
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=etag, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("Accept-Encoding", res['Vary'])
+
+    def testList(self):
+        url = reverse('snippet-list')
+        etag = self.assertRevalidates(url, last_modified=False)
+
+        Snippet.objects.create(code="print(2)", owner=self.owner)
+
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+
+    def testListDelete(self):
+        Snippet.objects.create(code="print(2)", owner=self.owner)
+        url = reverse('snippet-list')
+        etag = self.client.get(url)['ETag']
+
+        self.snippet.delete()
+
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        res = self.client.get(url, HTTP_IF_MODIFIED_SINCE=http_date(time.time()))
+        self.assertEqual(res.status_code, 200)
+
+    def testVersionBump(self):
+        version = self.snippet.version
+
+        self.snippet.save(update_fields=["title"])
+
+        self.snippet.refresh_from_db()
+        self.assertEqual(self.snippet.version, version + 1)
+
+class SnippetBulkCreateTest(TestCase):
+    def setUp(self):
+        highlighting.get_memory_cache().clear()
+        self.owner = ExtendedUser.objects.create_user(username="owner", password="1234")
+        self.client.force_login(self.owner)
+        self.url = reverse('snippet-bulk')
+
+    def tearDown(self):
+        Snippet.objects.all().delete()
+        Audit.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def post(self, items):
+        return self.client.post(self.url, items, content_type="application/json")
+
+    def testBulkCreate(self):
+        items = [{"code": "print(%d)" % i, "language": "python"} for i in range(6)]
+
+        with mock.patch.object(highlighting, "get_pool", return_value=InlinePool()) as get_pool:
+            res = self.post(items)
+
+        self.assertEqual(res.status_code, 201)
+        get_pool.assert_called()
+        self.assertEqual(Snippet.objects.filter(owner=self.owner).count(), 6)
+        self.assertEqual(Audit.objects.filter(model_name="Snippet", action="create").count(), 6)
+        snippet = Snippet.objects.get(pk=res.data['results'][5]['id'])
+        self.assertEqual(snippet.code, "print(5)")
+        self.assertIn("print", snippet.highlighted)
+
+    def testBulkCreateSingleQuery(self):
+        items = [{"code": "print(%d)" % i} for i in range(3)]
+
+        with CaptureQueriesContext(connection) as queries:
+            self.post(items)
+
+        inserts = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('INSERT INTO "snippets_snippet"')]
+        self.assertEqual(len(inserts), 1)
+
+    def testPerItemErrors(self):
+        items = [{"code": "a"}, {"language": "python"}, {"code": "b", "language": "nope"}, {"code": "c"}]
+
+        res = self.post(items)
+
+        self.assertEqual(res.status_code, 207)
+        results = res.data['results']
+        self.assertIn("id", results[0])
+        self.assertIn("code", results[1]['errors'])
+        self.assertIn("language", results[2]['errors'])
+        self.assertIn("id", results[3])
+        self.assertEqual(Snippet.objects.count(), 2)
+
+    def testAllInvalid(self):
+        res = self.post([{"language": "python"}])
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(Snippet.objects.count(), 0)
+
+    def testNotAList(self):
+        res = self.post({"code": "a"})
+
+        self.assertEqual(res.status_code, 400)
+
+    def testNotAuth(self):
+        self.client.logout()
+
+        res = self.post([{"code": "a"}])
+
+        self.assertEqual(res.status_code, 401)
+
+class RehighlightCommandTest(TestCase):
+    def setUp(self):
+        highlighting.get_memory_cache().clear()
+        self.owner = ExtendedUser.objects.create_user(username="owner", password="1234")
+        self.snippets = [
+            Snippet.objects.create(code="print(%d)" % i, language="python" if i % 2 else "ruby", owner=self.owner)
+            for i in range(5)
+        ]
+        Snippet.objects.update(highlighted="stale")
+        self.checkpoint = os.path.join(tempfile.mkdtemp(), "checkpoint.json")
+
+    def tearDown(self):
+        Snippet.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def rehighlight(self, *args):
+        out = StringIO()
+        call_command("rehighlight", "--workers=0", "--batch-size=2", "--checkpoint", self.checkpoint, *args, stdout=out)
+        return out.getvalue()
+
+    def testRehighlightAll(self):
+        audits = Audit.objects.count()
+
+        out = self.rehighlight()
+
+        self.assertIn("Re-highlighted 5 snippets", out)
+        self.assertFalse(Snippet.objects.filter(highlighted="stale").exists())
+        self.assertEqual(Audit.objects.count(), audits)
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.assertEqual(Snippet.objects.get(pk=self.snippets[0].pk).version, 2)
+
+    def testConcurrentEdit(self):
+        command = rehighlight.Command(stdout=StringIO())
+        batch = list(Snippet.objects.filter(pk=self.snippets[1].pk).only("id", "version", *highlighting.RENDER_FIELDS))
+        edited = Snippet.objects.get(pk=self.snippets[1].pk)
+        edited.code = "print('edited')"
+        edited.save()
+
+        skipped = command.write(batch, {"cached": False, "pool": None, "parallel": False})
+
+        edited.refresh_from_db()
+        self.assertEqual(skipped, 1)
+        self.assertIn("edited", edited.highlighted)
+        self.assertEqual(edited.version, 2)
+
+    def testOneUpdatePerBatch(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.rehighlight()
+
+        updates = [query for query in queries if query["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 3)
+        self.assertEqual(Snippet.objects.filter(highlighted="stale").count(), 0)
+
+    @override_settings(SNIPPETS_COMPRESSED_STORAGE=True)
+    def testRehighlightCompressed(self):
+        self.rehighlight()
+
+        raw = Snippet.objects.filter(pk=self.snippets[0].pk).annotate(
+            raw=Substr("highlighted", 1, compression.HEADER_SIZE, output_field=BinaryField())
+        ).values_list("raw", flat=True).get()
+        self.assertIsNotNone(compression.parse_header(raw))
+        snippet = Snippet.objects.get(pk=self.snippets[0].pk)
+        self.assertIn("print", snippet.highlighted)
+
+    def testRehighlightFiltered(self):
+        self.rehighlight("--language=ruby")
+
+        self.assertEqual(Snippet.objects.filter(highlighted="stale").count(), 2)
+
+    def testResume(self):
+        with open(self.checkpoint, "w") as checkpoint:
+            json.dump({"filters": {"language": None, "owner": None, "status": None}, "last_pk": self.snippets[2].pk, "done": 3}, checkpoint)
+
+        out = self.rehighlight("--resume")
+
+        self.assertIn("Re-highlighted 5 snippets", out)
+        self.assertEqual(Snippet.objects.filter(highlighted="stale").count(), 3)
+
+    def testResumeWithOtherFilters(self):
+        with open(self.checkpoint, "w") as checkpoint:
+            json.dump({"filters": {"language": ["go"], "owner": None, "status": None}, "last_pk": 0, "done": 0}, checkpoint)
+
+        with self.assertRaises(CommandError):
+            self.rehighlight("--resume")
+
+class UserSnippetsTest(TestCase):
+    def setUp(self):
+        self.owner = ExtendedUser.objects.create_user(username="owner", password="1234")
+        self.snippets = [Snippet.objects.create(code="print(%d)" % i, owner=self.owner) for i in range(3)]
+
+    def tearDown(self):
+        Snippet.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def testSnippetCount(self):
+        self.snippets[0].delete()
+        self.client.force_login(self.owner)
+        self.client.post(reverse('snippet-bulk'), [{"code": "a"}, {"code": "b"}], content_type="application/json")
+
+        self.owner.refresh_from_db()
+        self.assertEqual(self.owner.snippet_count, 4)
+
+    def testStaleSaveKeepsCount(self):
+        Snippet.objects.create(code="late", owner=self.owner)
+
+        self.owner.first_name = "Owner"
+        self.owner.save()
+
+        self.owner.refresh_from_db()
+        self.assertEqual(self.owner.snippet_count, 4)
+        self.assertEqual(self.owner.first_name, "Owner")
+
+    def testOwnerChangeMovesCount(self):
+        other = ExtendedUser.objects.create_user(username="other", password="1234")
+        snippet = Snippet.objects.get(pk=self.snippets[0].pk)
+
+        snippet.owner = other
+        snippet.save()
+        snippet.save()
+
+        self.owner.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(self.owner.snippet_count, 2)
+        self.assertEqual(other.snippet_count, 1)
+
+    def testUserLinks(self):
+        res = self.client.get(reverse('extendeduser-detail', args=[self.owner.pk]))
+
+        self.assertEqual(res.data['snippet_count'], 3)
+        self.assertTrue(res.data['snippets_url'].endswith(reverse('user-snippets', args=[self.owner.pk])))
+        self.assertNotIn('snippets', res.data)
+
+    def testExpandSnippets(self):
+        res = self.client.get(reverse('user-list'), {"expand": "snippets"})
+
+        self.assertEqual(len(res.data['results'][0]['snippets']), 3)
+
+    def testUserSnippetList(self):
+        other = ExtendedUser.objects.create_user(username="other", password="1234")
+        Snippet.objects.create(code="other", owner=other)
+
+        res = self.client.get(reverse('user-snippets', args=[self.owner.pk]))
+
+        self.assertEqual(res.data['count'], 3)
+        self.assertEqual([entry['id'] for entry in res.data['results']], [snippet.pk for snippet in self.snippets])
+
+    def testUserSnippetListHidden(self):
+        self.owner.soft_delete()
+        self.owner.save()
+
+        res = self.client.get(reverse('user-snippets', args=[self.owner.pk]))
+
+        self.assertEqual(res.status_code, 404)
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class QueryBudgetTest(TestCase):
+    """
+    Requests every route with N users, snippets and audits seeded for
+    several N. The number of queries per request must stay the same as N
+    grows and within the route's budget. Set QUERY_BUDGET_REPORT=1 to print
+    the query counts and wall times.
+    """
+    SIZES = (1, 5, 25)
+    # Route -> (method, path, maximum queries). Sessions and their users
+    # come from the cache, so session-authenticated GETs start at zero.
+    ROUTES = {
+        "api-root": ("get", "/", 0),
+        "snippet-list": ("get", "/snippets/", 3),
+        "snippet-detail": ("get", "/snippets/{snippet}/", 2),
+        "snippet-highlight": ("get", "/snippets/{snippet}/highlight/", 3),
+        "snippet-bulk": ("post", "/snippets/bulk/", 6),
+        "user-list": ("get", "/users/", 2),
+        "extendeduser-detail": ("get", "/users/{user}/", 1),
+        "user-expanded": ("get", "/users/?expand=snippets", 3),
+        "user-snippets": ("get", "/users/{user}/snippets/", 3),
+        "session": ("post", "/session/", 5),
+        "token": ("post", "/token/", 3),
+        "signed-token": ("post", "/token/signed/", 1),
+        "signed-token-refresh": ("post", "/token/refresh/", 1),
+        "audit-list": ("get", "/audits/", 1),
+        "audit-detail": ("get", "/audits/{audit}/", 1),
+        "audit-rollups": ("get", "/audits/rollups/", 2),
+        "audit-export": ("get", "/audits/export/?export_format=csv", 1),
+        "audit-archive": ("get", "/audits/archive/", 0),
+        "audit-archive-detail": ("get", "/audits/archive/2020-01-01/", 0),
+        "audit-history": ("get", "/audits/Snippet/{snippet}/history/", 1),
+        "audit-filtered": ("get", "/audits/?model=Snippet&action=update&since=2000-01-01T00:00:00", 1),
+        "highlight-cache": ("get", "/highlight-cache/", 1),
+        "snippet-style": ("get", "/styles/default.css", 0),
+    }
+
+    def setUp(self):
+        highlighting.get_memory_cache().clear()
+        self.admin = ExtendedUser.objects.create_user(username="admin", password="1234", is_staff=True)
+        self.client.force_login(self.admin)
+        self.snippet = Snippet.objects.create(code="print(0)", owner=self.admin)
+        self.audit = Audit.objects.filter(user=None).first()
+        self.seeded = 0
+        settings = override_settings(SNIPPETS_AUDIT_ARCHIVE_DIR=tempfile.mkdtemp())
+        settings.enable()
+        self.addCleanup(settings.disable)
+        archive.write_partition(datetime.date(2020, 1, 1), [
+            {"id": 1, "model_name": "Snippet", "object_id": "1", "action": "create",
+             "timestamp": "2020-01-01T10:00:00Z", "user_id": None, "user__username": None, "changes": None},
+        ])
+
+    def tearDown(self):
+        Snippet.objects.all().delete()
+        Audit.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def seed(self, n):
+        # Bulk inserts skip the audit signals and the per-row renders.
+        users = ExtendedUser.objects.bulk_create(
+            ExtendedUser(username="user%d" % i, snippet_count=1) for i in range(self.seeded, n)
+        )
+        Snippet.objects.bulk_create(
+            Snippet(code="print(%d)" % i, highlighted="<pre>print</pre>", highlight_status="ready", owner=user)
+            for i, user in enumerate(users)
+        )
+        Audit.objects.bulk_create(
+            Audit(model_name="Snippet", object_id=str(self.snippet.pk), action="update", user=user)
+            for user in users
+        )
+        self.seeded = n
+
+    def request(self, method, path):
+        path = path.format(snippet=self.snippet.pk, user=self.admin.pk, audit=self.audit.pk)
+        if path == "/snippets/bulk/":
+            return self.client.post(path, [{"code": "a"}, {"code": "b"}], content_type="application/json")
+        if path == "/token/refresh/":
+            return self.client.post(path, {"refresh": tokens.issue(self.admin)["refresh"]})
+        if method == "post":
+            return self.client.post(path, {"username": "admin", "password": "1234"})
+        return self.client.get(path)
+
+    def testQueryBudgets(self):
+        counts, report = {}, []
+        # The first token and bulk requests also create rows later ones reuse.
+        for method, path, budget in self.ROUTES.values():
+            self.request(method, path)
+        for n in self.SIZES:
+            self.seed(n)
+            for name, (method, path, budget) in self.ROUTES.items():
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    res = self.request(method, path)
+                    if res.streaming:
+                        b"".join(res.streaming_content)
+                    elapsed = time.perf_counter() - started
+                self.assertLess(res.status_code, 400, name)
+                counts.setdefault(name, []).append(len(queries))
+                report.append("%-18s N=%-4d %3d queries %8.2f ms" % (name, n, len(queries), elapsed * 1000))
+
+        if os.environ.get("QUERY_BUDGET_REPORT"):
+            print("\n" + "\n".join(report))
+        for name, seen in counts.items():
+            with self.subTest(route=name):
+                self.assertEqual(len(set(seen)), 1, "query count grows with N: %s" % seen)
+                self.assertLessEqual(seen[0], self.ROUTES[name][2])
+
+    def testEveryRouteHasBudget(self):
+        names = {pattern.name for pattern in get_resolver("snippets.urls").url_patterns}
+
+        self.assertEqual(names - set(self.ROUTES), set())
+
+class CachedTokenAuthenticationTest(TestCase):
+    def setUp(self):
+        authentication.get_token_cache().clear()
+        self.user = ExtendedUser.objects.create_user(username="client", password="1234")
+        self.token = Token.objects.create(user=self.user)
+        self.staff = ExtendedUser.objects.create_user(username="staff1", password="1234", is_staff=True)
+
+    def tearDown(self):
+        Token.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def get(self):
+        return self.client.get(reverse('snippet-list'), HTTP_AUTHORIZATION="Token %s" % self.token.key)
+
+    def token_queries(self, queries):
+        return [q for q in queries.captured_queries if "authtoken_token" in q['sql']]
+
+    def testCached(self):
+        self.assertEqual(self.get().status_code, 200)
+
+        with CaptureQueriesContext(connection) as queries:
+            res = self.get()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.token_queries(queries), [])
+
+    def testExpires(self):
+        self.get()
+
+        with mock.patch("snippets.cache.time.monotonic", return_value=time.monotonic() + 3600):
+            with CaptureQueriesContext(connection) as queries:
+                self.get()
+
+        self.assertEqual(len(self.token_queries(queries)), 1)
+
+    def testTokenDeleted(self):
+        self.get()
+
+        self.token.delete()
+
+        self.assertEqual(self.get().status_code, 401)
+
+    def testTokenDeletedInOtherProcess(self):
+        key = self.token.key
+        self.get()
+        entry = authentication.get_token_cache().get(key)
+
+        self.token.delete()
+        # This process still holds the entry, as another worker would.
+        authentication.get_token_cache().set(key, entry)
+
+        res = self.client.get(reverse('snippet-list'), HTTP_AUTHORIZATION="Token %s" % key)
+        self.assertEqual(res.status_code, 401)
+
+    def testUserSoftDeletedInOtherProcess(self):
+        self.get()
+        entry = authentication.get_token_cache().get(self.token.key)
+
+        self.user.soft_delete()
+        self.user.save()
+        authentication.get_token_cache().set(self.token.key, entry)
+
+        self.assertEqual(self.get().status_code, 401)
+
+    def testUserSoftDeleted(self):
+        self.get()
+        self.client.force_login(self.staff)
+        self.client.delete(reverse('extendeduser-detail', args=[self.user.pk]))
+        self.client.logout()
+
+        self.assertEqual(self.get().status_code, 401)
+
+class SignedTokenTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = ExtendedUser.objects.create_user(username="client", password="1234")
+        self.staff = ExtendedUser.objects.create_user(username="staff1", password="1234", is_staff=True)
+
+    def tearDown(self):
+        Snippet.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+        cache.clear()
+
+    def obtain(self, username="client"):
+        res = self.client.post(reverse('signed-token'), {"username": username, "password": "1234"})
+        self.assertEqual(res.status_code, 200)
+        return res.data
+
+    def bearer(self, access):
+        return {"HTTP_AUTHORIZATION": "Bearer %s" % access}
+
+    def testNoQueries(self):
+        access = self.obtain()['access']
+
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get("/", **self.bearer(access))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(queries), 0)
+
+    def testCreateSnippet(self):
+        access = self.obtain()['access']
+
+        res = self.client.post(reverse('snippet-list'), {"code": "print(1)"}, **self.bearer(access))
+
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(Snippet.objects.get().owner, self.user)
+        self.assertEqual(ExtendedUser.objects.get(pk=self.user.pk).username, "client")
+
+    def testStaffClaim(self):
+        access = self.obtain("staff1")['access']
+
+        res = self.client.get(reverse('audit-list'), **self.bearer(access))
+
+        self.assertEqual(res.status_code, 200)
+
+    def testInvalid(self):
+        access = self.obtain()['access']
+
+        for token in (access[:-2] + "xx", self.obtain()['refresh']):
+            res = self.client.get(reverse('snippet-list'), **self.bearer(token))
+            self.assertEqual(res.status_code, 401)
+
+    def testExpired(self):
+        access = self.obtain()['access']
+
+        with mock.patch("django.core.signing.time.time", return_value=time.time() + 3600):
+            res = self.client.get(reverse('snippet-list'), **self.bearer(access))
+
+        self.assertEqual(res.status_code, 401)
+
+    def testRefresh(self):
+        pair = self.obtain()
+
+        res = self.client.post(reverse('signed-token-refresh'), {"refresh": pair['refresh']})
+        self.assertEqual(res.status_code, 200)
+        res = self.client.get(reverse('snippet-list'), **self.bearer(res.data['access']))
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client.post(reverse('signed-token-refresh'), {"refresh": pair['access']})
+        self.assertEqual(res.status_code, 401)
+
+    def testSoftDeleteRevokes(self):
+        pair = self.obtain()
+
+        self.user.soft_delete()
+        self.user.save()
+
+        res = self.client.get(reverse('snippet-list'), **self.bearer(pair['access']))
+        self.assertEqual(res.status_code, 401)
+        res = self.client.post(reverse('signed-token-refresh'), {"refresh": pair['refresh']})
+        self.assertEqual(res.status_code, 401)
+
+    def testStaffRemovedRevokes(self):
+        access = self.obtain("staff1")['access']
+
+        self.staff.is_staff = False
+        self.staff.save()
+
+        res = self.client.get(reverse('audit-list'), **self.bearer(access))
+        self.assertEqual(res.status_code, 401)
+        access = self.obtain("staff1")['access']
+        res = self.client.get(reverse('audit-list'), **self.bearer(access))
+        self.assertEqual(res.status_code, 403)
+
+    def testPasswordChangeRevokes(self):
+        pair = self.obtain()
+
+        self.user.set_password("5678")
+        self.user.save()
+
+        res = self.client.get(reverse('snippet-list'), **self.bearer(pair['access']))
+        self.assertEqual(res.status_code, 401)
+        res = self.client.post(reverse('signed-token-refresh'), {"refresh": pair['refresh']})
+        self.assertEqual(res.status_code, 401)
+
+    def testOtherChangesKeepTokens(self):
+        pair = self.obtain()
+
+        self.user.first_name = "Client"
+        self.user.save()
+        self.obtain()
+
+        res = self.client.get(reverse('snippet-list'), **self.bearer(pair['access']))
+        self.assertEqual(res.status_code, 200)
+
+    @override_settings(SNIPPETS_SHARED_CACHE="default")
+    def testLocalSharedCacheCheck(self):
+        errors = apps.check_shared_cache(None)
+
+        self.assertEqual([error.id for error in errors], ["snippets.E001"])
+
+    def testSessionLogin(self):
+        res = self.client.post("/session/", {"username": "client", "password": "1234"})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("access", res.data)
+        self.assertEqual(self.client.get(reverse('snippet-list')).status_code, 200)
+
+class SessionUserCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        authentication.get_user_cache().clear()
+        self.user = ExtendedUser.objects.create_user(username="client", password="1234")
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        ExtendedUser.objects.all().delete()
+        cache.clear()
+
+    def testNoQueries(self):
+        self.client.get("/")
+
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get("/")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(queries), 0)
+
+    def testStaffFlagChange(self):
+        self.assertEqual(self.client.get(reverse('audit-list')).status_code, 403)
+
+        self.user.is_staff = True
+        self.user.save()
+
+        self.assertEqual(self.client.get(reverse('audit-list')).status_code, 200)
+
+    def testLogoutInOtherProcess(self):
+        session_key = self.client.session.session_key
+        self.assertTrue(self.cached_in_other_process(session_key))
+
+        self.client.logout()
+
+        self.assertFalse(self.cached_in_other_process(session_key))
+
+    def cached_in_other_process(self, session_key):
+        # A fresh interpreter shares nothing with this one but the caches.
+        script = (
+            "import django; django.setup()\n"
+            "from django.contrib.sessions.backends.cached_db import SessionStore\n"
+            "store = SessionStore(%r)\n"
+            "print(store._cache.get(store.cache_key) is not None)\n" % session_key
+        )
+        env = {
+            **os.environ,
+            "DJANGO_SETTINGS_MODULE": "tutorial.settings",
+            "SNIPPETS_SHARED_CACHE_DIR": str(settings.CACHES["shared"]["LOCATION"]),
+        }
+        output = subprocess.run(
+            [sys.executable, "-c", script], env=env, cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout
+        return output.strip() == "True"
+
+    def testStaffFlagChangeInOtherProcess(self):
+        self.client.get("/")
+        entry = authentication.get_user_cache().get(self.user.pk)
+
+        self.user.is_staff = True
+        self.user.save()
+        authentication.get_user_cache().set(self.user.pk, entry)
+
+        self.assertEqual(self.client.get(reverse('audit-list')).status_code, 200)
+
+    def testSoftDelete(self):
+        self.client.get("/")
+
+        self.user.soft_delete()
+        self.user.save()
+
+        res = self.client.post(reverse('snippet-list'), {"code": "print(1)"})
+        self.assertEqual(res.status_code, 401)
+        self.assertFalse(self.client.login(username="client", password="1234"))
+
+class SqliteProfileTest(TestCase):
+    def tearDown(self):
+        Snippet.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def testNoProfile(self):
+        self.assertEqual(db.pragmas(), {})
+        with override_settings(SNIPPETS_SQLITE_PROFILE="fast"):
+            with self.assertRaises(ImproperlyConfigured):
+                db.pragmas()
+
+    @override_settings(SNIPPETS_SERIALIZE_WRITES=True)
+    def testWriteLock(self):
+        acquired = threading.Event()
+
+        def writer():
+            with db.write_lock():
+                acquired.set()
+
+        with db.write_lock():
+            with db.write_lock():
+                thread = threading.Thread(target=writer)
+                thread.start()
+                self.assertFalse(acquired.wait(0.1))
+        thread.join()
+        self.assertTrue(acquired.is_set())
+
+    def testWriteLockFile(self):
+        path = os.path.join(tempfile.mkdtemp(), "write.lock")
+
+        with override_settings(SNIPPETS_SERIALIZE_WRITES=True, SNIPPETS_WRITE_LOCK_FILE=path):
+            with db.write_lock():
+                with db.write_lock():
+                    self.assertTrue(os.path.exists(path))
+
+
+
+class WriteTransactionTest(TransactionTestCase):
+    def tearDown(self):
+        Snippet.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def testPragmas(self):
+        # Some pragmas cannot run inside the transaction of a TestCase.
+        with override_settings(SNIPPETS_SQLITE_PROFILE="production"):
+            db.configure_sqlite(None, connection)
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(cursor.fetchone()[0], 5000)
+            cursor.execute("PRAGMA cache_size")
+            self.assertEqual(cursor.fetchone()[0], -64 * 1024)
+
+    def testBeginImmediate(self):
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                ExtendedUser.objects.create_user(username="owner", password="1234")
+
+        self.assertEqual(queries.captured_queries[0]['sql'], "BEGIN IMMEDIATE")
+
+    @override_settings(SNIPPETS_SERIALIZE_WRITES=True)
+    def testTransactionHoldsWriteLock(self):
+        acquired = threading.Event()
+
+        def writer():
+            with db.write_lock():
+                acquired.set()
+
+        with transaction.atomic():
+            ExtendedUser.objects.create_user(username="owner", password="1234")
+            thread = threading.Thread(target=writer)
+            thread.start()
+            self.assertFalse(acquired.wait(0.1))
+        thread.join()
+        self.assertTrue(acquired.is_set())
+
+    @override_settings(SNIPPETS_SERIALIZE_WRITES=True)
+    def testRollbackReleasesWriteLock(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                ExtendedUser.objects.create_user(username="owner", password="1234")
+                raise RuntimeError
+
+        self.assertEqual(db._local.depth, 0)
+
+
+@override_settings(SNIPPETS_READ_REPLICAS=["replica"])
+class ReplicaRoutingTest(TestCase):
+    def setUp(self):
+        self.user = ExtendedUser.objects.create_user(username="test", password="12345")
+        self.snippet = Snippet.objects.create(owner=self.user, code="print(1)")
+
+    def tearDown(self):
+        cache.clear()
+        shared_cache().clear()
+        Token.objects.all().delete()
+        Snippet.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def testRouter(self):
+        router = routers.ReplicaRouter()
+        self.assertIsNone(router.db_for_read(Snippet))
+        with routers.reading_from("replica"):
+            self.assertEqual(router.db_for_read(Snippet), "replica")
+            self.assertEqual(router.db_for_write(Snippet), "default")
+        self.assertIsNone(router.db_for_read(Snippet))
+        self.assertFalse(router.allow_migrate("replica", "snippets"))
+        self.assertIsNone(router.allow_migrate("default", "snippets"))
+
+    def testUnsyncedReplicaUnused(self):
+        path = os.path.join(tempfile.mkdtemp(), "missing.sqlite3")
+        with mock.patch.object(routers, "replica_path", return_value=path):
+            self.assertIsNone(routers.choose_replica())
+        # Test databases are in memory, which has nothing to read from.
+        self.assertIsNone(routers.replica_path("default"))
+
+    def testLaggingReplicaUnused(self):
+        path = os.path.join(tempfile.mkdtemp(), "replica.sqlite3")
+        open(path, "w").close()
+        with mock.patch.object(routers, "replica_path", return_value=path):
+            self.assertEqual(routers.choose_replica(), "replica")
+            synced = time.time() - 60
+            os.utime(path, (synced, synced))
+            self.assertIsNone(routers.choose_replica())
+            with override_settings(SNIPPETS_REPLICA_MAX_LAG=None):
+                self.assertEqual(routers.choose_replica(), "replica")
+
+    def testListReadsReplica(self):
+        with mock.patch.object(routers, "choose_replica", return_value="default") as choose:
+            self.assertEqual(self.client.get(reverse("snippet-list")).status_code, 200)
+            self.assertEqual(self.client.get(reverse("user-list")).status_code, 200)
+        self.assertEqual(choose.call_count, 2)
+
+    def testStickyAfterWrite(self):
+        self.client.force_login(self.user)
+        with mock.patch.object(routers, "choose_replica", return_value="default") as choose:
+            self.client.get(reverse("snippet-list"))
+            self.assertEqual(choose.call_count, 1)
+            response = self.client.post(reverse("snippet-list"), {"code": "x = 2"})
+            self.assertEqual(response.status_code, 201)
+            self.client.get(reverse("snippet-list"))
+            self.assertEqual(choose.call_count, 1)
+            self.assertNotIn(routers.STICKY_COOKIE, response.cookies)
+
+            # The window ends SNIPPETS_REPLICA_STICKY_SECONDS after the write.
+            with mock.patch.object(routers.time, "time", return_value=time.time() + 11):
+                self.client.get(reverse("snippet-list"))
+            self.assertEqual(choose.call_count, 2)
+
+    def testStickyWithoutCookies(self):
+        # API clients authenticate with a token and usually keep no cookies.
+        headers = {"HTTP_AUTHORIZATION": "Token %s" % Token.objects.create(user=self.user).key}
+        with mock.patch.object(routers, "choose_replica", return_value="default") as choose:
+            response = Client().post(reverse("snippet-list"), {"code": "x = 2"}, **headers)
+            self.assertEqual(response.status_code, 201)
+            Client().get(reverse("snippet-list"), **headers)
+            self.assertEqual(choose.call_count, 0)
+
+            Client().get(reverse("snippet-list"))
+            self.assertEqual(choose.call_count, 1)
+
+    def testStickyAnonymous(self):
+        with mock.patch.object(routers, "choose_replica", return_value="default") as choose:
+            response = self.client.post("/token/", {"username": "test", "password": "12345"})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(routers.STICKY_COOKIE, response.cookies)
+            self.client.get(reverse("snippet-list"))
+            self.assertEqual(choose.call_count, 0)
+
+            # The window ends with the deadline in the cookie.
+            with mock.patch.object(routers.time, "time", return_value=time.time() + 11):
+                self.client.get(reverse("snippet-list"))
+            self.assertEqual(choose.call_count, 1)
+
+            # A cookie that was not signed by the server is ignored.
+            self.client.cookies[routers.STICKY_COOKIE] = str(time.time() + 60)
+            self.client.get(reverse("snippet-list"))
+            self.assertEqual(choose.call_count, 2)
+
+    def testStreamingReadsReplica(self):
+        def content():
+            yield routers._reading_from.get()
+            yield routers._reading_from.get()
+
+        self.assertEqual(
+            list(routers.iter_reading_from("replica", content())),
+            ["replica", "replica"],
+        )
+        self.assertIsNone(routers._reading_from.get())
+
+
+class SyncReplicaTest(TransactionTestCase):
+    # The backup waits for open transactions, so this cannot run in one.
+    def tearDown(self):
+        Snippet.objects.all().delete()
+        ExtendedUser.objects.all().delete()
+
+    def testSyncReplica(self):
+        user = ExtendedUser.objects.create_user(username="test", password="12345")
+        Snippet.objects.create(owner=user, code="print(1)")
+        path = os.path.join(tempfile.mkdtemp(), "replica.sqlite3")
+        with mock.patch.object(routers, "replica_path", return_value=path):
+            with mock.patch.object(time, "time", return_value=1600000000.0):
+                call_command("sync_replica", "--database", "default", stdout=StringIO())
+        # Dated to the start of the backup rather than the swap.
+        self.assertEqual(os.path.getmtime(path), 1600000000.0)
+        replica = sqlite3.connect(path)
+        try:
+            tables = [row[0] for row in replica.execute("SELECT name FROM sqlite_master")]
+            self.assertIn("snippets_snippet", tables)
+            count = replica.execute("SELECT COUNT(*) FROM snippets_snippet").fetchone()[0]
+            self.assertEqual(count, 1)
+            journal_mode = replica.execute("PRAGMA journal_mode").fetchone()[0]
+            self.assertEqual(journal_mode, "delete")
+        finally:
+            replica.close()
+
+    def testSyncMemoryReplica(self):
+        with self.assertRaises(CommandError):
+            call_command("sync_replica", "--database", "default", stdout=StringIO())
+
+    def testNoReplicas(self):
+        with self.assertRaisesMessage(CommandError, "No read replicas"):
+            call_command("sync_replica", stdout=StringIO())
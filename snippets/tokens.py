@@ -0,0 +1,175 @@
+"""
+Stateless signed access and refresh tokens.
+
+Tokens are `django.core.signing` payloads signed with
+`SNIPPETS_SIGNED_TOKEN_KEY`, or `SECRET_KEY` when unset. Access tokens
+carry enough claims to authenticate without a database query and live
+for `SNIPPETS_ACCESS_TOKEN_TTL` seconds. Refresh tokens live for
+`SNIPPETS_REFRESH_TOKEN_TTL` seconds and are exchanged for a new pair
+after the user, and a fragment of their password hash, are checked
+against the database.
+
+When a claimed field, the password, `is_active` or `is_deleted` of a
+user changes, or the user is deleted, the time is put on a revocation
+list in the shared cache, see `cache.shared_cache`, until the access
+tokens issued before it have expired.
+"""
+import time
+
+from django.conf import settings
+from django.core import signing
+from django.db import router
+from django.db.models.signals import post_delete, post_init, post_save
+from django.utils.crypto import constant_time_compare
+
+from .cache import changed_since, stamp
+
+ACCESS_SALT = "snippets.tokens.access"
+REFRESH_SALT = "snippets.tokens.refresh"
+# Claims copied into access tokens, and the user fields they stand for.
+CLAIMS = {
+    "uid": "id",
+    "usr": "username",
+    "stf": "is_staff",
+    "su": "is_superuser",
+}
+# User fields whose change revokes the access tokens issued so far.
+REVOKING_FIELDS = ("username", "is_staff", "is_superuser", "password", "is_active", "is_deleted")
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def signing_key():
+    return getattr(settings, "SNIPPETS_SIGNED_TOKEN_KEY", None) or settings.SECRET_KEY
+
+
+def access_ttl():
+    return getattr(settings, "SNIPPETS_ACCESS_TOKEN_TTL", 300)
+
+
+def refresh_ttl():
+    return getattr(settings, "SNIPPETS_REFRESH_TOKEN_TTL", 14 * 24 * 3600)
+
+
+def issue(user):
+    """
+    A new access and refresh token pair for `user`.
+    """
+    claims = {claim: getattr(user, field) for claim, field in CLAIMS.items()}
+    claims["iat"] = time.time()
+    refresh_claims = {"uid": user.pk, "pwd": password_fragment(user)}
+    return {
+        "access": signing.dumps(claims, key=signing_key(), salt=ACCESS_SALT),
+        "refresh": signing.dumps(refresh_claims, key=signing_key(), salt=REFRESH_SALT),
+        "expires_in": access_ttl(),
+    }
+
+
+def password_fragment(user):
+    # Like the session auth hash, so a password change ends the refreshes.
+    return user.get_session_auth_hash()[:16]
+
+
+def _load(token, salt, max_age):
+    try:
+        return signing.loads(token, key=signing_key(), salt=salt, max_age=max_age)
+    except signing.SignatureExpired:
+        raise InvalidToken("Token expired.")
+    except signing.BadSignature:
+        raise InvalidToken("Invalid token.")
+
+
+def verify_access(token):
+    """
+    The user an access token was issued to, built from its claims without
+    a query. Only the claimed fields are loaded, others are read from the
+    database on access, and saving the user writes only the loaded ones.
+    """
+    from .models import ExtendedUser
+
+    claims = _load(token, ACCESS_SALT, access_ttl())
+    if is_revoked(claims["uid"], claims.get("iat", 0)):
+        raise InvalidToken("Token revoked.")
+    loaded = {field: claims[claim] for claim, field in CLAIMS.items()}
+    loaded.update(is_active=True, is_deleted=False)
+    # `from_db` takes the values in model field order.
+    fields = [
+        field.attname
+        for field in ExtendedUser._meta.concrete_fields
+        if field.attname in loaded
+    ]
+    user = ExtendedUser.from_db(
+        router.db_for_read(ExtendedUser), fields, [loaded[field] for field in fields]
+    )
+    return user, claims
+
+
+def refresh(token):
+    """
+    A new token pair for a refresh token whose user may still sign in.
+    """
+    from .models import ExtendedUser
+
+    claims = _load(token, REFRESH_SALT, refresh_ttl())
+    user = ExtendedUser.objects.filter(
+        pk=claims["uid"], is_active=True, is_deleted=False
+    ).first()
+    if user is None:
+        raise InvalidToken("User inactive or deleted.")
+    if not constant_time_compare(claims.get("pwd", ""), password_fragment(user)):
+        raise InvalidToken("Password changed.")
+    return issue(user)
+
+
+def _revoked_key(user_id):
+    return "snippets:tokens:revoked:%s" % user_id
+
+
+def is_revoked(user_id, issued):
+    """
+    Whether access tokens of `user_id` issued at `issued` were revoked.
+    """
+    return changed_since([_revoked_key(user_id)], issued)
+
+
+def revoke(user_id):
+    # Refresh tokens are checked against the database, so the entry only
+    # has to outlive the access tokens issued before it.
+    stamp(_revoked_key(user_id), access_ttl())
+
+
+def _revoking_values(user):
+    # Deferred fields are left out rather than loaded.
+    return {
+        field: user.__dict__[field] for field in REVOKING_FIELDS if field in user.__dict__
+    }
+
+
+def user_loaded(sender, instance, **kwargs):
+    instance._revoking_values = _revoking_values(instance)
+
+
+def user_saved(sender, instance, created, **kwargs):
+    values = _revoking_values(instance)
+    previous = getattr(instance, "_revoking_values", {})
+    instance._revoking_values = values
+    if created:
+        return
+    # A field that was not loaded before may have changed.
+    missing = object()
+    if any(previous.get(field, missing) != value for field, value in values.items()):
+        revoke(instance.pk)
+
+
+def user_deleted(sender, instance, **kwargs):
+    revoke(instance.pk)
+
+
+def connect():
+    from .models import ExtendedUser
+
+    post_init.connect(user_loaded, sender=ExtendedUser, dispatch_uid="signed-tokens")
+    post_save.connect(user_saved, sender=ExtendedUser, dispatch_uid="signed-tokens")
+    post_delete.connect(user_deleted, sender=ExtendedUser, dispatch_uid="signed-tokens")
@@ -5,6 +5,7 @@ from snippets import views
 
 urlpatterns = [
     path("snippets/", views.SnippetList.as_view(), name="snippet-list"),
+    path("snippets/bulk/", views.SnippetBulkCreate.as_view(), name="snippet-bulk"),
     path("snippets/<int:pk>/", views.SnippetDetail.as_view(), name="snippet-detail"),
     path(
         "snippets/<int:pk>/highlight/",
@@ -13,11 +14,34 @@ urlpatterns = [
     ),  
     path("users/", views.UserList.as_view(), name="user-list"),
     path("users/<int:pk>/", views.UserDetail.as_view(), name="extendeduser-detail"),
-    path("session/", views.login_user),
-    path('token/', obtain_auth_token),
+    path(
+        "users/<int:pk>/snippets/",
+        views.UserSnippetList.as_view(),
+        name="user-snippets",
+    ),
+    path("session/", views.login_user, name="session"),
+    path('token/', obtain_auth_token, name="token"),
+    path("token/signed/", views.signed_token, name="signed-token"),
+    path("token/refresh/", views.refresh_signed_token, name="signed-token-refresh"),
     path('audits/', views.AuditList.as_view(), name="audit-list"),
     path('audits/<int:pk>/', views.AuditDetail.as_view(), name="audit-detail"),
-    path("", views.api_root),
+    path("audits/export/", views.AuditExport.as_view(), name="audit-export"),
+    path("audits/rollups/", views.AuditRollupList.as_view(), name="audit-rollups"),
+    path("audits/archive/", views.AuditArchiveList.as_view(), name="audit-archive"),
+    path(
+        "audits/archive/<str:day>/",
+        views.AuditArchiveDetail.as_view(),
+        name="audit-archive-detail",
+    ),
+    path(
+        "audits/<str:model>/<str:pk>/history/",
+        views.AuditHistory.as_view(),
+        name="audit-history",
+    ),
+    path('highlight-cache/', views.HighlightCacheStats.as_view(), name="highlight-cache"),
+    path("", views.api_root, name="api-root"),
 ]
 
-urlpatterns = format_suffix_patterns(urlpatterns)
+urlpatterns = format_suffix_patterns(urlpatterns) + [
+    path("styles/<str:style>.css", views.snippet_style, name="snippet-style"),
+]
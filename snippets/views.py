@@ -1,21 +1,175 @@
+import csv
+import datetime
+import hashlib
+import json
+import re
+from itertools import chain
+from django.conf import settings
 from django.contrib.auth import authenticate, login
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import BinaryField, Count, Max, Prefetch, Sum
+from django.db.models.functions import Length, Substr
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date, quote_etag
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import require_GET
+import pygments
 from rest_framework import generics, permissions, renderers, viewsets, status
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
-from .models import ExtendedUser, Snippet, Audit
+from rest_framework.views import APIView
+from . import archive, audit, choices, compression, highlighting, streaming, tokens
+from .models import AuditActionField, AuditRollup, ExtendedUser, Snippet, Audit
+from .pagination import AuditCursorPagination, StreamPagination
+from .routers import ReplicaReadMixin
 from .permissions import IsOwnerOrReadOnly
-from .serializers import SnippetSerializer, UserSerializer, AuditSerializer
+from .serializers import (
+    ArchivedAuditSerializer,
+    AuditSerializer,
+    ExpandedUserSerializer,
+    SnippetSerializer,
+    UserSerializer,
+)
 
+re_accepts_gzip = re.compile(r"\bgzip\b")
 
-class SnippetHighlight(generics.GenericAPIView):
-    queryset = Snippet.objects.all()
+
+class ConditionalGetMixin:
+    """
+    Answers conditional GETs from `get_validators`, which should only run a
+    small query, so a 304 costs no serialization and no large-column reads.
+    """
+
+    def get_validators(self, request, *args, **kwargs):
+        """
+        Return `(etag_parts, last_modified)`, or `(None, None)` to answer
+        the request unconditionally, as by default.
+        """
+        return None, None
+
+    def get(self, request, *args, **kwargs):
+        parts, last_modified = self.get_validators(request, *args, **kwargs)
+        if parts is None:
+            return self.unconditional_get(request, *args, **kwargs)
+
+        parts = (request.accepted_renderer.format, *parts)
+        etag = quote_etag(hashlib.sha1(repr(parts).encode()).hexdigest())
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+        response = get_conditional_response(
+            request, etag=etag, last_modified=timestamp
+        )
+        if response is None:
+            response = self.unconditional_get(request, *args, **kwargs)
+        if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            response["ETag"] = etag
+            if timestamp is not None:
+                response["Last-Modified"] = http_date(timestamp)
+        return response
+
+    def unconditional_get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+
+class SnippetHighlight(ReplicaReadMixin, ConditionalGetMixin, generics.GenericAPIView):
+    # The large columns are only read once we know how to serve them.
+    queryset = Snippet.objects.defer("code", "highlighted").annotate(
+        highlighted_length=Length("highlighted"),
+        highlighted_header=Substr(
+            "highlighted", 1, compression.HEADER_SIZE, output_field=BinaryField()
+        ),
+    )
     renderer_classes = (renderers.StaticHTMLRenderer,)
 
+    def get_validators(self, request, *args, **kwargs):
+        row = (
+            Snippet.objects.filter(pk=kwargs["pk"])
+            .exclude(highlight_status=Snippet.HighlightStatus.PENDING)
+            .values_list("version", "updated")
+            .first()
+        )
+        if row is None:
+            return None, None
+        version, updated = row
+        # The stylesheet link and the content encoding are part of the page.
+        parts = ("highlight", kwargs["pk"], version, pygments.__version__, accepts_gzip(request))
+        return parts, updated
+
     def get(self, request, *args, **kwargs):
+        response = super().get(request, *args, **kwargs)
+        patch_vary_headers(response, ["Accept-Encoding"])
+        return response
+
+    def unconditional_get(self, request, *args, **kwargs):
         snippet = self.get_object()
-        return Response(snippet.highlighted)
+        if snippet.highlight_status == Snippet.HighlightStatus.PENDING:
+            if not highlighting.is_stalled(snippet):
+                # The background workers have not rendered this snippet yet.
+                return Response(
+                    "<p>Highlighting in progress.</p>",
+                    status=status.HTTP_202_ACCEPTED,
+                    headers={"Retry-After": "1"},
+                )
+            # The render was lost, e.g. with the process that scheduled it.
+            snippet.highlighted, snippet.highlight_status = (
+                highlighting.render_stalled(snippet)
+            )
+
+        stylesheet_url = "%s?v=%s" % (
+            reverse("snippet-style", args=[snippet.style]),
+            pygments.__version__,
+        )
+        head, tail = highlighting.document_parts(snippet.title, stylesheet_url)
+        row = Snippet.objects.filter(pk=snippet.pk)
+        header = compression.parse_header(snippet.highlighted_header)
+
+        if snippet.highlight_status == Snippet.HighlightStatus.FAILED:
+            body = streaming.escaped(streaming.iter_column(row, "code"))
+        elif snippet.highlight_status == Snippet.HighlightStatus.STREAMED:
+            body = streaming.render_lines(
+                streaming.iter_column(row, "code"), snippet.language, snippet.linenos
+            )
+        elif header is not None and accepts_gzip(request):
+            # Serve the stored compressed bytes as they are.
+            deflated = streaming.iter_raw(
+                row, "highlighted", start=compression.HEADER_SIZE + 1
+            )
+            response = StreamingHttpResponse(
+                compression.gzip_stream(head, deflated, *header, tail),
+                content_type="text/html; charset=utf-8",
+            )
+            response["Content-Encoding"] = "gzip"
+            return response
+        elif header is not None or snippet.highlighted_length > streaming.threshold():
+            body = streaming.iter_column(row, "highlighted")
+        else:
+            return Response(head + snippet.highlighted + tail)
+
+        return StreamingHttpResponse(
+            chain([head], body, [tail]), content_type="text/html; charset=utf-8"
+        )
+
+
+def accepts_gzip(request):
+    return bool(re_accepts_gzip.search(request.headers.get("Accept-Encoding", "")))
+
+
+# Stylesheet URLs carry the Pygments version, so they can be cached forever.
+@require_GET
+@cache_control(public=True, max_age=31536000, immutable=True)
+def snippet_style(request, style):
+    # Only the styles snippets can choose; Pygments would otherwise import
+    # any module named like the style.
+    if style not in dict(choices.style_choices()):
+        raise Http404("Unknown style.")
+    return HttpResponse(highlighting.stylesheet(style), content_type="text/css")
 
 
 @api_view(["GET", "POST"])
@@ -29,32 +183,166 @@ def api_root(request, format=None):
 
 @api_view(["POST"])
 def login_user(request):
+    """
+    Start a session, and return a signed token pair for API clients.
+    """
     username = request.data.get('username')
     password = request.data.get('password')
     auth_user = authenticate(username = username, password = password)
     if auth_user:
         e = login(request, auth_user)
-        return Response(status=200)
+        return Response(tokens.issue(auth_user), status=200)
     return Response(status=401)
 
-class SnippetList(generics.ListCreateAPIView):
-    queryset = Snippet.objects.all()
+@api_view(["POST"])
+@authentication_classes([])
+@permission_classes([permissions.AllowAny])
+def signed_token(request):
+    """
+    Exchange a username and password for a signed access and refresh token.
+    """
+    user = authenticate(
+        username=request.data.get('username'), password=request.data.get('password')
+    )
+    if user is None or user.is_deleted:
+        return Response(
+            {"message": "Invalid username or password."},
+            status=status.HTTP_401_UNAUTHORIZED
+        )
+    return Response(tokens.issue(user))
+
+@api_view(["POST"])
+@authentication_classes([])
+@permission_classes([permissions.AllowAny])
+def refresh_signed_token(request):
+    """
+    Exchange a refresh token for a new signed token pair.
+    """
+    try:
+        return Response(tokens.refresh(request.data.get('refresh', '')))
+    except tokens.InvalidToken as error:
+        return Response({"message": str(error)}, status=status.HTTP_401_UNAUTHORIZED)
+
+# Snippet representations show the owner's name but never the highlight.
+SNIPPET_QUERYSET = Snippet.objects.select_related("owner").defer("highlighted")
+
+
+class SnippetList(ReplicaReadMixin, ConditionalGetMixin, generics.ListCreateAPIView):
+    queryset = SNIPPET_QUERYSET
     serializer_class = SnippetSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)  
 
+    def get_validators(self, request, *args, **kwargs):
+        # Every write moves the latest `updated`, every delete the count.
+        stats = self.get_queryset().aggregate(count=Count("id"), updated=Max("updated"))
+        parts = ("snippets", stats["count"], stats["updated"], request.GET.urlencode())
+        # No Last-Modified, as deleting a snippet does not move it forward.
+        return parts, None
+
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
 
-class SnippetDetail(generics.RetrieveUpdateDestroyAPIView):
+class SnippetBulkCreate(generics.GenericAPIView):
+    """
+    Create a list of snippets in one request. Valid items are highlighted
+    in parallel and inserted with one `bulk_create`, invalid ones are
+    reported by their index.
+    """
     queryset = Snippet.objects.all()
     serializer_class = SnippetSerializer
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        items = request.data
+        limit = getattr(settings, "SNIPPETS_BULK_MAX_ITEMS", 500)
+        if not isinstance(items, list) or not items or len(items) > limit:
+            return Response(
+                {
+                    "message": "Expected a list of 1 to %d snippets." % limit
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        serializer = self.get_serializer(data=items, many=True)
+        if serializer.is_valid():
+            errors = {}
+            valid = list(enumerate(serializer.validated_data))
+        else:
+            errors = {index: error for index, error in enumerate(serializer.errors) if error}
+            valid = [
+                (index, serializer.child.run_validation(item))
+                for index, item in enumerate(items)
+                if index not in errors
+            ]
+
+        snippets = [Snippet(owner=request.user, **data) for _, data in valid]
+        Snippet.highlight_many(snippets)
+        with transaction.atomic():
+            Snippet.objects.bulk_create(snippets)
+            ExtendedUser.count_snippets(request.user.pk, len(snippets))
+            audit.write([
+                Audit(model_name="Snippet", object_id=snippet.pk, action="create", user=request.user)
+                for snippet in snippets
+            ])
+
+        results = [None] * len(items)
+        for index, error in errors.items():
+            results[index] = {"index": index, "errors": error}
+        for (index, _), snippet in zip(valid, snippets):
+            results[index] = {
+                "index": index,
+                "id": snippet.pk,
+                "url": reverse("snippet-detail", args=[snippet.pk], request=request),
+            }
+
+        if not errors:
+            response_status = status.HTTP_201_CREATED
+        elif snippets:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response({"results": results}, status=response_status)
+
+class SnippetDetail(ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
+    queryset = SNIPPET_QUERYSET
+    serializer_class = SnippetSerializer
     permission_classes = (
         permissions.IsAuthenticatedOrReadOnly,
         IsOwnerOrReadOnly,
     )  
 
-class UserList(generics.ListCreateAPIView):
-    serializer_class = UserSerializer
+    def get_validators(self, request, *args, **kwargs):
+        row = (
+            Snippet.objects.filter(pk=kwargs["pk"])
+            .values_list("version", "updated", "owner__username")
+            .first()
+        )
+        if row is None:
+            return None, None
+        version, updated, owner = row
+        return ("snippet", kwargs["pk"], version, owner), updated
+
+class ExpandableUserMixin:
+    """
+    Users carry their snippet count and a link to their snippets, the link
+    to every snippet is only listed with `?expand=snippets`.
+    """
+    def expands_snippets(self):
+        return self.request.GET.get("expand") == "snippets"
+
+    def get_serializer_class(self):
+        if self.expands_snippets():
+            return ExpandedUserSerializer
+        return UserSerializer
+
+    def with_snippet_links(self, queryset):
+        if not self.expands_snippets():
+            return queryset
+        # The snippet links only need the primary keys, fetched in one query.
+        snippets = Snippet.objects.only("id", "owner_id")
+        return queryset.prefetch_related(Prefetch("snippets", queryset=snippets))
+
+class UserList(ReplicaReadMixin, ExpandableUserMixin, generics.ListCreateAPIView):
 
     def get_queryset(self):
         is_staff = self.request.user.is_staff
@@ -64,7 +352,7 @@ class UserList(generics.ListCreateAPIView):
         if is_staff and show_deleted:
             queryset = ExtendedUser.objects.all()
 
-        return queryset
+        return self.with_snippet_links(queryset.order_by("id"))
     
     # Get a list of all users
     def get(self, request):
@@ -112,15 +400,13 @@ class UserList(generics.ListCreateAPIView):
             status=status.HTTP_201_CREATED
         )
 
-class UserDetail(generics.RetrieveDestroyAPIView):
-    serializer_class = UserSerializer
-
+class UserDetail(ExpandableUserMixin, generics.RetrieveDestroyAPIView):
     def get_queryset(self):
         is_staff = self.request.user.is_staff
         show_deleted = self.request.GET.get('show_deleted')
         if is_staff and show_deleted:
-            return ExtendedUser.objects.all()
-        return ExtendedUser.objects.filter(is_deleted=False)
+            return self.with_snippet_links(ExtendedUser.objects.all())
+        return self.with_snippet_links(ExtendedUser.objects.filter(is_deleted=False))
 
     # Soft delete a user
     def delete(self, request, *args, **kwargs):
@@ -139,12 +425,232 @@ class UserDetail(generics.RetrieveDestroyAPIView):
         user.save()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
-class AuditList(generics.ListAPIView):
-    queryset=Audit.objects.all()
+class UserSnippetList(generics.ListAPIView):
+    """
+    A paginated list of one user's snippets.
+    """
+    serializer_class = SnippetSerializer
+
+    def get_queryset(self):
+        users = ExtendedUser.objects.all()
+        if not (self.request.user.is_staff and self.request.GET.get('show_deleted')):
+            users = users.filter(is_deleted=False)
+        owner = get_object_or_404(users, pk=self.kwargs["pk"])
+        return SNIPPET_QUERYSET.filter(owner=owner)
+
+def parse_time(params, name):
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        parsed = parse_datetime(value)
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise ValidationError({name: "Expected an ISO 8601 datetime."})
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+def filter_audits(queryset, params, time_field="timestamp"):
+    """
+    Narrow `queryset` by the `model`, `action`, `user` (an id) and
+    `object_id` query params, and by `since` (inclusive) and `until`
+    (exclusive) ISO 8601 datetimes compared with `time_field`.
+    """
+    if params.get("model"):
+        queryset = queryset.filter(model_name=params["model"])
+    if params.get("object_id"):
+        queryset = queryset.filter(object_id=params["object_id"])
+    action = params.get("action")
+    if action:
+        if action not in AuditActionField.CODES:
+            raise ValidationError(
+                {"action": "Expected one of %s." % ", ".join(AuditActionField.CODES)}
+            )
+        queryset = queryset.filter(action=action)
+    user = params.get("user")
+    if user:
+        if not user.isdigit():
+            raise ValidationError({"user": "Expected a user id."})
+        queryset = queryset.filter(user_id=user)
+    since = parse_time(params, "since")
+    if since:
+        queryset = queryset.filter(**{time_field + "__gte": since})
+    until = parse_time(params, "until")
+    if until:
+        queryset = queryset.filter(**{time_field + "__lt": until})
+    return queryset
+
+class AuditList(ReplicaReadMixin, generics.ListAPIView):
+    queryset=Audit.objects.select_related("user")
     permission_classes=[IsAdminUser]
     serializer_class = AuditSerializer
+    pagination_class = AuditCursorPagination
+
+    def get_queryset(self):
+        return filter_audits(super().get_queryset(), self.request.GET)
+
+class AuditHistory(AuditList):
+    """
+    The audits of one object, newest first.
+    """
+    def get_queryset(self):
+        return super().get_queryset().filter(
+            model_name=self.kwargs["model"], object_id=self.kwargs["pk"]
+        )
+
+class Echo:
+    """
+    A file-like object whose `write` hands back what it is given, so
+    `csv.writer` can format rows for a streaming response.
+    """
+    def write(self, value):
+        return value
+
+class AuditExport(APIView):
+    """
+    Stream every audit matching the `AuditList` filters, oldest first, as
+    NDJSON or, with `?export_format=csv`, as CSV. Rows are read with a
+    chunked iterator and formatted without the DRF serializer.
+    """
+    permission_classes=[IsAdminUser]
+    # Column headers, the archive's field names with `username` for the join.
+    columns = [field.replace("user__", "") for field in archive.FIELDS]
+
+    def get(self, request, format=None):
+        export_format = request.GET.get("export_format", "ndjson")
+        if export_format not in ("csv", "ndjson"):
+            raise ValidationError({"export_format": "Expected csv or ndjson."})
+
+        chunk_size = getattr(settings, "SNIPPETS_AUDIT_EXPORT_CHUNK_SIZE", 2000)
+        rows = (
+            filter_audits(Audit.objects.order_by("timestamp", "id"), request.GET)
+            .values_list(*archive.FIELDS)
+            .iterator(chunk_size=chunk_size)
+        )
+        if export_format == "csv":
+            content = self.iter_csv(rows)
+            content_type = "text/csv; charset=utf-8"
+        else:
+            content = self.iter_ndjson(rows)
+            content_type = "application/x-ndjson"
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response["Content-Disposition"] = 'attachment; filename="audits.%s"' % export_format
+        return response
+
+    def iter_csv(self, rows):
+        writer = csv.writer(Echo())
+        yield writer.writerow(self.columns)
+        changes = self.columns.index("changes")
+        for row in rows:
+            row = list(row)
+            if row[changes] is not None:
+                row[changes] = json.dumps(row[changes], cls=DjangoJSONEncoder)
+            yield writer.writerow(row)
+
+    def iter_ndjson(self, rows):
+        encoder = DjangoJSONEncoder()
+        for row in rows:
+            yield encoder.encode(dict(zip(self.columns, row))) + "\n"
+
+class AuditRollupList(generics.GenericAPIView):
+    """
+    Audit counts summed from the hourly rollups, oldest first. `group_by`
+    lists the dimensions kept, any of `hour`, `model`, `action` and `user`
+    (all by default), and `model`, `action`, `user` (an id), `since` and
+    `until` filter as in `AuditList`.
+    """
+    permission_classes=[IsAdminUser]
+    dimensions = {
+        "hour": ["hour"],
+        "model": ["model_name"],
+        "action": ["action"],
+        "user": ["user_id", "user__username"],
+    }
+
+    def get_queryset(self):
+        params = self.request.GET
+        groups = params.get("group_by", ",".join(self.dimensions)).split(",")
+        if not set(groups) <= set(self.dimensions):
+            raise ValidationError(
+                {"group_by": "Expected some of %s." % ", ".join(self.dimensions)}
+            )
+
+        # Rollups do not keep object ids.
+        params = params.copy()
+        params.pop("object_id", None)
+        queryset = filter_audits(AuditRollup.objects.all(), params, time_field="hour")
+
+        fields = [field for group in self.dimensions if group in groups for field in self.dimensions[group]]
+        return queryset.values(*fields).annotate(count=Sum("count")).order_by(*fields)
+
+    def get(self, request, format=None):
+        page = self.paginate_queryset(self.get_queryset())
+        rows = [
+            {key.replace("user__", ""): value for key, value in row.items()}
+            for row in page
+        ]
+        return self.get_paginated_response(rows)
+
+class AuditArchiveList(APIView):
+    """
+    The days whose audits were moved to the archive by `archive_audits`.
+    """
+    permission_classes=[IsAdminUser]
+
+    def get(self, request, format=None):
+        return Response([
+            {
+                "date": day.isoformat(),
+                "url": reverse("audit-archive-detail", args=[day.isoformat()], request=request, format=format),
+                "size": archive.partition_path(day).stat().st_size,
+            }
+            for day in archive.partitions()
+        ])
+
+class AuditArchiveDetail(generics.ListAPIView):
+    """
+    The archived audits of one day, read from the archive file, filtered
+    by the `model`, `action`, `user` (an id) and `object_id` query params.
+    The file is only read up to the requested page.
+    """
+    permission_classes=[IsAdminUser]
+    serializer_class = ArchivedAuditSerializer
+    pagination_class = StreamPagination
+
+    def get_queryset(self):
+        try:
+            day = datetime.date.fromisoformat(self.kwargs["day"])
+        except ValueError:
+            raise Http404
+        if not archive.partition_path(day).exists():
+            raise Http404
+
+        params = self.request.GET
+        wanted = {
+            key: params[param]
+            for param, key in (
+                ("model", "model_name"),
+                ("action", "action"),
+                ("user", "user_id"),
+                ("object_id", "object_id"),
+            )
+            if params.get(param)
+        }
+        return (
+            row
+            for row in archive.read_partition(day)
+            if all(str(row[key]) == value for key, value in wanted.items())
+        )
 
 class AuditDetail(generics.RetrieveAPIView):
-    queryset=Audit.objects.all()
+    queryset=Audit.objects.select_related("user")
+    permission_classes=[IsAdminUser]
+    serializer_class = AuditSerializer
+
+class HighlightCacheStats(APIView):
     permission_classes=[IsAdminUser]
-    serializer_class = AuditSerializer
\ No newline at end of file
+
+    def get(self, request):
+        return Response(highlighting.cache_stats())
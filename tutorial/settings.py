@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -50,6 +51,8 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "snippets.middleware.ReplicaStickyMiddleware",
+    "snippets.middleware.AuditMiddleware",
 ]
 
 ROOT_URLCONF = "tutorial.urls"
@@ -77,11 +80,13 @@ WSGI_APPLICATION = "tutorial.wsgi.application"
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
 DATABASES = {
+    # Starts transactions with BEGIN IMMEDIATE, see the backend module.
     "default": {
-        "ENGINE": "django.db.backends.sqlite3",
+        "ENGINE": "snippets.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
-    }
+    },
 }
+DATABASE_ROUTERS = ["snippets.routers.ReplicaRouter"]
 
 
 # Password validation
@@ -129,9 +134,144 @@ REST_FRAMEWORK = {
     "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.PageNumberPagination",
     "PAGE_SIZE": 10,
     "DEFAULT_AUTHENTICATION_CLASSES": [
-        "rest_framework.authentication.TokenAuthentication",
+        "snippets.authentication.SignedTokenAuthentication",
+        "snippets.authentication.CachedTokenAuthentication",
         "rest_framework.authentication.SessionAuthentication",
     ]
 }
 
-AUTH_USER_MODEL = 'snippets.ExtendedUser'
\ No newline at end of file
+AUTH_USER_MODEL = 'snippets.ExtendedUser'
+
+# Session users are cached per process, see snippets.authentication.
+AUTHENTICATION_BACKENDS = ["snippets.authentication.CachedModelBackend"]
+# Render snippet highlights on a pool of worker processes instead of inside
+# the request. SNIPPETS_HIGHLIGHT_WORKERS defaults to the number of CPUs.
+SNIPPETS_HIGHLIGHT_ASYNC = False
+SNIPPETS_HIGHLIGHT_WORKERS = None
+# Pending renders older than this many seconds are rendered by the next
+# request for the highlight, as the process that scheduled them may be gone.
+SNIPPETS_HIGHLIGHT_PENDING_TIMEOUT = 60
+
+# Highlight cache: number of renders kept in each process's LRU, and whether
+# renders are also persisted to the HighlightCache table.
+SNIPPETS_HIGHLIGHT_CACHE_SIZE = 256
+SNIPPETS_HIGHLIGHT_CACHE_PERSISTENT = True
+
+# Per-process pool of Pygments lexers and formatters: how many
+# (language, linenos) combinations to keep, and idle instances per combination.
+SNIPPETS_HIGHLIGHT_POOL_KEYS = 64
+SNIPPETS_HIGHLIGHT_POOL_PER_KEY = 4
+
+# Highlight responses: stored fragments longer than the threshold are streamed
+# from the database in chunks, and snippets whose code is longer than
+# SNIPPETS_HIGHLIGHT_MAX_SIZE are not pre-rendered but highlighted while
+# streaming, SNIPPETS_HIGHLIGHT_STREAM_LINES lines at a time.
+SNIPPETS_HIGHLIGHT_STREAM_THRESHOLD = 256 * 1024
+SNIPPETS_HIGHLIGHT_CHUNK_SIZE = 64 * 1024
+SNIPPETS_HIGHLIGHT_MAX_SIZE = 1024 * 1024
+SNIPPETS_HIGHLIGHT_STREAM_LINES = 1000
+
+# Store Snippet.code and Snippet.highlighted compressed. Gzip-capable clients
+# are then served the stored highlight without recompressing it.
+SNIPPETS_COMPRESSED_STORAGE = False
+SNIPPETS_COMPRESSION_LEVEL = 6
+
+# Bulk snippet import: largest accepted batch, and the number of uncached
+# renders from which a batch is spread over the highlight worker pool.
+SNIPPETS_BULK_MAX_ITEMS = 500
+SNIPPETS_HIGHLIGHT_POOL_MIN_BATCH = 4
+
+# Audit records made while handling a request, or inside
+# snippets.audit.buffered(), are written in one bulk insert after their
+# transaction commits, or sooner once this many are buffered or the oldest
+# has waited this many seconds.
+SNIPPETS_AUDIT_BUFFER_SIZE = 500
+SNIPPETS_AUDIT_BUFFER_AGE = 5
+
+# Audits older than SNIPPETS_AUDIT_RETENTION_DAYS are moved by
+# `manage.py archive_audits` into per-day gzip files in this directory.
+SNIPPETS_AUDIT_RETENTION_DAYS = 90
+SNIPPETS_AUDIT_ARCHIVE_DIR = BASE_DIR / "audit-archive"
+
+# Rows fetched per database round trip by the streaming audit export.
+SNIPPETS_AUDIT_EXPORT_CHUNK_SIZE = 2000
+
+# Token authentication remembers up to SNIPPETS_TOKEN_CACHE_SIZE resolved
+# tokens per process for SNIPPETS_TOKEN_CACHE_TTL seconds.
+SNIPPETS_TOKEN_CACHE_SIZE = 1024
+SNIPPETS_TOKEN_CACHE_TTL = 60
+
+# Signed bearer tokens from token/signed/ and session/: key (SECRET_KEY when
+# None) and lifetimes in seconds of the access and refresh tokens.
+SNIPPETS_SIGNED_TOKEN_KEY = None
+SNIPPETS_ACCESS_TOKEN_TTL = 5 * 60
+SNIPPETS_REFRESH_TOKEN_TTL = 14 * 24 * 3600
+
+# Sessions are read from the shared cache and written through to the
+# database, so a logout is seen by every process at once.
+# SNIPPETS_SHARED_CACHE names the cache for state every process must see,
+# such as the invalidation stamps of the token and user caches. The file
+# cache, in SNIPPETS_SHARED_CACHE_DIR or shared-cache/, is shared by the
+# processes of one host, use Redis or Memcached across hosts. Tests run
+# with the file caches in a temporary directory.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "shared": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.environ.get("SNIPPETS_SHARED_CACHE_DIR", BASE_DIR / "shared-cache"),
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+}
+SNIPPETS_SHARED_CACHE = "shared"
+TEST_RUNNER = "snippets.runner.TestRunner"
+SESSION_ENGINE = "django.contrib.sessions.backends.cached_db"
+SESSION_CACHE_ALIAS = SNIPPETS_SHARED_CACHE
+
+# Users of sessions are cached for up to SNIPPETS_USER_CACHE_TTL seconds.
+SNIPPETS_USER_CACHE_SIZE = 1024
+SNIPPETS_USER_CACHE_TTL = 30
+
+# Pragmas run on every new SQLite connection, from the profile named by
+# the SNIPPETS_SQLITE_PROFILE environment variable, none by default. The
+# "production" profile: write-ahead logging so readers never block the
+# writer, fewer fsyncs, waiting up to 5s for locks instead of failing, a
+# 256 MiB memory map and a 64 MiB page cache.
+SNIPPETS_SQLITE_PROFILE = os.environ.get("SNIPPETS_SQLITE_PROFILE")
+SNIPPETS_SQLITE_PROFILES = {
+    "production": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "busy_timeout": 5000,
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,
+        "temp_store": "memory",
+    },
+}
+
+# Make write transactions queue on one lock instead of contending for
+# SQLite's. SNIPPETS_WRITE_LOCK_FILE extends the lock across processes.
+SNIPPETS_SERIALIZE_WRITES = False
+SNIPPETS_WRITE_LOCK_FILE = None
+
+# Replicas the snippet, user and audit lists and the highlight pages read
+# from, none unless listed in the environment, e.g.
+# SNIPPETS_READ_REPLICAS=replica once `sync_replica --interval` runs.
+# Replicas not synced for SNIPPETS_REPLICA_MAX_LAG seconds are skipped, and
+# a user who wrote reads from "default" for
+# SNIPPETS_REPLICA_STICKY_SECONDS. Both should exceed the sync interval, and
+# the lag should not exceed the sticky window.
+SNIPPETS_READ_REPLICAS = [
+    alias for alias in os.environ.get("SNIPPETS_READ_REPLICAS", "").split(",") if alias
+]
+# Each a read-only copy of "default" in db.<alias>.sqlite3, refreshed by
+# `manage.py sync_replica`.
+for alias in SNIPPETS_READ_REPLICAS:
+    DATABASES[alias] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": "file:%s?mode=ro" % (BASE_DIR / ("db.%s.sqlite3" % alias)),
+        "TEST": {"MIRROR": "default"},
+    }
+SNIPPETS_REPLICA_MAX_LAG = 10
+SNIPPETS_REPLICA_STICKY_SECONDS = 10